@@ -0,0 +1,62 @@
+"""Gunicorn settings used by the Docker image.
+
+Set WEB_WORKERS to serve the SSE streams from more than one process. Broker
+connections must then be shared by every worker, so unless INGEST_SOCKET
+already points at a running ingestion process, one is started next to
+gunicorn and stopped with it.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+bind = "0.0.0.0:8585"
+worker_class = "eventlet"
+workers = int(os.environ.get("WEB_WORKERS", "1"))
+# Run from src so app:app and its templates/static are found
+chdir = os.path.join(ROOT, "src")
+
+spawn_ingest = workers > 1 and not os.environ.get("INGEST_SOCKET")
+if spawn_ingest:
+    # Inherited by the workers, which then use the shared registry
+    os.environ["INGEST_SOCKET"] = os.path.join(ROOT, "data", "ingest.sock")
+
+_ingest = None
+
+
+def on_starting(server):
+    """Start the ingestion process before the workers connect to it."""
+    global _ingest
+    if not spawn_ingest:
+        return
+    path = os.environ["INGEST_SOCKET"]
+    if os.path.exists(path):
+        os.remove(path)
+    _ingest = subprocess.Popen([sys.executable, os.path.join(ROOT, "src", "ingest.py")])
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.1)
+
+
+def post_worker_init(worker):
+    """Connect the saved brokers flagged auto_connect.
+
+    With a single worker holding the connections this runs once per worker
+    start; an ingestion process connects them itself instead.
+    """
+    if os.environ.get("INGEST_SOCKET"):
+        return
+    from app import auto_connect_brokers
+
+    auto_connect_brokers()
+
+
+def on_exit(server):
+    """Stop the ingestion process started by on_starting."""
+    if _ingest is not None:
+        _ingest.terminate()
+        _ingest.wait(timeout=10)
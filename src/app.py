@@ -5,7 +5,10 @@ if os.environ.get("NO_MONKEY_PATCH") != "1":
 
     eventlet.monkey_patch()
 
+import hmac
 import json
+from datetime import datetime
+
 import click
 
 from flask import (  # noqa: E402
@@ -18,15 +21,45 @@ from flask import (  # noqa: E402
     session,
     Response,
     stream_with_context,
+    abort,
+    jsonify,
+)
+from database import (  # noqa: E402
+    db,
+    User,
+    Broker,
+    add_missing_columns,
+    add_missing_indexes,
+    configure_sqlite,
+    engine_options,
+    DATABASE_PATH,
 )
-from database import db, User, Broker  # noqa: E402
 from mqtt_manager import (  # noqa: E402
-    add_client,
-    get_client,
-    remove_client,
     listeners,
-    listeners_lock,
+    ListenerQueue,
+    OVERFLOW_POLICIES,
+    COALESCE,
+)
+from sse import (  # noqa: E402
+    LATEST_INTERVAL,
+    latest_events,
+    latest_interval,
+    message_events,
 )
+import broker_cache  # noqa: E402
+import history  # noqa: E402
+import loadgen  # noqa: E402
+import logs  # noqa: E402
+import metrics  # noqa: E402
+import registry  # noqa: E402
+import topics  # noqa: E402
+
+logs.setup()
+log = logs.get_logger("app")
+
+# Broker connections: in this process, or shared through the ingestion process
+clients = registry.create_registry()
+clients.start()
 
 
 app = Flask(__name__)
@@ -37,16 +70,45 @@ data_dir = os.path.join(
 )
 os.makedirs(data_dir, exist_ok=True)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = (
-    f"sqlite:///{os.path.join(data_dir, 'antena.db')}"
-)
+app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DATABASE_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
 
 db.init_app(app)
 
 
 with app.app_context():
+    configure_sqlite(db.engine)
     db.create_all()
+    add_missing_columns()
+    add_missing_indexes()
+
+history.init_history(data_dir, start_writer=not clients.shared)
+
+# The brokers each user has saved, so pages and ownership checks skip the DB
+saved_brokers = broker_cache.BrokerCache(
+    lambda user_id: Broker.query.filter_by(user_id=user_id).all()
+)
+saved_brokers.track_changes(Broker)
+
+
+def auto_connect_brokers():
+    """Connect every broker flagged auto_connect.
+
+    Called once when the server starts (see gunicorn.conf.py), not on
+    import, so CLI commands and tests don't connect. Connections are
+    started without waiting, so they all proceed in parallel and
+    unreachable brokers are retried in the background. With an ingestion
+    process the connections live there and it connects them itself.
+    """
+    if app.testing or clients.shared:
+        return
+    with app.app_context():
+        saved = Broker.query.filter_by(auto_connect=True).all()
+    for broker in saved:
+        clients.add_client(broker).connect(wait=0)
+    if saved:
+        log.info("Auto-connecting %d brokers", len(saved))
 
 
 def get_version():
@@ -124,6 +186,7 @@ def register():
             new_user.set_password(password)
             db.session.add(new_user)
             db.session.commit()
+            log.info("User %s registered", username)
 
             session["user_id"] = new_user.id
             flash("Account created! Logged in.", "success")
@@ -149,6 +212,7 @@ def login():
             flash("Logged in!", "success")
             return redirect(url_for("brokers"))
         else:
+            log.warning("Failed login for %s", username)
             flash("Invalid credentials", "error")
     return render_template("login.html")
 
@@ -173,11 +237,12 @@ def edit_broker(broker_id):
         broker.port = int(request.form.get("port", 1883))
         broker.username = request.form.get("username")
         broker.password = request.form.get("password")
+        broker.auto_connect = request.form.get("auto_connect") == "on"
 
         if not broker.name:
             broker.name = broker.ip
 
-        remove_client(broker.id)
+        clients.remove_client(broker.id)
 
         db.session.commit()
         flash("Broker updated", "success")
@@ -186,6 +251,35 @@ def edit_broker(broker_id):
     return render_template("edit_broker.html", broker=broker)
 
 
+def user_client(broker_id):
+    """The client of `broker_id` if it belongs to the session user, else None.
+
+    Ownership is checked on the live client rather than with saved_brokers:
+    another worker's cache may be stale, and SQLite reuses the ids of
+    deleted brokers.
+    """
+    client = clients.get_client(broker_id)
+    if client is None or client.user_id != session["user_id"]:
+        return None
+    return client
+
+
+@app.route("/brokers/<int:broker_id>/topics")
+@login_required
+def topic_tree(broker_id):
+    """One level of a connected broker's topic tree.
+
+    Without `path` the root is returned; `?path=a/b` expands that node.
+    """
+    client = user_client(broker_id)
+    if client is None:
+        return jsonify({"error": "Broker not connected"}), 404
+    node = client.topic_tree(request.args.get("path"))
+    if node is None:
+        return jsonify({"error": "Unknown topic"}), 404
+    return jsonify(node)
+
+
 @app.route("/brokers", methods=["GET", "POST"])
 @login_required
 def brokers():
@@ -197,6 +291,7 @@ def brokers():
             port = int(request.form.get("port", 1883))
             user = request.form.get("username")
             password = request.form.get("password")
+            auto_connect = request.form.get("auto_connect") == "on"
 
             if not name:
                 name = ip
@@ -207,6 +302,7 @@ def brokers():
                 port=port,
                 username=user,
                 password=password,
+                auto_connect=auto_connect,
                 user_id=session["user_id"],
             )
             db.session.add(new_broker)
@@ -218,7 +314,7 @@ def brokers():
             broker = Broker.query.filter_by(id=b_id, user_id=session["user_id"]).first()
             if broker:
                 # Disconnect if connected
-                remove_client(broker.id)
+                clients.remove_client(broker.id)
                 db.session.delete(broker)
                 db.session.commit()
                 flash("Broker deleted", "success")
@@ -227,44 +323,77 @@ def brokers():
             b_id = request.form.get("broker_id")
             broker = Broker.query.filter_by(id=b_id, user_id=session["user_id"]).first()
             if broker:
-                client = add_client(broker)
+                client = clients.add_client(broker)
                 success, error = client.connect()
-                if success:
+                if success and clients.shared:
+                    # The ingestion process connects in the background
+                    flash(f"Connecting to {broker.name}", "info")
+                elif success:
+                    log.info(
+                        "Broker %s connected by user %s", broker.id, broker.user_id
+                    )
                     flash(f"Connected to {broker.name}", "success")
                 else:
-                    flash(f"Error connecting: {error}", "error")
+                    flash(f"Error connecting: {error} (retrying)", "error")
 
         elif "disconnect" in request.form:
             b_id = request.form.get("broker_id")
             broker = Broker.query.filter_by(id=b_id, user_id=session["user_id"]).first()
             if broker:
-                remove_client(broker.id)
-                flash("Disconnected", "info")
+                clients.remove_client(broker.id)
+                if broker.auto_connect:
+                    # Stay disconnected across restarts, as the user asked
+                    broker.auto_connect = False
+                    db.session.commit()
+                    flash("Disconnected; auto-connect turned off", "info")
+                else:
+                    flash("Disconnected", "info")
 
         return redirect(url_for("brokers"))
 
     # GET
-    all_brokers = Broker.query.filter_by(user_id=session["user_id"]).all()
-
-    brokers_data = []
-    for b in all_brokers:
-        client = get_client(b.id)
-        status = "disconnected"
-        if client:
-            if client.is_connected:
-                status = "connected"
-            elif client.connection_error:
-                status = "error"
-
-        brokers_data.append(
+    active = clients.user_clients(session["user_id"])
+    brokers_data = [
+        {
+            "obj": b,
+            "status": broker_status(active.get(b.id)),
+            "error": active[b.id].connection_error if b.id in active else None,
+        }
+        for b in saved_brokers.brokers(session["user_id"])
+    ]
+
+    return render_template("brokers.html", brokers=brokers_data)
+
+
+def broker_status(client):
+    """Connection status shown for a broker with this active client (or None)."""
+    if client is None:
+        return "disconnected"
+    if client.is_connected:
+        return "connected"
+    if client.connection_error:
+        return "error"
+    return "connecting"
+
+
+@app.route("/brokers/status")
+@login_required
+def brokers_status():
+    """Connection status of the user's brokers, for pages polling it."""
+    active = clients.user_clients(session["user_id"])
+    data = []
+    for b in saved_brokers.brokers(session["user_id"]):
+        client = active.get(b.id)
+        data.append(
             {
-                "obj": b,
-                "status": status,
+                "id": b.id,
+                "name": b.name,
+                "status": broker_status(client),
                 "error": client.connection_error if client else None,
+                "subscriptions": sorted(client.subscriptions) if client else [],
             }
         )
-
-    return render_template("brokers.html", brokers=brokers_data)
+    return jsonify({"brokers": data})
 
 
 @app.route("/subscription")
@@ -272,50 +401,60 @@ def brokers():
 def subscription():
     """Display and manage MQTT topic subscriptions."""
     active_brokers_data = []
-    user_brokers = Broker.query.filter_by(user_id=session["user_id"]).all()
+    user_brokers = saved_brokers.brokers(session["user_id"])
+    active = clients.user_clients(session["user_id"])
     for b in user_brokers:
-        c = get_client(b.id)
+        c = active.get(b.id)
         if c and c.is_connected:
-            is_listening = len(c.subscribed_topics) > 0
-            current_topic = list(c.subscribed_topics)[0] if is_listening else ""
-
             active_brokers_data.append(
                 {
                     "id": c.broker_id,
                     "name": c.name,
-                    "is_listening": is_listening,
-                    "current_topic": current_topic,
+                    "is_listening": bool(c.subscriptions),
+                    "subscriptions": sorted(c.subscriptions.items()),
                 }
             )
 
-    return render_template("subscription.html", active_brokers=active_brokers_data)
+    return render_template(
+        "subscription.html",
+        active_brokers=active_brokers_data,
+        user_brokers=user_brokers,
+        history_enabled=history.store is not None,
+    )
 
 
 @app.route("/toggle_listen", methods=["POST"])
 @login_required
 def toggle_listen():
-    """Start or stop listening to a specific MQTT topic."""
+    """Subscribe to or unsubscribe from MQTT topics on a broker."""
     broker_id = request.form.get("broker_id")
     topic = request.form.get("topic")
     action = request.form.get("action")
+    qos = int(request.form.get("qos", 0))
 
     if not broker_id:
         flash("Select a broker", "error")
         return redirect(url_for("subscription"))
 
-    client = get_client(int(broker_id))
+    client = clients.get_client(int(broker_id))
     if client:
         # Verify ownership
-        broker = Broker.query.get(int(broker_id))
-        if not broker or broker.user_id != session["user_id"]:
+        if client.user_id != session["user_id"]:
             flash("Unauthorized", "error")
             return redirect(url_for("subscription"))
 
         if action == "stop":
             client.clear_subscription()
             flash(f"Stopped listening on {client.name}", "info")
+        elif action == "unsubscribe":
+            client.remove_subscription(topic)
+            flash(f"Stopped listening to {topic} on {client.name}", "info")
         else:
-            client.update_subscription(topic)
+            try:
+                client.add_subscription(topic, qos)
+            except ValueError as e:
+                flash(str(e), "error")
+                return redirect(url_for("subscription"))
             flash(
                 f"Listening to {topic if topic else 'all topics'} on {client.name}",
                 "success",
@@ -329,34 +468,176 @@ def toggle_listen():
 def stream():
     """Server-Sent Events (SSE) stream for real-time MQTT messages."""
 
+    batch = request.args.get("batch") == "1"
+    # Follow every frame with a `trace` event timing its messages
+    trace = request.args.get("trace") == "1"
+    overflow = request.args.get("overflow")
+    if overflow and overflow not in OVERFLOW_POLICIES:
+        abort(400)
+    # "latest": one update per topic every `interval` seconds, with its rate
+    latest = request.args.get("mode") == "latest"
+    try:
+        interval = latest_interval(request.args.get("interval", LATEST_INTERVAL))
+    except ValueError:
+        abort(400)
+    if latest and not overflow:
+        # Only the newest message of a topic is shown, so a full queue can
+        # always keep that one
+        overflow = COALESCE
+    # Sent by EventSource when it reconnects; replay what was missed meanwhile
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id"
+    )
+    last_event_id = int(last_event_id) if (last_event_id or "").isdigit() else None
+    # Optional server-side filters: ?topic=a/+/b&topic=c/#&broker_id=3
+    topic_filters = [t for t in request.args.getlist("topic") if t]
+    broker_ids = request.args.getlist("broker_id", type=int)
+    try:
+        for topic_filter in topic_filters:
+            topics.validate_filter(topic_filter)
+    except ValueError:
+        abort(400)
+
     def event_stream():
         """Generator function for streaming messages via SSE."""
-        import queue
-
-        q = queue.Queue()
+        q = ListenerQueue(policy=overflow)
         user_id = session["user_id"]
-        with listeners_lock:
-            if user_id not in listeners:
-                listeners[user_id] = []
-            listeners[user_id].append(q)
+        listeners.add(user_id, q, topic_filters, broker_ids)
         try:
-            while True:
-                # 30s timeout to send keepalive
-                try:
-                    msg = q.get(timeout=20)
-                    yield f"data: {json.dumps(msg)}\n\n"
-                except queue.Empty:
-                    yield ": keepalive\n\n"
-        except GeneratorExit:
-            with listeners_lock:
-                if user_id in listeners:
-                    listeners[user_id].remove(q)
-                    if not listeners[user_id]:
-                        del listeners[user_id]
+            replay = clients.replay_messages(
+                user_id,
+                last_event_id,
+                topic_filters=topic_filters,
+                broker_ids=broker_ids,
+            )
+            if latest:
+                yield from latest_events(q, interval=interval, replay=replay)
+            else:
+                yield from message_events(q, batch=batch, replay=replay, trace=trace)
+        finally:
+            # Closed by the client or failed: never leave the queue registered
+            listeners.remove(user_id, q)
 
     return Response(stream_with_context(event_stream()), mimetype="text/event-stream")
 
 
+# Browser latency samples accepted per /stream/trace report
+MAX_TRACE_SAMPLES = 1000
+
+
+@app.route("/stream/trace", methods=["POST"])
+@login_required
+def stream_trace():
+    """Record the arrival-to-render latencies measured by a traced page."""
+    data = request.get_json(silent=True) or {}
+    samples = data.get("render_ms")
+    if not isinstance(samples, list):
+        abort(400)
+    for value in samples[:MAX_TRACE_SAMPLES]:
+        if isinstance(value, (int, float)):
+            # Clock skew between server and browser can make a sample negative
+            metrics.browser_latency.observe_ns(max(0, int(value * 1e6)))
+    return "", 204
+
+
+# Bearer token required by /metrics; without one only local clients may scrape
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics of the brokers, listener queues and delivery.
+
+    They are labelled by user and broker, so they are not public: scrapers
+    send `Authorization: Bearer $METRICS_TOKEN`, or connect from this host
+    when no token is set.
+    """
+    if METRICS_TOKEN:
+        expected = f"Bearer {METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            abort(401)
+    elif request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
+    text = clients.broker_metrics() + metrics.render_listeners(listeners)
+    return Response(text, content_type=metrics.CONTENT_TYPE)
+
+
+def parse_time(value):
+    """Parse an epoch timestamp or ISO 8601 date from a query parameter.
+
+    Dates need a UTC offset (`Z` or `+02:00`): the server cannot know the
+    time zone the user meant.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        raise ValueError(f"Date without a time zone: {value}")
+    return moment.timestamp()
+
+
+@app.route("/history")
+@login_required
+def message_history():
+    """Query recorded messages as a JSON page or an NDJSON stream."""
+    store = history.store
+    if store is None:
+        return jsonify({"error": "Message history is disabled"}), 404
+
+    # Read from the database: the history is only keyed by broker id
+    broker_names = dict(
+        db.session.execute(
+            db.select(Broker.id, Broker.name).filter_by(user_id=session["user_id"])
+        ).all()
+    )
+    broker_id = request.args.get("broker_id", type=int)
+    if broker_id is not None and broker_id not in broker_names:
+        return jsonify({"error": "Broker not found"}), 404
+    broker_ids = [broker_id] if broker_id is not None else list(broker_names)
+
+    topic_filter = request.args.get("topic") or None
+    cursor = request.args.get("cursor") or None
+    try:
+        if topic_filter:
+            topics.validate_filter(topic_filter)
+        if cursor:
+            history.decode_cursor(cursor)
+        start = parse_time(request.args.get("start"))
+        end = parse_time(request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+
+    if request.args.get("format") == "ndjson":
+
+        def generate():
+            """Stream every matching message as one JSON document per line."""
+            for _, row in store.iter_query(
+                broker_ids, topic_filter, start, end, cursor
+            ):
+                message = history.message_dict(row)
+                message["broker_name"] = broker_names.get(message["broker_id"])
+                yield json.dumps(message) + "\n"
+
+        return Response(
+            stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
+    messages, next_cursor = store.query(
+        broker_ids, topic_filter, start, end, limit, cursor
+    )
+    for message in messages:
+        message["broker_name"] = broker_names.get(message["broker_id"])
+    return jsonify({"messages": messages, "next_cursor": next_cursor})
+
+
+# Seconds /publish waits for a message's acknowledgement before answering
+PUBLISH_ACK_WAIT = float(os.environ.get("PUBLISH_ACK_WAIT", "2"))
+
+
 @app.route("/publish", methods=["GET", "POST"])
 @login_required
 def publish():
@@ -368,31 +649,143 @@ def publish():
         qos = int(request.form.get("qos", 0))
         retain = request.form.get("retain") == "on"
 
-        client = get_client(int(broker_id))
+        client = clients.get_client(int(broker_id))
         if client and client.is_connected:
             # Verify ownership
-            broker = Broker.query.get(int(broker_id))
-            if not broker or broker.user_id != session["user_id"]:
+            if client.user_id != session["user_id"]:
                 flash("Unauthorized", "error")
                 return redirect(url_for("publish"))
 
-            client.publish(topic, message, qos=qos, retain=retain)
-            flash(f"Message published (QoS: {qos}, Retain: {retain})", "success")
+            record = client.publish(topic, message, qos=qos, retain=retain)
+            status = client.publish_status(record.id, wait=PUBLISH_ACK_WAIT)
+            if status is None:
+                flash("Message published; its status is no longer tracked", "info")
+            elif status["state"] == "failed":
+                flash(f"Publish failed (rc {status['rc']})", "error")
+            elif status["state"] == "pending":
+                flash(
+                    f"Message queued (QoS: {qos}), not acknowledged yet"
+                    f" (publish {record.id})",
+                    "info",
+                )
+            else:
+                flash(
+                    f"Message published (QoS: {qos}, Retain: {retain}),"
+                    f" acknowledged in {status['ack_ms']:.1f} ms",
+                    "success",
+                )
         else:
             flash("Broker not connected", "error")
 
-    user_brokers = Broker.query.filter_by(user_id=session["user_id"]).all()
+    active = clients.user_clients(session["user_id"])
     active_brokers = [
-        {"id": c.broker_id, "name": c.name}
-        for c in [get_client(b.id) for b in user_brokers]
-        if c and c.is_connected
+        {"id": b.id, "name": active[b.id].name}
+        for b in saved_brokers.brokers(session["user_id"])
+        if b.id in active and active[b.id].is_connected
     ]
     return render_template("publish.html", active_brokers=active_brokers)
 
 
+def connected_client(broker_id):
+    """The user's broker client if connected, else None."""
+    client = user_client(broker_id)
+    return client if client and client.is_connected else None
+
+
+@app.route("/brokers/<int:broker_id>/publishes")
+@login_required
+def publish_status(broker_id):
+    """In-flight window and completion statistics of a broker's publishes."""
+    client = connected_client(broker_id)
+    if client is None:
+        return jsonify({"error": "Broker not connected"}), 404
+    return jsonify(client.publish_summary())
+
+
+@app.route("/brokers/<int:broker_id>/publishes/<int:publish_id>")
+@login_required
+def publish_record(broker_id, publish_id):
+    """Delivery status of one publish (pending, acked or failed)."""
+    client = connected_client(broker_id)
+    if client is None:
+        return jsonify({"error": "Broker not connected"}), 404
+    status = client.publish_status(publish_id)
+    if status is None:
+        return jsonify({"error": "Unknown publish"}), 404
+    return jsonify(status)
+
+
+@app.route("/publish/bulk", methods=["POST"])
+@login_required
+def publish_bulk():
+    """Publish many messages in one request.
+
+    The body is either JSON, `{"broker_id": 1, "messages": [...]}`, or
+    NDJSON (application/x-ndjson) with one message per line and the broker
+    in `?broker_id=`. See loadgen for the message fields.
+    """
+    if request.mimetype == "application/x-ndjson":
+        broker_id = request.args.get("broker_id", type=int)
+        messages = []
+        for number, line in enumerate(request.get_data().splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                return jsonify({"error": f"Invalid JSON on line {number}"}), 400
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Expected a JSON object"}), 400
+        broker_id = data.get("broker_id")
+        messages = data.get("messages")
+    if not isinstance(broker_id, int) or not isinstance(messages, list):
+        return jsonify({"error": "broker_id and messages are required"}), 400
+    if len(messages) > loadgen.BULK_PUBLISH_MAX:
+        return (
+            jsonify({"error": f"At most {loadgen.BULK_PUBLISH_MAX} messages"}),
+            413,
+        )
+
+    client = connected_client(broker_id)
+    if client is None:
+        return jsonify({"error": "Broker not connected"}), 404
+    return jsonify(client.publish_many(messages))
+
+
+@app.route("/publish/load", methods=["POST"])
+@login_required
+def start_load():
+    """Start a load job publishing at a rate on a connected broker."""
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict) or not isinstance(params.get("broker_id"), int):
+        return jsonify({"error": "broker_id is required"}), 400
+    client = connected_client(params.pop("broker_id"))
+    if client is None:
+        return jsonify({"error": "Broker not connected"}), 404
+    try:
+        job = client.start_load(params)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(job), 202
+
+
+@app.route("/publish/load/<int:job_id>", methods=["GET", "DELETE"])
+@login_required
+def load_job(job_id):
+    """Progress of a load job; DELETE stops it."""
+    job = clients.load_job(job_id)
+    if job is None or job["user_id"] != session["user_id"]:
+        return jsonify({"error": "Unknown load job"}), 404
+    if request.method == "DELETE":
+        job = clients.load_job(job_id, stop=True)
+    return jsonify(job)
+
+
 if __name__ == "__main__":
-    print("\n-------------------------------------------")
-    print(" 📡 MQTT Antena is starting!")
-    print(" Access it at: http://localhost:8585")
-    print("-------------------------------------------\n")
+    # The debug reloader runs this twice; connect from the serving child only
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        auto_connect_brokers()
+    log.info("📡 MQTT Antena is starting! Access it at: http://localhost:8585")
     app.run(host="0.0.0.0", port=8585, debug=True)
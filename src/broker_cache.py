@@ -0,0 +1,113 @@
+"""In-process cache of the brokers each user has saved.
+
+The broker pages and the publish and subscription forms list the user's
+brokers on every request. They are read from the database once per user and
+kept here until a broker of that user is added, edited or deleted.
+
+The cache is for display only. Other workers' entries can be stale and
+SQLite reuses the ids of deleted brokers, so routes acting on a broker check
+the owner of its live client (or query the database) instead.
+
+Invalidation follows committed ORM changes (see track_changes), so it is
+immediate in the process making the change. Other web workers sharing an
+ingestion process see it once their entry expires, after BROKER_CACHE_TTL
+seconds. Bulk query updates and deletes bypass the ORM events and must call
+invalidate() themselves.
+"""
+
+import os
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+# Seconds a user's cached brokers are trusted without an invalidation
+BROKER_CACHE_TTL = float(os.environ.get("BROKER_CACHE_TTL", "60"))
+
+# Broker metadata shown and checked by the web app (no password)
+BrokerInfo = namedtuple(
+    "BrokerInfo", ["id", "user_id", "name", "ip", "port", "username", "auto_connect"]
+)
+
+
+def broker_info(broker):
+    """Immutable BrokerInfo copy of a Broker row."""
+    return BrokerInfo._make(getattr(broker, field) for field in BrokerInfo._fields)
+
+
+class BrokerCache:
+    """Saved brokers per user, loaded on first use.
+
+    `load(user_id)` returns the user's Broker rows.
+    """
+
+    def __init__(self, load, ttl=None):
+        """Initialize an empty BrokerCache."""
+        self._load = load
+        self.ttl = BROKER_CACHE_TTL if ttl is None else ttl
+        # user_id -> (expiry, {broker_id: BrokerInfo})
+        self._entries = {}
+        # Bumped on invalidation so a load racing with it is not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _user_entry(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        brokers = {b.id: broker_info(b) for b in self._load(user_id)}
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, brokers)
+        return brokers
+
+    def brokers(self, user_id):
+        """The user's brokers, as BrokerInfo in database order."""
+        return list(self._user_entry(user_id).values())
+
+    def get(self, user_id, broker_id):
+        """The user's broker `broker_id`, or None if it is not theirs."""
+        return self._user_entry(user_id).get(broker_id)
+
+    def invalidate(self, user_id=None):
+        """Forget the brokers of `user_id`, or of every user."""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def track_changes(self, model):
+        """Invalidate the owner of every `model` row inserted, updated or deleted.
+
+        Owners are collected while the session flushes and invalidated once
+        it commits, so no request can cache the rows as they were before.
+        """
+
+        # Session.info key of the owners changed in a transaction
+        key = ("broker_cache", id(self))
+
+        def changed(mapper, connection, target):
+            object_session(target).info.setdefault(key, set()).add(target.user_id)
+
+        for name in ("after_insert", "after_update", "after_delete"):
+            event.listen(model, name, changed)
+
+        @event.listens_for(Session, "after_commit")
+        def committed(session):
+            for user_id in session.info.pop(key, ()):
+                self.invalidate(user_id)
+
+        @event.listens_for(Session, "after_rollback")
+        def rolled_back(session):
+            session.info.pop(key, None)
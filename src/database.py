@@ -1,9 +1,70 @@
+import os
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.schema import CreateColumn
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# The app database; ":memory:" gives a throwaway one (used by the tests)
+DATABASE_PATH = os.environ.get(
+    "DATABASE_PATH",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "data",
+        "antena.db",
+    ),
+)
+
+# SQLite settings applied to every connection of the app database
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+# Milliseconds a connection waits for another one's write lock
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+# Connections kept open per web worker, and extra ones opened under load
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "5"))
+SQLITE_POOL_OVERFLOW = int(os.environ.get("SQLITE_POOL_OVERFLOW", "10"))
+
 db = SQLAlchemy()
 
 
+def engine_options(path=None):
+    """SQLALCHEMY_ENGINE_OPTIONS for the SQLite database at `path`.
+
+    An in-memory database lives in a single connection, so it gets no pool
+    settings.
+    """
+    if (path or DATABASE_PATH) == ":memory:":
+        return {}
+    return {
+        "pool_size": SQLITE_POOL_SIZE,
+        "max_overflow": SQLITE_POOL_OVERFLOW,
+        # Seconds a request waits for a pooled connection
+        "pool_timeout": 30,
+        "connect_args": {"timeout": SQLITE_BUSY_TIMEOUT / 1000},
+    }
+
+
+def configure_sqlite(engine):
+    """Apply the SQLITE_* settings to every new connection of `engine`.
+
+    WAL lets readers proceed while another connection writes, and with
+    synchronous=NORMAL a commit no longer waits for an fsync (only
+    checkpoints do), at the cost of the last commits on power loss.
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT:d}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE:d}")
+        finally:
+            cursor.close()
+
+
 class User(db.Model):
     """User model for authentication."""
 
@@ -24,12 +85,18 @@ class Broker(db.Model):
     """MQTT Broker configuration model."""
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
     name = db.Column(db.String(100), nullable=False)
     ip = db.Column(db.String(100), nullable=False)
     port = db.Column(db.Integer, nullable=False, default=1883)
     username = db.Column(db.String(100), nullable=True)
     password = db.Column(db.String(100), nullable=True)
+    # Connect to this broker when the app starts
+    auto_connect = db.Column(
+        db.Boolean, nullable=False, default=False, server_default="0"
+    )
 
     user = db.relationship("User", backref=db.backref("brokers", lazy=True))
 
@@ -42,4 +109,38 @@ class Broker(db.Model):
             "port": self.port,
             "username": self.username,
             "password": self.password,
+            "auto_connect": self.auto_connect,
         }
+
+
+def add_missing_columns():
+    """Add columns introduced since a database was created.
+
+    db.create_all() only creates missing tables, so columns added to an
+    existing model are appended here with ALTER TABLE. Such columns must be
+    nullable or have a server default.
+    """
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+
+
+def add_missing_indexes():
+    """Create indexes introduced since a database was created."""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
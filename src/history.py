@@ -0,0 +1,469 @@
+import atexit
+import heapq
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import messages
+import topics
+
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED") == "1"
+# Length of a segment file; retention deletes whole segments
+HISTORY_SEGMENT_SECONDS = int(os.environ.get("HISTORY_SEGMENT_SECONDS", "3600"))
+# Segments older than this many seconds are deleted (0 = keep forever)
+HISTORY_MAX_AGE = int(os.environ.get("HISTORY_MAX_AGE", str(7 * 24 * 3600)))
+# Oldest segments are deleted while the store is larger than this (0 = no limit)
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", str(1024**3)))
+# Seconds between batched writes
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.25"))
+# Messages buffered for the writer before the oldest are dropped
+HISTORY_MAX_BACKLOG = int(os.environ.get("HISTORY_MAX_BACKLOG", "200000"))
+
+RETENTION_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    broker_id INTEGER NOT NULL,
+    topic TEXT NOT NULL,
+    payload BLOB,
+    qos INTEGER NOT NULL DEFAULT 0,
+    retain INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_messages_broker_topic_ts
+    ON messages (broker_id, topic, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_broker_ts
+    ON messages (broker_id, ts);
+CREATE TABLE IF NOT EXISTS topics (
+    broker_id INTEGER NOT NULL,
+    topic TEXT NOT NULL,
+    PRIMARY KEY (broker_id, topic)
+) WITHOUT ROWID;
+"""
+
+INSERT = (
+    "INSERT INTO messages (ts, broker_id, topic, payload, qos, retain) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+INSERT_TOPIC = "INSERT OR IGNORE INTO topics (broker_id, topic) VALUES (?, ?)"
+
+# Wildcard queries expand to at most this many exact (broker_id, topic) lookups
+MAX_TOPIC_LOOKUPS = 500
+# Up to this many (broker_id, topic) index ranges are merged in (ts, id) order;
+# beyond it, or without a topic list, each broker's time range is scanned
+MAX_MERGED_RANGES = 32
+
+SELECT = (
+    "SELECT id, ts, broker_id, topic, payload, qos, retain "
+    "FROM messages WHERE broker_id = ?"
+)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".db"
+
+
+def connect_segment(path):
+    """Open a segment database with the pragmas used for append-only writes."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def open_segment_readonly(path):
+    """Open a segment for queries without interfering with the writer."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    conn.create_function("topic_matches", 2, topics.matches, deterministic=True)
+    return conn
+
+
+def topic_clause(topic_filter, column="topic"):
+    """Translate an MQTT filter into a SQL condition that can use the topic index.
+
+    The wildcard-free leading levels become a range scan on `topic`; a `+`
+    after them is checked with the `topic_matches` SQL function. With
+    `column="+topic"` the condition only filters rows and no index on the
+    topic is used for it.
+    """
+    if not topic_filter:
+        return "", []
+    prefix, wildcard = topics.literal_prefix(topic_filter)
+    if wildcard is None:
+        return f" AND {column} = ?", [topic_filter]
+    if not prefix:
+        if wildcard == "#":
+            return "", []
+        return f" AND topic_matches(?, {column})", [topic_filter]
+
+    # Every topic below "prefix/" sorts between "prefix/" and "prefix0"
+    lower, upper = prefix + "/", prefix + "0"
+    if wildcard == "#" and topic_filter == prefix + "/#":
+        # "a/#" also matches the parent topic "a"
+        return (
+            f" AND ({column} = ? OR ({column} >= ? AND {column} < ?))",
+            [prefix, lower, upper],
+        )
+    return (
+        f" AND {column} >= ? AND {column} < ? AND topic_matches(?, {column})",
+        [lower, upper, topic_filter],
+    )
+
+
+def encode_cursor(segment_start, ts, row_id):
+    """Build the opaque keyset cursor pointing after a row."""
+    return f"{segment_start}:{ts!r}:{row_id}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor built by encode_cursor, raising ValueError if malformed."""
+    segment_start, ts, row_id = cursor.split(":")
+    return int(segment_start), float(ts), int(row_id)
+
+
+def payload_json(payload):
+    """Return the JSON fields representing a stored payload, never truncated."""
+    return messages.payload_fields(payload, limit=None)
+
+
+class HistoryStore:
+    """Append-only message history split into time-partitioned SQLite segments.
+
+    The MQTT callback thread only appends a tuple to an in-memory backlog; a
+    background writer drains it in batches into `segment-<start>.db` files,
+    one per `segment_seconds` window, each in WAL mode. Retention removes whole
+    segment files by age and by total size. When the writer falls behind the
+    oldest buffered messages are dropped instead of blocking the MQTT loop.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_seconds=HISTORY_SEGMENT_SECONDS,
+        max_age=HISTORY_MAX_AGE,
+        max_bytes=HISTORY_MAX_BYTES,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        max_backlog=HISTORY_MAX_BACKLOG,
+    ):
+        """Initialize a HistoryStore instance."""
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._backlog = deque(maxlen=max_backlog)
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._current_start = None
+        self._current = None
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, broker_id, topic, payload, qos=0, retain=False, ts=None):
+        """Queue a received message for persistence. Safe to call from any thread."""
+        backlog = self._backlog
+        if len(backlog) == backlog.maxlen:
+            self.dropped += 1
+        backlog.append(
+            (time.time() if ts is None else ts, broker_id, topic, payload, qos, retain)
+        )
+
+    def start(self):
+        """Start the background writer thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="history-writer", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stop the writer, flushing whatever is still buffered."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._flush_lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
+                self._current_start = None
+
+    def _run(self):
+        next_retention = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() >= next_retention:
+                self.enforce_retention()
+                next_retention = time.monotonic() + RETENTION_INTERVAL
+
+    def segment_start(self, ts):
+        """Return the start of the segment window containing `ts`."""
+        return int(ts // self.segment_seconds) * self.segment_seconds
+
+    def segment_path(self, start):
+        """Return the file path of the segment starting at `start`."""
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{start}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """Return `(start, path)` for every segment on disk, oldest first."""
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                start = name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]
+                if start.isdigit():
+                    found.append((int(start), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def flush(self):
+        """Write every buffered message to its segment in one transaction each."""
+        with self._flush_lock:
+            backlog = self._backlog
+            rows = []
+            while backlog:
+                rows.append(backlog.popleft())
+            if not rows:
+                return 0
+
+            groups = {}
+            for row in rows:
+                groups.setdefault(self.segment_start(row[0]), []).append(row)
+
+            for start in sorted(groups):
+                conn = self._segment(start)
+                segment_rows = groups[start]
+                with conn:
+                    conn.executemany(INSERT, segment_rows)
+                    conn.executemany(
+                        INSERT_TOPIC, {(row[1], row[2]) for row in segment_rows}
+                    )
+                if conn is not self._current:
+                    conn.close()
+            self.written += len(rows)
+            return len(rows)
+
+    def _segment(self, start):
+        """Return a connection to the segment starting at `start`.
+
+        The newest segment stays open; late messages for an older window get a
+        short-lived connection.
+        """
+        if start == self._current_start:
+            return self._current
+        conn = connect_segment(self.segment_path(start))
+        if self._current_start is None or start > self._current_start:
+            if self._current is not None:
+                self._current.close()
+            self._current, self._current_start = conn, start
+        return conn
+
+    def iter_query(
+        self, broker_ids, topic_filter=None, start=None, end=None, cursor=None
+    ):
+        """Yield stored messages matching the filters in (ts, id) order.
+
+        Only segments overlapping [start, end) are opened. Within a segment the
+        filter is expanded to the exact topics seen in it. A few of them are
+        read as (broker_id, topic, ts) index ranges merged in order; many
+        topics, broad filters and time-only queries walk the (broker_id, ts)
+        index of each broker. Either way rows come out already ordered, so a
+        page stops reading once it is full and nothing is sorted. A cursor
+        resumes with a keyset condition instead of an OFFSET.
+        """
+        if not broker_ids:
+            return
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        after = decode_cursor(cursor) if cursor else None
+
+        segments = self.segments()
+        for i, (seg_start, path) in enumerate(segments):
+            seg_end = segments[i + 1][0] if i + 1 < len(segments) else float("inf")
+            if seg_start >= end or seg_end <= start:
+                continue
+            if after and seg_start < after[0]:
+                continue
+
+            try:
+                conn = open_segment_readonly(path)
+            except sqlite3.OperationalError:
+                # Segment removed by retention while we were iterating
+                continue
+            try:
+                ranges = _segment_ranges(conn, broker_ids, topic_filter)
+                time_sql = " AND ts >= ? AND ts < ?"
+                time_args = [start, end]
+                if after and seg_start == after[0]:
+                    time_sql += " AND ts >= ? AND (ts > ? OR id > ?)"
+                    time_args += [after[1], after[1], after[2]]
+                cursors = [
+                    conn.execute(
+                        f"{SELECT}{where}{time_sql} ORDER BY ts, id",
+                        [broker_id, *params, *time_args],
+                    )
+                    for broker_id, where, params in ranges
+                ]
+                if len(cursors) == 1:
+                    rows = cursors[0]
+                else:
+                    rows = heapq.merge(*cursors, key=_row_order)
+                for row in rows:
+                    yield seg_start, row
+            finally:
+                conn.close()
+
+    def query(
+        self,
+        broker_ids,
+        topic_filter=None,
+        start=None,
+        end=None,
+        limit=100,
+        cursor=None,
+    ):
+        """Return one page of matching messages and the cursor of the next page."""
+        page = []
+        next_cursor = None
+        for seg_start, row in self.iter_query(
+            broker_ids, topic_filter, start, end, cursor
+        ):
+            if len(page) == limit:
+                last_seg, last = page[-1]
+                next_cursor = encode_cursor(last_seg, last[1], last[0])
+                break
+            page.append((seg_start, row))
+        return [message_dict(row) for _, row in page], next_cursor
+
+    def enforce_retention(self, now=None):
+        """Delete segments past the age limit, then the oldest over the size limit."""
+        now = time.time() if now is None else now
+        with self._flush_lock:
+            segments = [s for s in self.segments() if s[0] != self._current_start]
+            removed = []
+            if self.max_age:
+                for start, path in segments:
+                    if start + self.segment_seconds <= now - self.max_age:
+                        removed.append(path)
+            if self.max_bytes:
+                kept = [s for s in segments if s[1] not in removed]
+                total = sum(_segment_size(p) for _, p in self.segments())
+                total -= sum(_segment_size(p) for p in removed)
+                for _, path in kept:
+                    if total <= self.max_bytes:
+                        break
+                    total -= _segment_size(path)
+                    removed.append(path)
+            for path in removed:
+                for suffix in ("", "-wal", "-shm"):
+                    try:
+                        os.remove(path + suffix)
+                    except FileNotFoundError:
+                        pass
+            return len(removed)
+
+
+def _row_order(row):
+    """Sort key of a stored row: (ts, id)."""
+    return row[1], row[0]
+
+
+def _segment_ranges(conn, broker_ids, topic_filter):
+    """Return the `(broker_id, condition, params)` ranges to read in one segment.
+
+    Each range yields its rows in (ts, id) order. Wildcard filters are
+    resolved against the segment's topics table; an empty list means that
+    nothing in the segment matches.
+    """
+    where, params = topic_clause(topic_filter)
+    names = None
+    if topic_filter and topics.literal_prefix(topic_filter)[1] is None:
+        names = {broker_id: [topic_filter] for broker_id in broker_ids}
+    elif where:
+        placeholders = ",".join("?" * len(broker_ids))
+        try:
+            found = conn.execute(
+                "SELECT broker_id, topic FROM topics "
+                f"WHERE broker_id IN ({placeholders}){where}",
+                [*broker_ids, *params],
+            ).fetchall()
+        except sqlite3.OperationalError:
+            # Segment written before the topics table existed
+            found = None
+        if found is not None and len(found) <= MAX_TOPIC_LOOKUPS:
+            names = {}
+            for broker_id, topic in found:
+                names.setdefault(broker_id, []).append(topic)
+
+    if names is not None and sum(map(len, names.values())) <= MAX_MERGED_RANGES:
+        return [
+            (broker_id, " AND topic = ?", [topic])
+            for broker_id, broker_topics in names.items()
+            for topic in broker_topics
+        ]
+    # "+topic" keeps the planner on the (broker_id, ts) index
+    if names is not None:
+        return [
+            (
+                broker_id,
+                f" AND +topic IN ({','.join('?' * len(broker_topics))})",
+                broker_topics,
+            )
+            for broker_id, broker_topics in names.items()
+        ]
+    where, params = topic_clause(topic_filter, column="+topic")
+    return [(broker_id, where, params) for broker_id in broker_ids]
+
+
+def _segment_size(path):
+    """Size in bytes of a segment including its WAL file."""
+    size = 0
+    for suffix in ("", "-wal"):
+        try:
+            size += os.path.getsize(path + suffix)
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def message_dict(row):
+    """Convert a stored row into the JSON representation used by the API."""
+    row_id, ts, broker_id, topic, payload, qos, retain = row
+    return {
+        "id": row_id,
+        "ts": ts,
+        "broker_id": broker_id,
+        "topic": topic,
+        **payload_json(payload),
+        "qos": qos,
+        "retain": bool(retain),
+    }
+
+
+store = None
+
+
+def init_history(data_dir, start_writer=True):
+    """Create the history store if HISTORY_ENABLED is set.
+
+    Web workers fed by a separate ingestion process only query the store and
+    leave writing to that process (`start_writer=False`).
+    """
+    global store
+    if HISTORY_ENABLED and store is None:
+        store = HistoryStore(os.path.join(data_dir, "history"))
+        if start_writer:
+            store.start()
+            atexit.register(store.stop)
+    return store
+
+
+def record(broker_id, topic, payload, qos=0, retain=False, ts=None):
+    """Persist a received message when history is enabled."""
+    if store is not None:
+        store.record(broker_id, topic, payload, qos, retain, ts)
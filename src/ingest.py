@@ -0,0 +1,661 @@
+"""Standalone MQTT ingestion process.
+
+Running `python src/ingest.py` moves every broker connection out of the web
+worker. The ingestion process owns the paho clients and serves two kinds of
+connections on a local Unix socket, both speaking newline-delimited JSON:
+
+- control: one request/response per line (connect, disconnect, status,
+  subscriptions, publish, replay, user_clients);
+- feed: every received message pushed as `<user_id> <message JSON>`, the
+  JSON being the one sent to browsers so the web side does not re-encode it.
+
+Web workers started with INGEST_SOCKET set use IngestClient instead of the
+in-process client registry.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import history
+import loadgen
+import logs
+import metrics
+import mqtt_manager
+import topics
+from database import DATABASE_PATH
+from messages import Message, message_json
+
+log = logs.get_logger("ingest")
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"
+)
+
+# Path of the ingestion socket; setting it switches the web app to remote mode
+INGEST_SOCKET = os.environ.get("INGEST_SOCKET")
+# Messages buffered per web worker feed before the oldest are dropped
+FEED_BACKLOG = int(os.environ.get("FEED_BACKLOG", "10000"))
+
+RECONNECT_DELAY = 1
+
+
+def client_state(client):
+    """Serializable view of an ActiveClient."""
+    return {
+        "broker_id": client.broker_id,
+        "user_id": client.user_id,
+        "name": client.name,
+        "is_connected": client.is_connected,
+        "connection_error": client.connection_error,
+        "subscriptions": client.subscriptions,
+    }
+
+
+class _Feed:
+    """Buffered writer pushing messages to one web worker."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Users the worker has listeners for; None forwards everything
+        self.users = None
+        self.dropped = 0
+        self._backlog = deque(maxlen=FEED_BACKLOG)
+        self._ready = threading.Event()
+        self.closed = False
+
+    def push(self, line):
+        if len(self._backlog) == self._backlog.maxlen:
+            self.dropped += 1
+        self._backlog.append(line)
+        self._ready.set()
+
+    def run(self):
+        """Write buffered lines in batches until the worker goes away."""
+        try:
+            while True:
+                self._ready.wait()
+                self._ready.clear()
+                lines = []
+                while self._backlog:
+                    lines.append(self._backlog.popleft())
+                if lines:
+                    self.conn.sendall(b"".join(lines))
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.conn.close()
+
+
+class IngestServer:
+    """Serves the control and feed channels of the ingestion process."""
+
+    def __init__(self, path):
+        """Initialize an IngestServer instance."""
+        self.path = path
+        self._feeds = ()
+        self._feeds_lock = threading.Lock()
+        self._sock = None
+        self._closing = False
+
+    def forward(self, user_id, message_data):
+        """Message sink queueing a received message for every web worker."""
+        line = None
+        for feed in self._feeds:
+            if feed.users is not None and user_id not in feed.users:
+                continue
+            if line is None:
+                line = b"%d %s\n" % (user_id, message_json(message_data))
+            feed.push(line)
+
+    def serve_forever(self):
+        """Accept control and feed connections until the process exits."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        mqtt_manager.message_sinks.append(self.forward)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen()
+        log.info("Ingestion listening on %s", self.path)
+        try:
+            while True:
+                try:
+                    conn, _ = self._sock.accept()
+                except OSError:
+                    if self._closing:
+                        return
+                    raise
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            mqtt_manager.message_sinks.remove(self.forward)
+            self._sock.close()
+
+    def close(self):
+        """Stop accepting connections."""
+        self._closing = True
+        if self._sock is not None:
+            # Wake the accept loop, which then closes the socket itself
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for feed in self._feeds:
+            try:
+                feed.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _handle(self, conn):
+        reader = conn.makefile("rb")
+        hello = json.loads(reader.readline() or b"{}")
+        if hello.get("role") == "feed":
+            feed = _Feed(conn)
+            with self._feeds_lock:
+                self._feeds = self._feeds + (feed,)
+            threading.Thread(target=feed.run, daemon=True).start()
+            try:
+                # The worker announces the users it streams to, so their
+                # messages are the only ones sent its way
+                for line in reader:
+                    feed.users = set(json.loads(line)["users"])
+            except (OSError, ValueError):
+                pass
+            finally:
+                conn.close()
+                with self._feeds_lock:
+                    self._feeds = tuple(f for f in self._feeds if f is not feed)
+            return
+
+        try:
+            for line in reader:
+                try:
+                    response = self.dispatch(json.loads(line))
+                except Exception as e:
+                    log.warning("Control request failed: %s", e)
+                    response = {"error": str(e)}
+                conn.sendall((json.dumps(response) + "\n").encode())
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def dispatch(self, request):
+        """Execute one control request and return its JSON response."""
+        op = request["op"]
+        if op == "connect":
+            broker = SimpleNamespace(**request["broker"])
+            client = mqtt_manager.add_client(broker)
+            success, error = client.connect(wait=request.get("wait"))
+            return {"ok": success, "error": error}
+        if op == "disconnect":
+            mqtt_manager.remove_client(request["broker_id"])
+            return {"ok": True}
+        if op == "status":
+            client = mqtt_manager.get_client(request["broker_id"])
+            return {"client": client_state(client) if client else None}
+        if op == "user_clients":
+            owned = mqtt_manager.connected_clients.for_user(request["user_id"])
+            return {"clients": [client_state(client) for client in owned]}
+        if op == "set_subscriptions":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            client.set_subscriptions(request["subscriptions"])
+            return {"ok": True}
+        if op == "publish":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            record = client.publish(
+                request["topic"],
+                request["payload"],
+                qos=request.get("qos", 0),
+                retain=request.get("retain", False),
+            )
+            return {"ok": True, "publish": record.to_dict()}
+        if op == "publish_status":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            status = client.publish_status(
+                request["publish_id"], wait=request.get("wait", 0)
+            )
+            return {"publish": status}
+        if op == "publishes":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            return {"publishes": client.publish_summary()}
+        if op == "publish_many":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            return client.publish_many(request["messages"])
+        if op == "load_start":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            try:
+                return {"ok": True, "job": client.start_load(request["params"])}
+            except ValueError as e:
+                return {"ok": False, "error": str(e)}
+        if op in ("load_status", "load_stop"):
+            get = loadgen.get_job if op == "load_status" else loadgen.stop_job
+            job = get(request["job_id"])
+            return {"job": job.status() if job else None}
+        if op == "replay":
+            replay = mqtt_manager.replay_messages(
+                request["user_id"],
+                request.get("after_id"),
+                request.get("limit", mqtt_manager.REPLAY_ON_CONNECT),
+                request.get("topic_filters", ()),
+                request.get("broker_ids"),
+            )
+            return {"messages": [msg.to_wire() for msg in replay]}
+        if op == "topic_tree":
+            client = mqtt_manager.get_client(request["broker_id"])
+            if client is None:
+                return {"error": "Broker not connected"}
+            return {"node": client.topic_tree(request.get("path"))}
+        if op == "metrics":
+            clients = list(mqtt_manager.connected_clients.values())
+            return {"text": metrics.render_brokers(clients)}
+        raise ValueError(f"Unknown operation: {op}")
+
+
+class RemoteClient:
+    """Web-side stand-in for an ActiveClient living in the ingestion process."""
+
+    def __init__(self, ingest, state):
+        """Initialize a RemoteClient from its serialized state."""
+        self._ingest = ingest
+        self._broker = state.pop("broker", None)
+        self.broker_id = state["broker_id"]
+        self.user_id = state["user_id"]
+        self.name = state["name"]
+        self.is_connected = state.get("is_connected", False)
+        self.connection_error = state.get("connection_error")
+        self.subscriptions = state.get("subscriptions", {})
+
+    @property
+    def subscribed_topics(self):
+        """Set of the topic filters currently subscribed."""
+        return set(self.subscriptions)
+
+    def connect(self, wait=None):
+        """Ask the ingestion process to start connecting to the broker.
+
+        Never waits for the first attempt, whatever `wait` says: the control
+        socket is shared by every request of this worker, and one
+        unreachable broker would hold all of them. The outcome shows up in
+        the client's status (see ActiveClient.connect).
+        """
+        try:
+            response = self._ingest.request(
+                {"op": "connect", "broker": self._broker, "wait": 0}
+            )
+        except OSError as e:
+            self.connection_error = str(e)
+            return False, str(e)
+        if not response["ok"]:
+            self.connection_error = response["error"]
+        return response["ok"], response["error"]
+
+    def set_subscriptions(self, subscriptions):
+        """Replace the broker's subscriptions in the ingestion process."""
+        for topic_filter in subscriptions:
+            topics.validate_filter(topic_filter)
+        self._ingest.request(
+            {
+                "op": "set_subscriptions",
+                "broker_id": self.broker_id,
+                "subscriptions": subscriptions,
+            }
+        )
+        self.subscriptions = dict(subscriptions)
+
+    def add_subscription(self, topic, qos=0):
+        """Subscribe to one more topic filter (empty means all topics)."""
+        self.set_subscriptions({**self.subscriptions, (topic or "#"): qos})
+
+    def remove_subscription(self, topic):
+        """Unsubscribe from a single topic filter."""
+        remaining = dict(self.subscriptions)
+        remaining.pop(topic, None)
+        self.set_subscriptions(remaining)
+
+    def update_subscription(self, topic, qos=0):
+        """Replace every subscription of this client with a single topic."""
+        self.set_subscriptions({(topic or "#"): qos})
+
+    def clear_subscription(self):
+        """Unsubscribe from all topics."""
+        self.set_subscriptions({})
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Publish a message through the ingestion process.
+
+        Returns the publish status (see publish_tracker) as attributes.
+        """
+        response = self._ingest.request(
+            {
+                "op": "publish",
+                "broker_id": self.broker_id,
+                "topic": topic,
+                "payload": payload,
+                "qos": qos,
+                "retain": retain,
+            }
+        )
+        return SimpleNamespace(**response["publish"])
+
+    def publish_status(self, publish_id, wait=0):
+        """Status of a pending or recent publish, or None if unknown.
+
+        The ingestion process waits up to `wait` seconds for a pending
+        publish to complete, on a connection of its own.
+        """
+        response = self._ingest.request(
+            {
+                "op": "publish_status",
+                "broker_id": self.broker_id,
+                "publish_id": publish_id,
+                "wait": wait,
+            },
+            blocking=bool(wait),
+        )
+        return response["publish"]
+
+    def publish_summary(self):
+        """In-flight window, completion counts and latencies of publishes."""
+        response = self._ingest.request(
+            {"op": "publishes", "broker_id": self.broker_id}
+        )
+        return response["publishes"]
+
+    def publish_many(self, messages):
+        """Publish bulk messages through the ingestion process."""
+        return self._ingest.request(
+            {"op": "publish_many", "broker_id": self.broker_id, "messages": messages}
+        )
+
+    def start_load(self, params):
+        """Start a load job in the ingestion process and return its status."""
+        response = self._ingest.request(
+            {"op": "load_start", "broker_id": self.broker_id, "params": params}
+        )
+        if not response["ok"]:
+            raise ValueError(response["error"])
+        return response["job"]
+
+    def topic_tree(self, path=None):
+        """The broker's topic tree node at `path`, from the ingestion process."""
+        response = self._ingest.request(
+            {"op": "topic_tree", "broker_id": self.broker_id, "path": path}
+        )
+        return response["node"]
+
+
+class IngestClient:
+    """Connection of a web worker to the ingestion process.
+
+    Control requests share one socket guarded by a lock (blocking ones open
+    their own); a background thread
+    reads the message feed and fans it out to this worker's SSE listeners.
+    Any number of web workers can connect, which makes this the registry
+    backend for multi-worker deployments (see registry.py).
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        """Initialize an IngestClient instance."""
+        self.path = path
+        self._control = None
+        self._reader = None
+        self._lock = threading.Lock()
+        self._feed_thread = None
+        self._feed_sock = None
+        self._feed_lock = threading.Lock()
+        self._closing = False
+
+    def _connect(self, role):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall((json.dumps({"role": role}) + "\n").encode())
+        return sock
+
+    def request(self, payload, blocking=False):
+        """Send a control request and wait for its response.
+
+        A `blocking` request, one the ingestion process may take seconds to
+        answer, gets a connection of its own instead of holding up the
+        shared one.
+        """
+        if blocking:
+            with self._connect("control") as sock, sock.makefile("rb") as reader:
+                sock.sendall((json.dumps(payload) + "\n").encode())
+                line = reader.readline()
+            if not line:
+                raise ConnectionError("Ingestion process closed the connection")
+            return self._response(line)
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._control is None:
+                        self._control = self._connect("control")
+                        self._reader = self._control.makefile("rb")
+                    self._control.sendall((json.dumps(payload) + "\n").encode())
+                    line = self._reader.readline()
+                    if not line:
+                        raise ConnectionError("Ingestion process closed the connection")
+                    break
+                except OSError:
+                    # Reconnect once: the ingestion process may have restarted
+                    if self._control is not None:
+                        self._control.close()
+                    self._control = self._reader = None
+                    if attempt:
+                        raise
+        return self._response(line)
+
+    def _response(self, line):
+        response = json.loads(line)
+        if "error" in response and "ok" not in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def start(self):
+        """Receive the messages of the users streaming from this worker."""
+        mqtt_manager.listeners.watchers.append(self.announce_users)
+        self.start_feed()
+
+    def announce_users(self):
+        """Tell the ingestion process which users this worker streams to."""
+        with self._feed_lock:
+            sock = self._feed_sock
+            if sock is None:
+                return
+            line = json.dumps({"users": sorted(mqtt_manager.listeners.users())})
+            try:
+                sock.sendall((line + "\n").encode())
+            except OSError:
+                pass
+
+    def start_feed(self):
+        """Start forwarding ingested messages to the local listeners."""
+        if self._feed_thread is None:
+            self._feed_thread = threading.Thread(
+                target=self._run_feed, name="ingest-feed", daemon=True
+            )
+            self._feed_thread.start()
+
+    def _run_feed(self):
+        while not self._closing:
+            try:
+                sock = self._connect("feed")
+                with self._feed_lock:
+                    self._feed_sock = sock
+                if self.announce_users in mqtt_manager.listeners.watchers:
+                    self.announce_users()
+                for line in sock.makefile("rb"):
+                    user_id, encoded = line.rstrip(b"\n").split(b" ", 1)
+                    message = Message.from_wire(json.loads(encoded), encoded)
+                    mqtt_manager.broadcast_message(int(user_id), message)
+            except OSError:
+                pass
+            if not self._closing:
+                time.sleep(RECONNECT_DELAY)
+
+    def close(self):
+        """Stop the feed and drop the connections to the ingestion process."""
+        self._closing = True
+        if self.announce_users in mqtt_manager.listeners.watchers:
+            mqtt_manager.listeners.watchers.remove(self.announce_users)
+        for sock in (self._feed_sock, self._control):
+            if sock is not None:
+                # shutdown() wakes a thread blocked reading the socket
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+        if self._feed_thread is not None:
+            self._feed_thread.join(timeout=RECONNECT_DELAY + 1)
+
+    def get_client(self, broker_id):
+        """Retrieve the state of a broker connection, or None if not connected."""
+        try:
+            state = self.request({"op": "status", "broker_id": int(broker_id)})
+        except OSError:
+            return None
+        return RemoteClient(self, state["client"]) if state["client"] else None
+
+    def user_clients(self, user_id):
+        """States of a user's broker connections, by broker ID, in one request."""
+        try:
+            response = self.request({"op": "user_clients", "user_id": user_id})
+        except OSError:
+            return {}
+        return {
+            state["broker_id"]: RemoteClient(self, state)
+            for state in response["clients"]
+        }
+
+    def add_client(self, broker_obj):
+        """Prepare a connection to a broker; it is opened by connect()."""
+        broker = {
+            "id": broker_obj.id,
+            "user_id": broker_obj.user_id,
+            "name": broker_obj.name,
+            "ip": broker_obj.ip,
+            "port": broker_obj.port,
+            "username": broker_obj.username,
+            "password": broker_obj.password,
+        }
+        return RemoteClient(
+            self,
+            {
+                "broker": broker,
+                "broker_id": broker_obj.id,
+                "user_id": broker_obj.user_id,
+                "name": broker_obj.name,
+            },
+        )
+
+    def remove_client(self, broker_id):
+        """Disconnect a broker in the ingestion process."""
+        try:
+            self.request({"op": "disconnect", "broker_id": broker_id})
+        except OSError:
+            pass
+
+    def replay_messages(
+        self,
+        user_id,
+        after_id=None,
+        limit=mqtt_manager.REPLAY_ON_CONNECT,
+        topic_filters=(),
+        broker_ids=None,
+    ):
+        """Fetch buffered messages for a (re)connecting stream."""
+        try:
+            response = self.request(
+                {
+                    "op": "replay",
+                    "user_id": user_id,
+                    "after_id": after_id,
+                    "limit": limit,
+                    "topic_filters": list(topic_filters),
+                    "broker_ids": list(broker_ids) if broker_ids else None,
+                }
+            )
+        except OSError:
+            return []
+        return [Message.from_wire(fields) for fields in response["messages"]]
+
+    def load_job(self, job_id, stop=False):
+        """Status of a load job in the ingestion process, or None if unknown.
+
+        With `stop` the job is asked to stop first.
+        """
+        op = "load_stop" if stop else "load_status"
+        try:
+            return self.request({"op": op, "job_id": job_id})["job"]
+        except OSError:
+            return None
+
+    def broker_metrics(self):
+        """Broker metrics of the ingestion process, in the Prometheus format."""
+        try:
+            return self.request({"op": "metrics"})["text"]
+        except OSError:
+            return ""
+
+
+def auto_connect_brokers(db_path=DATABASE_PATH):
+    """Connect the brokers flagged auto_connect in the app database.
+
+    The ingestion process has no Flask app, so the broker table is read
+    directly. A database the web app has not created or upgraded yet has
+    nothing to connect.
+    """
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            "SELECT id, user_id, name, ip, port, username, password"
+            " FROM broker WHERE auto_connect"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+    for row in rows:
+        mqtt_manager.add_client(SimpleNamespace(**dict(row))).connect(wait=0)
+    if rows:
+        log.info("Auto-connecting %d brokers", len(rows))
+    return len(rows)
+
+
+def main():
+    """Run the ingestion process in the foreground."""
+    logs.setup()
+    path = INGEST_SOCKET or os.path.join(DATA_DIR, "ingest.sock")
+    os.makedirs(DATA_DIR, exist_ok=True)
+    history.init_history(DATA_DIR)
+    server = IngestServer(path)
+    auto_connect_brokers()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
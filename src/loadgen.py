@@ -0,0 +1,389 @@
+"""Bulk publishing and the load generator.
+
+Bulk requests carry many messages, each a JSON object with a `topic`, a
+`payload` (a string is sent as is, any other JSON value as its JSON text;
+`payload_base64` gives raw bytes), and optional `qos` and `retain`.
+
+A load job publishes to one broker at a target rate for a duration, from
+topic and payload templates. It runs in a background thread in the process
+holding the broker connection and paces itself against an absolute
+schedule, so a slow publish is caught up rather than lowering the rate.
+Completion of every publish is followed through the client's publish
+tracker (see publish_tracker) to count acknowledgements and sample the
+completion latency of each QoS level.
+
+Template placeholders: `{n}` message number, `{ts}` epoch seconds,
+`{rand}` random float in [0, 1), `{randint:LO:HI}` random integer,
+`{uuid}` random UUID. `{{` and `}}` are literal braces.
+"""
+
+import base64
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import logs
+
+log = logs.get_logger("loadgen")
+
+# Maximum messages accepted by one bulk publish request
+BULK_PUBLISH_MAX = int(os.environ.get("BULK_PUBLISH_MAX", "10000"))
+# Upper limits of a load job
+LOADGEN_MAX_RATE = float(os.environ.get("LOADGEN_MAX_RATE", "10000"))
+LOADGEN_MAX_DURATION = float(os.environ.get("LOADGEN_MAX_DURATION", "3600"))
+
+# Seconds a finished job waits for its outstanding acknowledgements
+ACK_TIMEOUT = 5
+# Completion latencies kept per QoS level for the percentiles
+LATENCY_SAMPLES = 10000
+# Finished jobs kept for their status
+MAX_FINISHED_JOBS = 20
+
+_PLACEHOLDER = re.compile(r"\{\{|\}\}|\{(\w+)(?::([^}]*))?\}")
+
+
+def parse_message(fields):
+    """Validate one bulk message, returning `(topic, payload, qos, retain)`."""
+    if not isinstance(fields, dict):
+        raise ValueError("Message must be a JSON object")
+    topic = fields.get("topic")
+    if not topic or not isinstance(topic, str) or "+" in topic or "#" in topic:
+        raise ValueError("Message needs a topic without wildcards")
+    if "payload_base64" in fields:
+        payload = base64.b64decode(fields["payload_base64"], validate=True)
+    else:
+        payload = fields.get("payload", "")
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+    qos = fields.get("qos", 0)
+    if qos not in (0, 1, 2):
+        raise ValueError("qos must be 0, 1 or 2")
+    return topic, payload, qos, bool(fields.get("retain", False))
+
+
+def publish_many(client, messages):
+    """Publish bulk messages through an ActiveClient.
+
+    Returns the number published and `{"index", "error"}` for each message
+    that was rejected.
+    """
+    published = 0
+    errors = []
+    for i, fields in enumerate(messages):
+        try:
+            topic, payload, qos, retain = parse_message(fields)
+        except (ValueError, TypeError) as e:
+            errors.append({"index": i, "error": str(e)})
+            continue
+        record = client.publish(topic, payload, qos=qos, retain=retain)
+        if record.rc:
+            errors.append({"index": i, "error": f"Publish failed, rc {record.rc}"})
+        else:
+            published += 1
+    return {"published": published, "errors": errors}
+
+
+class Template:
+    """A topic or payload template, parsed once and rendered per message."""
+
+    def __init__(self, text):
+        """Parse `text`; raises ValueError on an unknown placeholder."""
+        self.parts = []
+        pos = 0
+        for match in _PLACEHOLDER.finditer(text):
+            self.parts.append(text[pos : match.start()])
+            pos = match.end()
+            token = match.group(0)
+            if token in ("{{", "}}"):
+                self.parts.append(token[0])
+            else:
+                self.parts.append(self._field(match.group(1), match.group(2)))
+        self.parts.append(text[pos:])
+        self.parts = [p for p in self.parts if p != ""]
+
+    @staticmethod
+    def _field(name, arg):
+        if name == "n":
+            return str
+        if name == "ts":
+            return lambda n: f"{time.time():.3f}"
+        if name == "rand":
+            return lambda n: f"{random.random():.6f}"
+        if name == "uuid":
+            return lambda n: str(uuid.uuid4())
+        if name == "randint":
+            try:
+                low, high = (int(v) for v in (arg or "").split(":"))
+            except ValueError:
+                raise ValueError("randint needs bounds, e.g. {randint:0:100}")
+            if low > high:
+                raise ValueError(f"randint bounds out of order: {{randint:{arg}}}")
+            return lambda n: str(random.randint(low, high))
+        raise ValueError(f"Unknown template field: {{{name}}}")
+
+    def render(self, n):
+        """Return the text for message number `n`."""
+        return "".join(p if isinstance(p, str) else p(n) for p in self.parts)
+
+
+class LatencySample:
+    """Bounded uniform sample of latencies (reservoir sampling), in ms."""
+
+    def __init__(self, size=LATENCY_SAMPLES):
+        """Initialize an empty sample holding at most `size` values."""
+        self.size = size
+        self.seen = 0
+        self.values = []
+
+    def add(self, value):
+        """Offer one latency to the sample."""
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.size:
+                self.values[i] = value
+
+    def summary(self):
+        """Percentiles of the sampled latencies, or None if there are none."""
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+
+        def pct(p):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 3)
+
+        return {
+            "p50": pct(0.5),
+            "p95": pct(0.95),
+            "p99": pct(0.99),
+            "max": round(ordered[-1], 3),
+        }
+
+
+def _parse_qos_mix(qos):
+    """Normalize `qos` (a level or {level: weight}) to (levels, weights)."""
+    if isinstance(qos, int):
+        qos = {qos: 1}
+    if not isinstance(qos, dict) or not qos:
+        raise ValueError("qos must be 0, 1, 2 or a {level: weight} mix")
+    mix = {int(level): float(weight) for level, weight in qos.items()}
+    if not set(mix) <= {0, 1, 2} or min(mix.values()) < 0 or not sum(mix.values()):
+        raise ValueError("qos mix needs levels 0-2 with positive weights")
+    return list(mix), list(mix.values())
+
+
+class LoadJob:
+    """Publishes generated messages at a steady rate from a background thread."""
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        client,
+        rate,
+        duration,
+        topic,
+        payload="",
+        qos=0,
+        retain=False,
+    ):
+        """Validate the parameters of a job publishing through `client`."""
+        rate, duration = float(rate), float(duration)
+        if not 0 < rate <= LOADGEN_MAX_RATE:
+            raise ValueError(f"rate must be between 0 and {LOADGEN_MAX_RATE:g}")
+        if not 0 < duration <= LOADGEN_MAX_DURATION:
+            raise ValueError(
+                f"duration must be between 0 and {LOADGEN_MAX_DURATION:g} seconds"
+            )
+        self.id = next(self._ids)
+        self.client = client
+        self.rate = rate
+        self.duration = duration
+        self.topic = Template(topic)
+        self.payload = Template(payload)
+        self.qos_levels, self.qos_weights = _parse_qos_mix(qos)
+        self.retain = bool(retain)
+        self.state = "pending"
+        self.sent = 0
+        self.errors = 0
+        self.acked = {0: 0, 1: 0, 2: 0}
+        self.latency = {0: LatencySample(), 1: LatencySample(), 2: LatencySample()}
+        self.started = None
+        self.finished = None
+        # Ids of this job's publishes not acked yet
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._window = (0.0, 0)
+        self._recent_rate = 0.0
+        self._thread = None
+
+    def start(self):
+        """Start publishing in a background thread."""
+        self.client.ack_listeners.append(self.on_ack)
+        self.started = time.monotonic()
+        self._window = (self.started, 0)
+        self.state = "running"
+        self._thread = threading.Thread(
+            target=self._run, name=f"loadgen-{self.id}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Ask the job to stop publishing."""
+        self._stop.set()
+
+    def _run(self):
+        try:
+            self._publish_at_rate()
+            deadline = time.monotonic() + ACK_TIMEOUT
+            while self._pending and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.state = "stopped" if self._stop.is_set() else "done"
+        except Exception:
+            log.exception("Load job %s failed", self.id)
+            self.state = "failed"
+        finally:
+            self.finished = time.monotonic()
+            try:
+                self.client.ack_listeners.remove(self.on_ack)
+            except ValueError:
+                pass
+
+    def _publish_at_rate(self):
+        start = self.started
+        end = start + self.duration
+        total = int(self.duration * self.rate)
+        n = 0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= end:
+                break
+            # Publish everything due by now, then sleep until the next one
+            # (or the end, so the achieved rate is measured over the duration)
+            due = min(int((now - start) * self.rate) + 1, total)
+            while n < due and not self._stop.is_set():
+                self._publish(n)
+                n += 1
+            due_next = start + n / self.rate if n < total else end
+            delay = min(due_next, end) - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+
+    def _publish(self, n):
+        qos = random.choices(self.qos_levels, self.qos_weights)[0]
+        topic = self.topic.render(n)
+        payload = self.payload.render(n)
+        record = self.client.publish(topic, payload, qos=qos, retain=self.retain)
+        self.sent += 1
+        if record.rc:
+            self.errors += 1
+            return
+        with self._lock:
+            # The ack may have come in before publish() returned
+            if record.acked_ns is None:
+                self._pending.add(record.id)
+                return
+        self._record_ack(record)
+
+    def on_ack(self, record):
+        """A publish is done (see ActiveClient.ack_listeners)."""
+        with self._lock:
+            if record.id not in self._pending:
+                return
+            self._pending.remove(record.id)
+        self._record_ack(record)
+
+    def _record_ack(self, record):
+        self.acked[record.qos] += 1
+        self.latency[record.qos].add((record.acked_ns - record.sent_ns) / 1e6)
+
+    def status(self):
+        """JSON-ready progress of the job."""
+        now = self.finished or time.monotonic()
+        elapsed = now - self.started if self.started else 0.0
+        # Achieved rate over the last second or so, updated when polled
+        since, count = self._window
+        if now - since >= 1:
+            self._recent_rate = (self.sent - count) / (now - since)
+            self._window = (now, self.sent)
+        return {
+            "id": self.id,
+            "broker_id": self.client.broker_id,
+            "user_id": self.client.user_id,
+            "state": self.state,
+            "target_rate": self.rate,
+            "duration": self.duration,
+            "elapsed": round(elapsed, 3),
+            "sent": self.sent,
+            "errors": self.errors,
+            "pending": len(self._pending),
+            "rate": round(self.sent / elapsed, 1) if elapsed else 0.0,
+            "recent_rate": round(self._recent_rate, 1),
+            "acked": {str(q): n for q, n in self.acked.items()},
+            "latency_ms": {
+                str(q): sample.summary() for q, sample in self.latency.items()
+            },
+        }
+
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def start_job(client, params):
+    """Create and start a LoadJob for `client` from request parameters."""
+    if not isinstance(params, dict):
+        raise ValueError("Load job parameters must be a JSON object")
+    allowed = {"rate", "duration", "topic", "payload", "qos", "retain"}
+    unknown = set(params) - allowed
+    if unknown:
+        raise ValueError(f"Unknown load job parameters: {sorted(unknown)}")
+    if not params.get("topic"):
+        raise ValueError("A topic template is required")
+    try:
+        job = LoadJob(client, **params)
+    except TypeError as e:
+        raise ValueError(str(e))
+    with _jobs_lock:
+        finished = [i for i, j in _jobs.items() if j.finished is not None]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS + 1)]:
+            del _jobs[job_id]
+        _jobs[job.id] = job
+    job.start()
+    log.info(
+        "Load job %s: %s msg/s for %ss on broker %s",
+        job.id,
+        job.rate,
+        job.duration,
+        client.broker_id,
+    )
+    return job
+
+
+def get_job(job_id):
+    """Return a known job by id, or None."""
+    return _jobs.get(job_id)
+
+
+def stop_job(job_id):
+    """Stop a job; returns it, or None if unknown."""
+    job = _jobs.get(job_id)
+    if job is not None:
+        job.stop()
+    return job
+
+
+def stop_jobs(client):
+    """Stop every job publishing through `client`."""
+    for job in list(_jobs.values()):
+        if job.client is client:
+            job.stop()
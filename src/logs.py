@@ -0,0 +1,222 @@
+"""Logging for the app and the ingestion process.
+
+Records are handed to a bounded in-memory queue and written to stderr by a
+background thread, so the MQTT callbacks never wait on the terminal or the
+Docker log driver; when the queue is full, records are dropped and counted.
+
+Received messages are logged on the `antena.messages` logger. That echo can
+be turned off (LOG_MESSAGES=0) or limited: at most LOG_MESSAGE_RATE lines
+per second, and only one message in LOG_MESSAGE_SAMPLE. The number of
+messages left out is reported once per second.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+import messages
+
+ROOT_LOGGER = "antena"
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Per-logger levels, e.g. "mqtt=DEBUG,ingest=WARNING" (names under "antena.")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# "text" or "json" (one JSON object per line)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Log received messages at all
+LOG_MESSAGES = os.environ.get("LOG_MESSAGES", "1") == "1"
+# Maximum message lines per second (0 = no limit)
+LOG_MESSAGE_RATE = int(os.environ.get("LOG_MESSAGE_RATE", "20"))
+# Log one received message in this many
+LOG_MESSAGE_SAMPLE = max(1, int(os.environ.get("LOG_MESSAGE_SAMPLE", "1")))
+
+FORMATS = ("text", "json")
+TEXT_FORMAT = "[%(asctime)s.%(msecs)03d] %(levelname)s %(name)s: %(message)s"
+TEXT_DATE_FORMAT = "%H:%M:%S"
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def get_logger(name):
+    """Return the logger `antena.<name>`."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one line of JSON, including its `extra` fields."""
+
+    def format(self, record):
+        """Return the JSON line for `record`."""
+        fields = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                fields[key] = value
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        return json.dumps(fields, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        """Initialize a DroppingQueueHandler feeding `log_queue`."""
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """Queue `record`, or count it as dropped if the queue is full."""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class MessageSampler:
+    """Decide which received messages are logged.
+
+    Keeps one message in `sample` and at most `rate` per second (0 = no
+    limit). `allow()` is called for every message, so it only counts;
+    `take_skipped()` returns how many were refused since it was last
+    called, once a second at most.
+    """
+
+    def __init__(self, rate=LOG_MESSAGE_RATE, sample=LOG_MESSAGE_SAMPLE):
+        """Initialize a MessageSampler instance."""
+        self.rate = rate
+        self.sample = sample
+        self._seen = 0
+        self._window = 0
+        self._logged = 0
+        self._skipped = 0
+        self._reported = None
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        """Return True if the next message should be logged."""
+        with self._lock:
+            self._seen += 1
+            if self._seen % self.sample:
+                self._skipped += 1
+                return False
+            if self.rate:
+                window = int(time.monotonic() if now is None else now)
+                if window != self._window:
+                    self._window = window
+                    self._logged = 0
+                if self._logged >= self.rate:
+                    self._skipped += 1
+                    return False
+                self._logged += 1
+            return True
+
+    def take_skipped(self, now=None):
+        """Return the count of refused messages to report, resetting it."""
+        with self._lock:
+            window = int(time.monotonic() if now is None else now)
+            if not self._skipped or window == self._reported:
+                return 0
+            self._reported = window
+            skipped, self._skipped = self._skipped, 0
+            return skipped
+
+
+message_log = get_logger("messages")
+message_sampler = MessageSampler()
+
+
+def log_message(broker_name, message):
+    """Log a received message, subject to LOG_MESSAGES and the sampler.
+
+    Nothing is formatted for messages that are not logged.
+    """
+    if not LOG_MESSAGES or not message_log.isEnabledFor(logging.INFO):
+        return
+    if not message_sampler.allow():
+        skipped = message_sampler.take_skipped()
+        if skipped:
+            message_log.info("%d messages not logged", skipped)
+        return
+    message_log.info(
+        "[%s] %s | %s: %s",
+        messages.format_time(message.time_ns),
+        broker_name,
+        message.topic,
+        messages.payload_preview(message.payload),
+        extra={"broker": broker_name, "topic": message.topic},
+    )
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def parse_levels(spec):
+    """Parse LOG_LEVELS ("name=LEVEL,...") into {logger name: level}."""
+    levels = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, level = item.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"Invalid LOG_LEVELS entry: {item!r}")
+        levels[f"{ROOT_LOGGER}.{name.strip()}"] = level.strip().upper()
+    return levels
+
+
+def setup(stream=None):
+    """Configure the `antena` loggers once per process.
+
+    Returns the queue handler, whose `dropped` attribute counts the records
+    lost to a full queue.
+    """
+    global _listener
+    with _setup_lock:
+        root = logging.getLogger(ROOT_LOGGER)
+        if _listener is not None:
+            return root.handlers[0]
+        if LOG_FORMAT not in FORMATS:
+            raise ValueError(f"LOG_FORMAT must be one of {FORMATS}")
+        output = logging.StreamHandler(stream or sys.stderr)
+        if LOG_FORMAT == "json":
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT))
+        handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL.upper())
+        root.propagate = False
+        for name, level in parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+        _listener = logging.handlers.QueueListener(handler.queue, output)
+        _listener.start()
+        atexit.register(shutdown)
+        return handler
+
+
+def shutdown():
+    """Write out the queued records and stop the writer thread."""
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+        root = logging.getLogger(ROOT_LOGGER)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
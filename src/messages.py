@@ -0,0 +1,167 @@
+"""Received messages and their encoding for the browser.
+
+Messages keep the raw payload bytes handed over by paho. Nothing is decoded
+when a message arrives; the JSON form sent to the browser is only built when
+a message is written to a stream, from at most PAYLOAD_PREVIEW_BYTES of the
+payload, so a large binary payload is never decoded or base64-encoded whole.
+A Message caches that encoding, so it is built once however many streams
+send the message.
+"""
+
+import base64
+import json
+import os
+import time
+
+try:
+    import orjson
+except ImportError:  # optional, faster encoder
+    orjson = None
+
+# Payloads larger than this are truncated in the live view (0 = never)
+PAYLOAD_PREVIEW_BYTES = int(os.environ.get("PAYLOAD_PREVIEW_BYTES", "65536"))
+
+_RAW_TYPES = (bytes, bytearray, memoryview)
+
+# Broker names by broker id, filled in by the clients; messages only carry the id
+broker_names = {}
+
+
+class Message:
+    """A received MQTT message.
+
+    The receive time is kept as two integers: `time_ns` (epoch) and
+    `mono_ns` (monotonic, for ordering and latency within this process).
+    Times, payload and broker name are only formatted when the message is
+    first encoded; the encoding is then cached on the message.
+    """
+
+    __slots__ = (
+        "id",
+        "broker_id",
+        "topic",
+        "payload",
+        "time_ns",
+        "mono_ns",
+        "_json",
+        "_frame",
+    )
+
+    def __init__(self, id, broker_id, topic, payload, time_ns=None, mono_ns=None):
+        """Initialize a Message, timestamped now unless times are given."""
+        self.id = id
+        self.broker_id = broker_id
+        self.topic = topic
+        self.payload = payload
+        self.time_ns = time.time_ns() if time_ns is None else time_ns
+        self.mono_ns = time.monotonic_ns() if mono_ns is None else mono_ns
+        self._json = None
+        self._frame = None
+
+    @classmethod
+    def from_wire(cls, fields, encoded=None):
+        """Rebuild a message from its wire fields, keeping them as its encoding.
+
+        Used for messages relayed by the ingestion process: the payload is
+        the already encoded one and the monotonic time is the arrival here.
+        `encoded` is the JSON the fields were parsed from, if at hand.
+        """
+        message = cls(
+            fields["id"],
+            fields["broker_id"],
+            fields["topic"],
+            fields["payload"],
+            time_ns=round(fields["ts"] * 1e9),
+        )
+        message._json = bytes(encoded) if encoded is not None else dumps(fields)
+        return message
+
+    def to_wire(self):
+        """Return the JSON-ready fields sent to the browser."""
+        fields = {
+            "id": self.id,
+            "broker_id": self.broker_id,
+            "broker_name": broker_names.get(self.broker_id),
+            "topic": self.topic,
+            "ts": self.time_ns / 1e9,
+            "timestamp": format_time(self.time_ns),
+        }
+        if isinstance(self.payload, _RAW_TYPES):
+            fields.update(payload_fields(self.payload))
+        else:
+            fields["payload"] = self.payload
+        return fields
+
+    def __repr__(self):
+        return f"<Message {self.id} {self.broker_id}:{self.topic}>"
+
+
+def format_time(time_ns):
+    """Local wall-clock time of an epoch in ns, with milliseconds."""
+    seconds, ns = divmod(time_ns, 1_000_000_000)
+    return (
+        time.strftime("%H:%M:%S", time.localtime(seconds)) + f".{ns // 1_000_000:03d}"
+    )
+
+
+def dumps(obj):
+    """Encode `obj` as compact UTF-8 JSON bytes, with orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def payload_fields(payload, limit=PAYLOAD_PREVIEW_BYTES):
+    """Return the JSON fields representing a payload.
+
+    Text is sent as is (`encoding: utf-8`), anything else as base64. Payloads
+    over `limit` bytes are cut to `limit` and flagged `truncated`; `size` is
+    always the full size.
+    """
+    if payload is None:
+        payload = b""
+    view = memoryview(payload)
+    size = view.nbytes
+    truncated = bool(limit) and size > limit
+    if truncated:
+        view = view[:limit]
+    try:
+        text = str(view, "utf-8")
+    except UnicodeDecodeError as e:
+        # A cut through a multi-byte character is still text
+        if truncated and e.reason == "unexpected end of data":
+            text = str(view[: e.start], "utf-8")
+        else:
+            text = None
+    if text is None:
+        fields = {"payload": base64.b64encode(view).decode(), "encoding": "base64"}
+    else:
+        fields = {"payload": text, "encoding": "utf-8"}
+    fields["size"] = size
+    if truncated:
+        fields["truncated"] = True
+    return fields
+
+
+def message_json(message):
+    """JSON bytes of a message's wire form, encoded once per message."""
+    if message._json is None:
+        message._json = dumps(message.to_wire())
+    return message._json
+
+
+def message_frame(message):
+    """SSE frame (bytes) of a single message carrying its event id."""
+    if message._frame is None:
+        message._frame = b"id: %d\ndata: %s\n\n" % (message.id, message_json(message))
+    return message._frame
+
+
+def payload_preview(payload, limit=200):
+    """Short printable form of a payload for log lines."""
+    fields = payload_fields(payload, limit)
+    if fields["encoding"] == "base64":
+        return f"<{fields['size']} bytes binary>"
+    if fields.get("truncated"):
+        return f"{fields['payload']}... <{fields['size']} bytes>"
+    return fields["payload"]
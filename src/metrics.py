@@ -0,0 +1,310 @@
+"""Counters and histograms exposed on /metrics in the Prometheus text format.
+
+Instrumentation on the message path is kept to integer increments on
+preallocated slots: no locks, no per-message objects. Every broker's
+counters are only written by the thread serving that broker, and a lost
+increment between two streams updating the shared histogram is acceptable
+for monitoring, so nothing here takes a lock.
+
+Broker metrics come from the process holding the broker connections: the
+web app itself, or the ingestion process (see registry).
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+import mqtt_loop
+
+# Upper bounds, in seconds, of the receive -> SSE write latency buckets
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# Exposed BrokerStats counters: metric name -> (attribute, help text)
+BROKER_COUNTERS = {
+    "messages_received_total": ("received", "Messages received."),
+    "bytes_received_total": ("received_bytes", "Payload bytes received."),
+    "messages_published_total": ("published", "Messages published."),
+    "bytes_published_total": ("published_bytes", "Payload bytes published."),
+    "connects_total": ("connects", "Successful connections."),
+    "disconnects_total": ("disconnects", "Disconnections."),
+}
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """A monotonically increasing integer."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        """Initialize a Counter at zero."""
+        self.value = 0
+
+    def inc(self, n=1):
+        """Add `n` to the counter."""
+        self.value += n
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations observed in nanoseconds."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initialize a Histogram with `buckets` upper bounds in seconds."""
+        self.buckets = tuple(buckets)
+        self._bounds_ns = [round(b * 1e9) for b in self.buckets]
+        # One slot per bucket plus +Inf
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum_ns = 0
+
+    def observe_ns(self, duration_ns):
+        """Record one duration."""
+        self._counts[bisect_left(self._bounds_ns, duration_ns)] += 1
+        self.sum_ns += duration_ns
+
+    @property
+    def count(self):
+        """Number of observations."""
+        return sum(self._counts)
+
+    def quantile(self, q):
+        """Estimate the `q` quantile, in seconds, or None without observations.
+
+        Interpolates linearly within the bucket holding it, like Prometheus'
+        histogram_quantile(); past the last bound, that bound is returned.
+        """
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets, self._counts):
+            if n and seen + n >= rank:
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """Return `(upper bound, cumulative count)` pairs, ending with +Inf."""
+        total = 0
+        pairs = []
+        for bound, n in zip(self.buckets + (float("inf"),), self._counts):
+            total += n
+            pairs.append((bound, total))
+        return pairs
+
+
+class BrokerStats:
+    """Message and connection counters of one broker client."""
+
+    __slots__ = (
+        "received",
+        "received_bytes",
+        "published",
+        "published_bytes",
+        "connects",
+        "disconnects",
+    )
+
+    def __init__(self):
+        """Initialize a BrokerStats instance with every counter at zero."""
+        self.received = 0
+        self.received_bytes = 0
+        self.published = 0
+        self.published_bytes = 0
+        self.connects = 0
+        self.disconnects = 0
+
+
+# Time from a message's arrival in this process to its SSE frame being written
+delivery_latency = Histogram()
+# Part of it spent waiting in the listener queue
+queue_wait = Histogram()
+# Arrival to rendering, as measured by pages with tracing on (see /stream/trace)
+browser_latency = Histogram()
+# Messages broadcast to the listeners, and queue deliveries they resulted in
+broadcasts = Counter()
+deliveries = Counter()
+
+
+def observe_delivery(messages):
+    """Record the delivery latency of messages whose frame was just written."""
+    now = time.monotonic_ns()
+    for msg in messages:
+        delivery_latency.observe_ns(now - msg.mono_ns)
+
+
+def observe_queue_wait(messages, dequeued):
+    """Record the queue wait of messages taken from a listener queue at `dequeued`."""
+    for msg, t in zip(messages, dequeued):
+        queue_wait.observe_ns(t - msg.mono_ns)
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+
+def _family(out, name, kind, text, samples):
+    out.append(f"# HELP antena_{name} {text}")
+    out.append(f"# TYPE antena_{name} {kind}")
+    for labels, value in samples:
+        out.append(f"antena_{name}{labels} {value}")
+
+
+def _histogram(out, name, text, series):
+    """Append a histogram family; `series` is a list of (labels, Histogram)."""
+    name = f"antena_{name}"
+    out.append(f"# HELP {name} {text}")
+    out.append(f"# TYPE {name} histogram")
+    for labels, hist in series:
+        for bound, total in hist.cumulative():
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            out.append(f"{name}_bucket{_labels(**labels, le=le)} {total}")
+        out.append(f"{name}_sum{_labels(**labels)} {hist.sum_ns / 1e9}")
+        out.append(f"{name}_count{_labels(**labels)} {hist.count}")
+
+
+def render_brokers(clients):
+    """Metrics of the broker clients held by this process."""
+    clients = list(clients)
+    per_broker = [
+        (_labels(broker_id=c.broker_id, user_id=c.user_id), c) for c in clients
+    ]
+    out = []
+    for name, (attr, text) in BROKER_COUNTERS.items():
+        _family(
+            out,
+            f"broker_{name}",
+            "counter",
+            text,
+            [(labels, getattr(c.stats, attr)) for labels, c in per_broker],
+        )
+    _family(
+        out,
+        "broker_publishes_pending",
+        "gauge",
+        "Publishes awaiting completion (PUBACK/PUBCOMP for QoS 1/2).",
+        [
+            (_labels(broker_id=c.broker_id, user_id=c.user_id, qos=qos), n)
+            for c in clients
+            for qos, n in enumerate(c.publishes.pending())
+        ],
+    )
+    _histogram(
+        out,
+        "broker_publish_ack_seconds",
+        "Time from publish to completion: written out for QoS 0, PUBACK for"
+        " QoS 1, PUBCOMP for QoS 2.",
+        [
+            ({"broker_id": c.broker_id, "user_id": c.user_id, "qos": qos}, hist)
+            for c in clients
+            for qos, hist in enumerate(c.publishes.latency)
+        ],
+    )
+    _family(
+        out,
+        "broker_connected",
+        "gauge",
+        "1 if the broker is connected.",
+        [(labels, int(c.is_connected)) for labels, c in per_broker],
+    )
+    paho_threads = sum(
+        1 for c in clients if getattr(c.client, "_thread", None) is not None
+    )
+    _family(
+        out,
+        "paho_loop_threads",
+        "gauge",
+        "paho network threads (MQTT_RUNTIME=threads).",
+        [("", paho_threads)],
+    )
+    _family(
+        out,
+        "asyncio_loop_clients",
+        "gauge",
+        "Broker clients served by the asyncio loop (MQTT_RUNTIME=asyncio).",
+        [("", len(mqtt_loop.current_loop() or ()))],
+    )
+    return "\n".join(out) + "\n"
+
+
+def render_listeners(registry):
+    """Metrics of this process's SSE listeners and delivery."""
+    queues = [
+        (_labels(user_id=user_id, listener=q.id), q)
+        for user_id in sorted(registry.users())
+        for q in registry.get(user_id)
+    ]
+    out = []
+    _family(
+        out,
+        "listener_queue_depth",
+        "gauge",
+        "Messages waiting in a listener queue.",
+        [(labels, q.qsize()) for labels, q in queues],
+    )
+    _family(
+        out,
+        "listener_dropped_total",
+        "counter",
+        "Messages dropped by a listener queue's overflow policy.",
+        [(labels, q.dropped) for labels, q in queues],
+    )
+    _family(
+        out,
+        "broadcasts_total",
+        "counter",
+        "Messages broadcast to listeners.",
+        [("", broadcasts.value)],
+    )
+    _family(
+        out,
+        "deliveries_total",
+        "counter",
+        "Messages queued for listeners (one per matching listener).",
+        [("", deliveries.value)],
+    )
+    _histogram(
+        out,
+        "delivery_latency_seconds",
+        "Time from message arrival to its SSE frame being written.",
+        [({}, delivery_latency)],
+    )
+    _histogram(
+        out,
+        "queue_wait_seconds",
+        "Time from message arrival to its removal from a listener queue.",
+        [({}, queue_wait)],
+    )
+    _histogram(
+        out,
+        "browser_latency_seconds",
+        "Time from message arrival to its rendering, reported by traced pages.",
+        [({}, browser_latency)],
+    )
+    _family(
+        out,
+        "threads",
+        "gauge",
+        "Threads of this process (green threads when monkey-patched).",
+        [("", threading.active_count())],
+    )
+    return "\n".join(out) + "\n"
@@ -0,0 +1,199 @@
+"""Single asyncio event loop driving the sockets of every broker client.
+
+By default each ActiveClient runs paho's `loop_start()`, i.e. one network
+thread per broker. With MQTT_RUNTIME=asyncio the clients get no thread of
+their own: their sockets are registered with one asyncio loop through
+paho's external event loop callbacks (on_socket_open, on_socket_close,
+on_socket_register_write, on_socket_unregister_write) and that loop calls
+loop_read/loop_write when a socket is ready and loop_misc once a second.
+
+Failed and dropped connections are retried with exponential backoff
+(between MQTT_RECONNECT_MIN and MQTT_RECONNECT_MAX seconds) and jitter, so
+brokers that went down together are not all retried at the same moment.
+"""
+
+import asyncio
+import os
+import random
+import threading
+
+# "threads" (one paho network thread per broker) or "asyncio" (one loop)
+MQTT_RUNTIME = os.environ.get("MQTT_RUNTIME", "threads")
+RUNTIMES = ("threads", "asyncio")
+
+# Seconds between paho housekeeping calls (keepalive pings, retries)
+MISC_INTERVAL = 1
+# Bounds of the delay before a failed or dropped connection is retried
+MQTT_RECONNECT_MIN = float(os.environ.get("MQTT_RECONNECT_MIN", "1"))
+MQTT_RECONNECT_MAX = float(os.environ.get("MQTT_RECONNECT_MAX", "60"))
+
+
+class Backoff:
+    """Reconnect delays doubling from `base` up to `cap`, with jitter.
+
+    Each delay is drawn from the upper half of the current window, so
+    clients failing together spread out while still backing off.
+    """
+
+    def __init__(self, base=None, cap=None):
+        """Initialize a Backoff; bounds default to MQTT_RECONNECT_MIN/MAX."""
+        self.base = MQTT_RECONNECT_MIN if base is None else base
+        self.cap = MQTT_RECONNECT_MAX if cap is None else cap
+        self.attempt = 0
+
+    def next(self):
+        """Return the delay before the next attempt."""
+        window = min(self.cap, self.base * 2**self.attempt)
+        self.attempt += 1
+        return random.uniform(window / 2, window)
+
+    def reset(self):
+        """Start over from `base`, after a successful connection."""
+        self.attempt = 0
+
+
+class AsyncioLoop:
+    """An asyncio loop, run in one background thread, serving many paho clients."""
+
+    def __init__(self):
+        """Initialize an AsyncioLoop instance; its thread starts on first use."""
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._clients = set()
+        self._reconnecting = set()
+        self._backoff = {}
+
+    def start(self):
+        """Start the loop thread if it is not running yet."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.loop.run_forever, name="mqtt-asyncio", daemon=True
+                )
+                self._thread.start()
+
+    def connect(self, client, host, port, keepalive=60):
+        """Connect a paho client and let the loop service its socket.
+
+        The TCP connection is opened in the calling thread so errors are
+        reported to the caller as with loop_start(); the MQTT handshake and
+        all later traffic run on the loop. A failed connection is retried
+        in the background, like a dropped one, until detach().
+        """
+        self.start()
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._clients.add(client)
+        self._backoff[client] = Backoff()
+        try:
+            client.connect(host, port, keepalive)
+        finally:
+            self.loop.call_soon_threadsafe(self._misc, client)
+
+    def detach(self, client):
+        """Stop servicing and reconnecting a client.
+
+        Call before client.disconnect(): the socket stays registered until
+        paho closes it after sending DISCONNECT.
+        """
+        self._clients.discard(client)
+        self._backoff.pop(client, None)
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._watch, sock, True, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        # The socket is closed as soon as this returns, so it must be
+        # unregistered now rather than whenever the loop gets to it
+        self._run_on_loop(self._unwatch, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._watch, sock, False, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._run_on_loop(self.loop.remove_writer, sock)
+
+    def _watch(self, sock, read, callback):
+        # Requests queued from other threads may arrive after the close
+        if sock.fileno() < 0:
+            return
+        if read:
+            self.loop.add_reader(sock, callback)
+        else:
+            self.loop.add_writer(sock, callback)
+
+    def _unwatch(self, sock):
+        if sock.fileno() >= 0:
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
+
+    def _run_on_loop(self, func, *args):
+        """Run `func` on the loop thread and wait until it has run."""
+        if threading.current_thread() is self._thread:
+            func(*args)
+            return
+        done = threading.Event()
+
+        def run():
+            try:
+                func(*args)
+            finally:
+                done.set()
+
+        self.loop.call_soon_threadsafe(run)
+        done.wait()
+
+    def _misc(self, client):
+        if client not in self._clients:
+            return
+        if client.socket() is None:
+            if client not in self._reconnecting:
+                self._reconnecting.add(client)
+                delay = self._backoff[client].next()
+                self.loop.call_later(delay, self._reconnect, client)
+        else:
+            client.loop_misc()
+        self.loop.call_later(MISC_INTERVAL, self._misc, client)
+
+    def _reconnect(self, client):
+        if client not in self._clients:
+            self._reconnecting.discard(client)
+            return
+        # reconnect() blocks on the TCP handshake: keep it off the loop
+        self.loop.run_in_executor(None, self._attempt_reconnect, client)
+
+    def _attempt_reconnect(self, client):
+        try:
+            client.reconnect()
+        except OSError:
+            pass
+        else:
+            backoff = self._backoff.get(client)
+            if backoff is not None:
+                backoff.reset()
+        finally:
+            self._reconnecting.discard(client)
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def current_loop():
+    """Return the AsyncioLoop if one was started, else None."""
+    return _loop
+
+
+def get_loop():
+    """Return the process-wide AsyncioLoop, creating it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = AsyncioLoop()
+        return _loop
@@ -1,32 +1,412 @@
 import paho.mqtt.client as mqtt
-from datetime import datetime
+from collections import deque
+import itertools
+import os
+import random
 import threading
 import queue
 import time
 
-connected_clients = {}
+import history
+import loadgen
+import logs
+import messages
+import metrics
+import mqtt_loop
+import publish_tracker
+import topic_tree
+import topics
 
-# listeners = { user_id: [queue1, queue2, ...] }
-listeners = {}
-listeners_lock = threading.Lock()
+log = logs.get_logger("mqtt")
+
+
+class ClientIndex(dict):
+    """Active clients by broker id, also indexed by the user owning them.
+
+    Only item assignment and `del` keep the user index up to date.
+    """
+
+    def __init__(self):
+        """Initialize an empty ClientIndex."""
+        super().__init__()
+        self._by_user = {}
+
+    def __setitem__(self, broker_id, client):
+        if broker_id in self:
+            del self[broker_id]
+        super().__setitem__(broker_id, client)
+        self._by_user.setdefault(client.user_id, {})[broker_id] = client
+
+    def __delitem__(self, broker_id):
+        client = self[broker_id]
+        super().__delitem__(broker_id)
+        owned = self._by_user[client.user_id]
+        del owned[broker_id]
+        if not owned:
+            del self._by_user[client.user_id]
+
+    def for_user(self, user_id):
+        """The clients of a user's brokers."""
+        return list(self._by_user.get(user_id, {}).values())
+
+
+connected_clients = ClientIndex()
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+COALESCE = "coalesce"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+# Maximum number of messages buffered per SSE listener (0 = unbounded)
+LISTENER_QUEUE_SIZE = int(os.environ.get("LISTENER_QUEUE_SIZE", "1000"))
+LISTENER_OVERFLOW_POLICY = os.environ.get("LISTENER_OVERFLOW_POLICY", DROP_OLDEST)
+
+# Per-broker replay buffer limits, in messages and in approximate bytes
+REPLAY_BUFFER_SIZE = int(os.environ.get("REPLAY_BUFFER_SIZE", "1000"))
+REPLAY_BUFFER_BYTES = int(os.environ.get("REPLAY_BUFFER_BYTES", str(1024**2)))
+# Messages replayed to a stream that connects without a Last-Event-ID
+REPLAY_ON_CONNECT = int(os.environ.get("REPLAY_ON_CONNECT", "100"))
+
+# Seconds a connection attempt may take to open the TCP connection
+MQTT_CONNECT_TIMEOUT = float(os.environ.get("MQTT_CONNECT_TIMEOUT", "5"))
+
+# QoS 1/2 messages awaiting their acknowledgement at once (paho's window)
+MQTT_MAX_INFLIGHT = int(os.environ.get("MQTT_MAX_INFLIGHT", "20"))
+# QoS 1/2 messages held by paho, in flight or queued behind the window,
+# before publish() refuses more (0 = unbounded)
+MQTT_MAX_QUEUED = int(os.environ.get("MQTT_MAX_QUEUED", "0"))
+
+# Message ids double as SSE event ids. Starting from the current time in
+# microseconds keeps them increasing across restarts.
+_message_ids = itertools.count(time.time_ns() // 1000)
+# Identifies listener queues in the metrics
+_listener_ids = itertools.count(1)
+
+
+def _topic_key(message_data):
+    """Key used to coalesce messages of the same topic."""
+    return message_data.broker_id, message_data.topic
+
+
+class ListenerQueue:
+    """Bounded queue for a single SSE listener with an explicit overflow policy.
+
+    When the queue is full, `drop-oldest` evicts the oldest buffered message,
+    `drop-newest` discards the incoming one and `coalesce` replaces the pending
+    message of the same topic (falling back to drop-oldest). The replacement
+    goes to the tail so message ids leave the queue in increasing order.
+    Every discarded message is counted in `dropped`.
+    """
+
+    def __init__(self, maxsize=None, policy=None):
+        """Initialize a ListenerQueue instance."""
+        policy = policy or LISTENER_OVERFLOW_POLICY
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.policy = policy
+        self.id = next(_listener_ids)
+        self.maxsize = LISTENER_QUEUE_SIZE if maxsize is None else maxsize
+        self.dropped = 0
+        self._reported = 0
+        # Items are stored in one-element cells so a coalesced message can be
+        # emptied in place without searching the deque; empty cells are
+        # skipped when read and compacted away when they pile up.
+        self._items = deque()
+        self._size = 0
+        self._pending = {}
+        self._not_empty = threading.Condition(threading.Lock())
+
+    def qsize(self):
+        """Return the number of buffered messages."""
+        return self._size
+
+    def empty(self):
+        """Return True if no message is buffered."""
+        return not self._size
+
+    def _pop(self):
+        cell = self._items.popleft()
+        while not cell:
+            cell = self._items.popleft()
+        self._size -= 1
+        if self._pending:
+            key = _topic_key(cell[0])
+            if self._pending.get(key) is cell:
+                del self._pending[key]
+        return cell[0]
+
+    def _append(self, item):
+        cell = [item]
+        self._items.append(cell)
+        self._size += 1
+        return cell
+
+    def offer(self, item):
+        """Enqueue without blocking, applying the overflow policy when full."""
+        with self._not_empty:
+            if 0 < self.maxsize <= self._size:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                if self.policy == COALESCE:
+                    key = _topic_key(item)
+                    cell = self._pending.get(key)
+                    if cell is not None:
+                        cell.clear()
+                        self._size -= 1
+                        self._pending[key] = self._append(item)
+                        if len(self._items) > 2 * self._size:
+                            self._items = deque(c for c in self._items if c)
+                        self._not_empty.notify()
+                        return
+                self._pop()
+            cell = self._append(item)
+            if self.policy == COALESCE:
+                self._pending[_topic_key(item)] = cell
+            self._not_empty.notify()
+
+    put = put_nowait = offer
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the oldest message, waiting up to `timeout` seconds."""
+        with self._not_empty:
+            if block and not self._size:
+                self._not_empty.wait_for(lambda: self._size, timeout)
+            if not self._size:
+                raise queue.Empty
+            return self._pop()
+
+    def get_nowait(self):
+        """Remove and return the oldest message without waiting."""
+        return self.get(block=False)
+
+    def take_dropped(self):
+        """Return the number of messages dropped since the previous call."""
+        with self._not_empty:
+            count = self.dropped - self._reported
+            self._reported = self.dropped
+            return count
+
+
+class MessageRing:
+    """Fixed-size ring buffer of recent messages, bounded in count and bytes.
+
+    Slots are preallocated; appending past either limit evicts the oldest
+    entries. Message ids must be appended in increasing order.
+    """
+
+    def __init__(self, capacity=REPLAY_BUFFER_SIZE, max_bytes=REPLAY_BUFFER_BYTES):
+        """Initialize a MessageRing instance."""
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._ids = [0] * capacity
+        self._items = [None] * capacity
+        self._sizes = [0] * capacity
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def _evict(self):
+        i = self._start
+        self.bytes -= self._sizes[i]
+        self._items[i] = None
+        self._start = (i + 1) % self.capacity
+        self._count -= 1
+
+    def append(self, msg_id, item, size):
+        """Store a message, evicting the oldest ones to stay within the limits."""
+        if not self.capacity or size > self.max_bytes:
+            return
+        with self._lock:
+            while self._count and (
+                self._count == self.capacity or self.bytes + size > self.max_bytes
+            ):
+                self._evict()
+            i = (self._start + self._count) % self.capacity
+            self._ids[i] = msg_id
+            self._items[i] = item
+            self._sizes[i] = size
+            self._count += 1
+            self.bytes += size
+
+    def since(self, after_id=None):
+        """Return `(id, message)` pairs newer than `after_id`, oldest first."""
+        with self._lock:
+            found = []
+            for n in range(self._count):
+                i = (self._start + n) % self.capacity
+                if after_id is None or self._ids[i] > after_id:
+                    found.append((self._ids[i], self._items[i]))
+            return found
+
+
+class _Subscription:
+    """A listener queue with the topic filters and brokers it asked for."""
+
+    __slots__ = ("queue", "topic_filters", "broker_ids")
+
+    def __init__(self, q, topic_filters, broker_ids):
+        self.queue = q
+        self.topic_filters = tuple(topic_filters) or ("#",)
+        self.broker_ids = frozenset(broker_ids) if broker_ids else None
+
+    def wants(self, broker_id, topic):
+        """Return True if a message from `broker_id` on `topic` passes the filters."""
+        if self.broker_ids is not None and broker_id not in self.broker_ids:
+            return False
+        return any(topics.matches(f, topic) for f in self.topic_filters)
+
+
+class _UserSnapshot:
+    """Immutable view of one user's listeners, with their filters compiled.
+
+    Filters are inserted into one trie for listeners of any broker plus one
+    trie per broker a listener is restricted to, so matching a message costs
+    two trie walks no matter how many listeners or filters there are.
+    """
+
+    __slots__ = ("subscriptions", "_tries", "_unfiltered")
+
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+        # Fast path when nobody filters: every message goes to every queue
+        self._unfiltered = None
+        if all(
+            s.broker_ids is None and s.topic_filters == ("#",) for s in subscriptions
+        ):
+            self._unfiltered = tuple(s.queue for s in subscriptions)
+        self._tries = {}
+        for sub in subscriptions:
+            for broker_id in sub.broker_ids or (None,):
+                trie = self._tries.get(broker_id)
+                if trie is None:
+                    trie = self._tries[broker_id] = topics.TopicTrie()
+                for topic_filter in sub.topic_filters:
+                    trie.insert(topic_filter, sub.queue)
+
+    def match(self, broker_id, topic):
+        """Return the queues that should receive a message, each once."""
+        if self._unfiltered is not None:
+            return self._unfiltered
+        found = []
+        for key in (None, broker_id):
+            trie = self._tries.get(key)
+            if trie is not None:
+                found.extend(trie.match(topic))
+        if len(found) > 1:
+            found = list(dict.fromkeys(found))
+        return found
+
+
+class ListenerRegistry:
+    """Copy-on-write registry of the SSE listener queues of each user.
+
+    Every user maps to an immutable snapshot of its listeners and their
+    compiled topic filters. Subscribing or unsubscribing builds a new snapshot
+    under a writer lock and swaps it in, so the publish side only reads the
+    current snapshot and never takes a lock.
+    """
+
+    def __init__(self):
+        """Initialize a ListenerRegistry instance."""
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        # Called with no arguments whenever a user gains its first listener
+        # or loses its last one
+        self.watchers = []
+
+    def add(self, user_id, q, topic_filters=(), broker_ids=None):
+        """Register a listener queue for a user, optionally filtered.
+
+        `topic_filters` are MQTT filters (empty means every topic) and
+        `broker_ids` restricts the listener to some of the user's brokers.
+        """
+        for topic_filter in topic_filters:
+            topics.validate_filter(topic_filter)
+        sub = _Subscription(q, topic_filters, broker_ids)
+        with self._lock:
+            current = self._snapshots.get(user_id)
+            subs = current.subscriptions if current else ()
+            self._snapshots[user_id] = _UserSnapshot(subs + (sub,))
+        if current is None:
+            self._notify()
+
+    def remove(self, user_id, q):
+        """Unregister a listener queue, dropping the user once it has none left."""
+        with self._lock:
+            current = self._snapshots.get(user_id)
+            if current is None:
+                return
+            remaining = tuple(s for s in current.subscriptions if s.queue is not q)
+            if remaining:
+                self._snapshots[user_id] = _UserSnapshot(remaining)
+                return
+            del self._snapshots[user_id]
+        self._notify()
+
+    def _notify(self):
+        for watcher in self.watchers:
+            watcher()
+
+    def users(self):
+        """Return the IDs of the users with at least one listener."""
+        return set(self._snapshots)
+
+    def get(self, user_id):
+        """Return the current snapshot of a user's listener queues."""
+        current = self._snapshots.get(user_id)
+        return tuple(s.queue for s in current.subscriptions) if current else ()
+
+    def match(self, user_id, broker_id, topic):
+        """Return the user's listener queues whose filters accept the message."""
+        current = self._snapshots.get(user_id)
+        return current.match(broker_id, topic) if current else ()
+
+    def __contains__(self, user_id):
+        return user_id in self._snapshots
+
+
+listeners = ListenerRegistry()
+
+# Extra consumers of every received message, called as sink(user_id, message).
+# The ingestion process uses this to forward messages to the web workers.
+message_sinks = []
 
 
 def broadcast_message(user_id, message_data):
-    """Push message to all active SSE listeners of a specific user"""
-    with listeners_lock:
-        user_listeners = listeners.get(user_id, [])
-        for q in user_listeners:
-            try:
-                q.put_nowait(message_data)
-            except queue.Full:
-                pass
+    """Push message to the active SSE listeners of a user that want it."""
+    queues = listeners.match(user_id, message_data.broker_id, message_data.topic)
+    for q in queues:
+        q.offer(message_data)
+    metrics.broadcasts.inc()
+    metrics.deliveries.inc(len(queues))
+    for sink in message_sinks:
+        sink(user_id, message_data)
 
 
 class ActiveClient:
     """Wrapper for a Paho MQTT client managing a connection to a specific broker."""
 
-    def __init__(self, broker_id, user_id, name, ip, port, user=None, password=None):
-        """Initialize an ActiveClient instance."""
+    def __init__(
+        self,
+        broker_id,
+        user_id,
+        name,
+        ip,
+        port,
+        user=None,
+        password=None,
+        runtime=None,
+    ):
+        """Initialize an ActiveClient instance.
+
+        `runtime` picks how the socket is served (see mqtt_loop); it defaults
+        to MQTT_RUNTIME.
+        """
         self.broker_id = broker_id
         self.user_id = user_id
         self.name = name
@@ -34,13 +414,26 @@ class ActiveClient:
         self.port = port
         self.user = user
         self.password = password
+        messages.broker_names[broker_id] = name
+        self.runtime = runtime or mqtt_loop.MQTT_RUNTIME
+        if self.runtime not in mqtt_loop.RUNTIMES:
+            raise ValueError(f"Unknown MQTT runtime: {self.runtime}")
         self.client = mqtt.Client(
             mqtt.CallbackAPIVersion.VERSION1,
             client_id=f"antena_{broker_id}_{int(time.time())}",
         )
         self.is_connected = False
         self.connection_error = None
-        self.subscribed_topics = set()
+        # Requested subscriptions {filter: qos}, and what was sent to the broker
+        self.subscriptions = {}
+        self._broker_subscriptions = {}
+        self._subscription_lock = threading.Lock()
+        self.ring = MessageRing()
+        self.stats = metrics.BrokerStats()
+        self.tree = topic_tree.TopicTree()
+        # Called with the PublishRecord of every publish paho reports done
+        self.ack_listeners = []
+        self.publishes = publish_tracker.PublishTracker(self.ack_listeners)
 
         if self.user and self.password:
             self.client.username_pw_set(self.user, self.password)
@@ -48,84 +441,270 @@ class ActiveClient:
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.on_connect_fail = self.on_connect_fail
+        self.client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+        self.client.max_queued_messages_set(MQTT_MAX_QUEUED)
+        self.client.connect_timeout = MQTT_CONNECT_TIMEOUT
+        # paho's own retries double the delay without jitter: start each
+        # client from a random base so brokers that failed together drift apart
+        self.client.reconnect_delay_set(
+            min_delay=random.uniform(1, 2) * mqtt_loop.MQTT_RECONNECT_MIN,
+            max_delay=mqtt_loop.MQTT_RECONNECT_MAX,
+        )
+        # Set by disconnect(); a connection attempt still running then undoes itself
+        self._closed = False
+        self._connecting = False
+        self._connect_lock = threading.Lock()
 
-    def connect(self):
-        """Establish a connection to the MQTT broker and start the loop."""
-        try:
-            self.client.connect(self.ip, self.port, 60)
-            self.client.loop_start()
+    def connect(self, wait=None):
+        """Start connecting to the MQTT broker without blocking on it.
+
+        The first attempt runs on a background thread and its TCP connect
+        is bounded by MQTT_CONNECT_TIMEOUT. If it fails, the client keeps
+        retrying with exponential backoff until disconnect(). Waits up to
+        `wait` seconds (default: the connect timeout) for that first
+        attempt; returns `(False, error)` if it failed, else `(True, None)`.
+        With `wait=0` it returns `(True, None)` at once.
+        """
+        self.connection_error = None
+        self._connecting = True
+        attempted = threading.Event()
+        threading.Thread(
+            target=self._connect,
+            args=(attempted,),
+            name=f"mqtt-connect-{self.broker_id}",
+            daemon=True,
+        ).start()
+        if wait == 0:
             return True, None
+        if wait is None:
+            # Name resolution comes on top of the connect timeout
+            wait = MQTT_CONNECT_TIMEOUT + 1
+        if attempted.wait(wait) and self.connection_error:
+            return False, self.connection_error
+        return True, None
+
+    def _connect(self, attempted):
+        try:
+            if self.runtime == "asyncio":
+                mqtt_loop.get_loop().connect(self.client, self.ip, self.port, 60)
+            else:
+                self.client.connect(self.ip, self.port, 60)
         except Exception as e:
             self.connection_error = str(e)
-            return False, str(e)
+            log.warning("%s: connection failed, retrying: %s", self.name, e)
+            if self.runtime != "asyncio":
+                # The network thread retries a connect_async() connection
+                self.client.connect_async(self.ip, self.port, 60)
+        with self._connect_lock:
+            self._connecting = False
+            if self._closed:
+                self._stop_loop()
+            elif self.runtime != "asyncio":
+                self.client.loop_start()
+        attempted.set()
 
     def disconnect(self):
-        """Stop the loop and disconnect from the MQTT broker."""
-        self.client.loop_stop()
-        self.client.disconnect()
+        """Disconnect from the MQTT broker and stop the loop."""
+        loadgen.stop_jobs(self)
+        with self._connect_lock:
+            self._closed = True
+            # Otherwise the connection attempt stops the loop when it ends
+            if not self._connecting:
+                self._stop_loop()
         self.is_connected = False
 
-    def update_subscription(self, topic):
-        """Update the MQTT topic subscription for this client."""
-        if self.subscribed_topics:
-            for t in list(self.subscribed_topics):
-                self.client.unsubscribe(t)
-                self.subscribed_topics.remove(t)
+    def _stop_loop(self):
+        if self.runtime == "asyncio":
+            mqtt_loop.get_loop().detach(self.client)
+            self.client.disconnect()
+        else:
+            # DISCONNECT wakes the network thread, which then exits promptly;
+            # stopping the loop first would wait out its select timeout
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    @property
+    def subscribed_topics(self):
+        """Set of the topic filters currently subscribed."""
+        return set(self.subscriptions)
+
+    def set_subscriptions(self, subscriptions):
+        """Make `{filter: qos}` the exact set of subscriptions of this client.
+
+        Overlapping filters are reduced to a minimal cover and only the
+        difference with what the broker already has is sent, as at most one
+        SUBSCRIBE and one UNSUBSCRIBE packet. The SUBSCRIBE goes first, so a
+        topic moving from a dropped filter to a new one is never uncovered.
+        """
+        for topic_filter in subscriptions:
+            topics.validate_filter(topic_filter)
+        with self._subscription_lock:
+            self.subscriptions = dict(subscriptions)
+            wanted = topics.minimal_cover(self.subscriptions)
+            current = self._broker_subscriptions
+            to_unsubscribe = [t for t in current if t not in wanted]
+            to_subscribe = [(t, q) for t, q in wanted.items() if current.get(t) != q]
+            if to_subscribe:
+                self.client.subscribe(to_subscribe)
+            if to_unsubscribe:
+                self.client.unsubscribe(to_unsubscribe)
+            self._broker_subscriptions = wanted
+        if to_subscribe or to_unsubscribe:
+            log.info(
+                "%s: subscribed %s, unsubscribed %s",
+                self.name,
+                [t for t, _ in to_subscribe],
+                to_unsubscribe,
+            )
+
+    def add_subscription(self, topic, qos=0):
+        """Subscribe to one more topic filter (empty means all topics)."""
+        self.set_subscriptions({**self.subscriptions, (topic or "#"): qos})
+
+    def remove_subscription(self, topic):
+        """Unsubscribe from a single topic filter."""
+        remaining = dict(self.subscriptions)
+        remaining.pop(topic, None)
+        self.set_subscriptions(remaining)
 
-        target = topic if topic else "#"
-        print(f"Subscribing to {target} on {self.name}", flush=True)
-        self.client.subscribe(target)
-        self.subscribed_topics.add(target)
+    def update_subscription(self, topic, qos=0):
+        """Replace every subscription of this client with a single topic."""
+        self.set_subscriptions({(topic or "#"): qos})
 
     def clear_subscription(self):
         """Unsubscribe from all topics."""
-        if self.subscribed_topics:
-            for t in list(self.subscribed_topics):
-                self.client.unsubscribe(t)
-            self.subscribed_topics.clear()
-            print(f"Cleared subscriptions on {self.name}", flush=True)
+        self.set_subscriptions({})
 
     def publish(self, topic, payload, qos=0, retain=False):
-        """Publish a message to a specific MQTT topic."""
-        self.client.publish(topic, payload, qos=qos, retain=retain)
+        """Publish a message to a specific MQTT topic.
+
+        Returns the PublishRecord tracking its completion; a non-zero `rc`
+        means paho refused it (not connected, queue full).
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        sent_ns = time.monotonic_ns()
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        self.stats.published += 1
+        if isinstance(payload, (bytes, bytearray)):
+            self.stats.published_bytes += len(payload)
+        rc = info.rc
+        if qos and rc == mqtt.MQTT_ERR_NO_CONN:
+            # paho keeps QoS 1/2 messages and sends them once connected
+            rc = mqtt.MQTT_ERR_SUCCESS
+        return self.publishes.track(info.mid, rc, topic, qos, sent_ns)
+
+    def publish_status(self, publish_id, wait=0):
+        """Status of a pending or recent publish, or None if unknown.
+
+        A pending publish is first given up to `wait` seconds to complete.
+        """
+        if wait:
+            record = self.publishes.wait(publish_id, wait)
+        else:
+            record = self.publishes.get(publish_id)
+        return record.to_dict() if record else None
+
+    def publish_summary(self):
+        """In-flight window, completion counts and latencies of publishes."""
+        return {
+            "max_inflight": MQTT_MAX_INFLIGHT,
+            "max_queued": MQTT_MAX_QUEUED,
+            "inflight": getattr(self.client, "_inflight_messages", 0),
+            **self.publishes.summary(),
+        }
+
+    def publish_many(self, messages):
+        """Publish a list of bulk messages (see loadgen.parse_message)."""
+        return loadgen.publish_many(self, messages)
+
+    def start_load(self, params):
+        """Start a load job on this broker and return its status (see loadgen)."""
+        return loadgen.start_job(self, params).status()
+
+    def topic_tree(self, path=None):
+        """The topic tree node at `path` with its children (see topic_tree)."""
+        return self.tree.subtree(path)
 
     def on_connect(self, client, userdata, flags, rc):
         """Callback for when the client connects to the broker."""
         if rc == 0:
             self.is_connected = True
             self.connection_error = None
-            print(
-                f"[{datetime.now().strftime('%H:%M:%S')}] {self.name}: Connected!",
-                flush=True,
-            )
+            self.stats.connects += 1
+            # A clean session forgets subscriptions, so restore them on reconnect
+            with self._subscription_lock:
+                if self._broker_subscriptions:
+                    self.client.subscribe(list(self._broker_subscriptions.items()))
+            log.info("%s: Connected!", self.name)
         else:
             self.is_connected = False
             self.connection_error = f"Connection failed code {rc}"
-            print(self.connection_error, flush=True)
+            log.warning("%s: %s", self.name, self.connection_error)
+
+    def on_connect_fail(self, client, userdata):
+        """Callback for when paho's retry of a failed connection fails again."""
+        if not self.connection_error:
+            self.connection_error = f"Cannot connect to {self.ip}:{self.port}"
 
     def on_message(self, client, userdata, msg):
         """Callback for when a message is received from the broker."""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        try:
-            payload_str = msg.payload.decode()
-        except Exception:
-            payload_str = str(msg.payload)
-
-        data = {
-            "broker_id": self.broker_id,
-            "broker_name": self.name,
-            "timestamp": timestamp,
-            "topic": msg.topic,
-            "payload": payload_str,
-        }
+        # The payload stays raw bytes; it is encoded once, when a stream
+        # first sends the message
+        message = messages.Message(
+            next(_message_ids), self.broker_id, msg.topic, msg.payload
+        )
+
+        self.stats.received += 1
+        self.stats.received_bytes += len(msg.payload)
+        self.ring.append(message.id, message, len(msg.topic) + len(msg.payload) + 100)
+        broadcast_message(self.user_id, message)
+        self.tree.record(msg.topic, msg.payload, message.time_ns, message.mono_ns)
+        history.record(
+            self.broker_id,
+            msg.topic,
+            msg.payload,
+            msg.qos,
+            msg.retain,
+            message.time_ns / 1e9,
+        )
+        logs.log_message(self.name, message)
 
-        broadcast_message(self.user_id, data)
-        print(f"[{timestamp}] {self.name} | {msg.topic}: {payload_str}", flush=True)
+    def on_publish(self, client, userdata, mid):
+        """Callback for when a publish is done (sent for QoS 0, acked for 1 and 2)."""
+        self.publishes.complete(mid)
 
     def on_disconnect(self, client, userdata, rc):
         """Callback for when the client disconnects from the broker."""
         self.is_connected = False
-        print(f"{self.name} disconnected. RC: {rc}", flush=True)
+        self.stats.disconnects += 1
+        log.info("%s disconnected. RC: %s", self.name, rc)
+
+
+def replay_messages(
+    user_id, after_id=None, limit=REPLAY_ON_CONNECT, topic_filters=(), broker_ids=None
+):
+    """Collect buffered messages of a user's brokers for a (re)connecting stream.
+
+    With `after_id` (the stream's Last-Event-ID) every newer buffered message
+    is returned; otherwise only the latest `limit` ones. Messages are filtered
+    like the stream's live subscription.
+    """
+    sub = _Subscription(None, topic_filters, broker_ids)
+    found = []
+    for client in connected_clients.for_user(user_id):
+        if sub.broker_ids is None or client.broker_id in sub.broker_ids:
+            found.extend(
+                entry
+                for entry in client.ring.since(after_id)
+                if sub.wants(client.broker_id, entry[1].topic)
+            )
+    found.sort(key=lambda entry: entry[0])
+    if after_id is None:
+        found = found[-limit:] if limit else []
+    return [message for _, message in found]
 
 
 def get_client(broker_id):
@@ -133,6 +712,11 @@ def get_client(broker_id):
     return connected_clients.get(int(broker_id))
 
 
+def user_clients(user_id):
+    """Active clients of a user's brokers, by broker ID."""
+    return {client.broker_id: client for client in connected_clients.for_user(user_id)}
+
+
 def add_client(broker_obj):
     """Create and store a new active client for a broker."""
     if broker_obj.id in connected_clients:
@@ -157,5 +741,5 @@ def remove_client(broker_id):
         try:
             connected_clients[broker_id].disconnect()
         except Exception:
-            pass
+            log.exception("Error disconnecting broker %s", broker_id)
         del connected_clients[broker_id]
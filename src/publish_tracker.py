@@ -0,0 +1,199 @@
+"""Completion tracking of the messages a broker client publishes.
+
+paho reports a publish done through `on_publish` with its message id (mid):
+once written out for QoS 0, on PUBACK for QoS 1 and on PUBCOMP for QoS 2.
+The tracker keeps every publish not yet done in an in-flight table keyed by
+mid, the latest PUBLISH_TRACK_RECENT completed ones for status lookups, and
+a histogram of the completion latency per QoS level.
+
+Publish ids are assigned here and, unlike mids (which wrap at 65535 and are
+reused), identify a publish for the lifetime of the process.
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# Completed publishes kept per broker for status lookups
+PUBLISH_TRACK_RECENT = 1000
+# Acks of unknown mids remembered before they are discarded
+_MAX_EARLY = 1000
+
+_publish_ids = itertools.count(1)
+
+PENDING = "pending"
+ACKED = "acked"
+FAILED = "failed"
+
+
+def _latency_summary(hist):
+    """Count, mean and estimated percentiles, in ms, of a latency Histogram."""
+    count = hist.count
+    if not count:
+        return {"count": 0}
+    summary = {"count": count, "mean": round(hist.sum_ns / count / 1e6, 3)}
+    for q in (0.5, 0.95, 0.99):
+        summary[f"p{round(q * 100)}"] = round(hist.quantile(q) * 1e3, 3)
+    return summary
+
+
+class PublishRecord:
+    """One published message and its completion."""
+
+    __slots__ = ("id", "mid", "rc", "topic", "qos", "sent_ns", "acked_ns")
+
+    def __init__(self, mid, rc, topic, qos, sent_ns):
+        """Initialize a PublishRecord for a message handed to paho at `sent_ns`."""
+        self.id = next(_publish_ids)
+        self.mid = mid
+        self.rc = rc
+        self.topic = topic
+        self.qos = qos
+        self.sent_ns = sent_ns
+        self.acked_ns = None
+
+    @property
+    def state(self):
+        """`pending`, `acked` or `failed` (refused by paho, see `rc`)."""
+        if self.rc:
+            return FAILED
+        return PENDING if self.acked_ns is None else ACKED
+
+    def to_dict(self):
+        """JSON-ready status of the publish."""
+        ack_ms = None
+        if self.acked_ns is not None:
+            ack_ms = round((self.acked_ns - self.sent_ns) / 1e6, 3)
+        return {
+            "id": self.id,
+            "mid": self.mid,
+            "rc": int(self.rc),
+            "topic": self.topic,
+            "qos": self.qos,
+            "state": self.state,
+            "ack_ms": ack_ms,
+        }
+
+
+class PublishTracker:
+    """In-flight table and completion statistics of one broker client.
+
+    `listeners` are called with each record once it is acked.
+    """
+
+    def __init__(self, listeners=None, recent=PUBLISH_TRACK_RECENT):
+        """Initialize an empty PublishTracker."""
+        self.listeners = listeners if listeners is not None else []
+        self.recent = recent
+        self.acked = [0, 0, 0]
+        self.failed = 0
+        self.latency = tuple(metrics.Histogram() for _ in range(3))
+        self._inflight = {}
+        # The same in-flight records by publish id, for status lookups
+        self._inflight_ids = {}
+        # Acks that arrived before publish() returned their mid
+        self._early = {}
+        # Events of the pending publishes someone waits for, by publish id
+        self._waiters = {}
+        self._completed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def track(self, mid, rc, topic, qos, sent_ns):
+        """Record a message just handed to paho and return its PublishRecord."""
+        record = PublishRecord(mid, rc, topic, qos, sent_ns)
+        if rc:
+            with self._lock:
+                self.failed += 1
+                self._remember(record)
+            return record
+        with self._lock:
+            acked_ns = self._early.pop(mid, None)
+            if acked_ns is None:
+                replaced = self._inflight.get(mid)
+                if replaced is not None:
+                    del self._inflight_ids[replaced.id]
+                self._inflight[mid] = record
+                self._inflight_ids[record.id] = record
+        if acked_ns is not None:
+            self._complete(record, acked_ns)
+        return record
+
+    def complete(self, mid):
+        """paho is done with message `mid` (called from on_publish)."""
+        now = time.monotonic_ns()
+        with self._lock:
+            record = self._inflight.pop(mid, None)
+            if record is None:
+                if len(self._early) >= _MAX_EARLY:
+                    self._early.clear()
+                self._early[mid] = now
+                return
+        self._complete(record, now)
+
+    def _complete(self, record, acked_ns):
+        record.acked_ns = acked_ns
+        self.acked[record.qos] += 1
+        self.latency[record.qos].observe_ns(acked_ns - record.sent_ns)
+        with self._lock:
+            # Moved in one step, so lookups never miss a completing publish
+            self._inflight_ids.pop(record.id, None)
+            self._remember(record)
+            done = self._waiters.pop(record.id, None)
+        if done is not None:
+            done.set()
+        for listener in self.listeners:
+            listener(record)
+
+    def _remember(self, record):
+        completed = self._completed
+        completed[record.id] = record
+        if len(completed) > self.recent:
+            completed.popitem(last=False)
+
+    def get(self, publish_id):
+        """The record of a pending or recently completed publish, or None."""
+        with self._lock:
+            record = self._completed.get(publish_id)
+            if record is None:
+                record = self._inflight_ids.get(publish_id)
+        return record
+
+    def wait(self, publish_id, timeout):
+        """Like get(), but first wait up to `timeout` s for a pending publish."""
+        with self._lock:
+            record = self._inflight_ids.get(publish_id)
+            if record is None:
+                return self._completed.get(publish_id)
+            done = self._waiters.setdefault(publish_id, threading.Event())
+        if not done.wait(timeout):
+            with self._lock:
+                if self._waiters.get(publish_id) is done:
+                    del self._waiters[publish_id]
+        return self.get(publish_id)
+
+    def pending(self):
+        """Publishes awaiting completion, per QoS level."""
+        counts = [0, 0, 0]
+        with self._lock:
+            for record in self._inflight.values():
+                counts[record.qos] += 1
+        return counts
+
+    def summary(self, recent=20):
+        """JSON-ready totals, completion latencies and the latest publishes."""
+        pending = self.pending()
+        with self._lock:
+            latest = list(self._completed.values())[-recent:]
+        return {
+            "pending": {str(q): n for q, n in enumerate(pending)},
+            "acked": {str(q): n for q, n in enumerate(self.acked)},
+            "failed": self.failed,
+            "ack_ms": {
+                str(qos): _latency_summary(hist)
+                for qos, hist in enumerate(self.latency)
+            },
+            "recent": [record.to_dict() for record in reversed(latest)],
+        }
@@ -0,0 +1,63 @@
+"""Broker client registry used by the web app.
+
+The registry owns the broker connections and their replay buffers. Two
+backends implement the same interface (get_client, user_clients,
+add_client, remove_client, replay_messages, broker_metrics):
+
+- LocalRegistry keeps the clients in this process. This is only correct
+  with a single web worker.
+- ingest.IngestClient keeps them in the ingestion process. Every web worker
+  connects to it, so broker state and received messages are shared by all
+  workers.
+"""
+
+import ingest
+import loadgen
+import metrics
+import mqtt_manager
+
+
+class LocalRegistry:
+    """Registry of the broker clients living in this process."""
+
+    shared = False
+
+    def start(self):
+        """Nothing to start: clients are created on demand."""
+
+    def get_client(self, broker_id):
+        """Retrieve an active client by broker ID."""
+        return mqtt_manager.get_client(broker_id)
+
+    def user_clients(self, user_id):
+        """Active clients of a user's brokers, by broker ID."""
+        return mqtt_manager.user_clients(user_id)
+
+    def add_client(self, broker_obj):
+        """Create and register a client for a broker."""
+        return mqtt_manager.add_client(broker_obj)
+
+    def remove_client(self, broker_id):
+        """Disconnect and unregister a broker's client."""
+        mqtt_manager.remove_client(broker_id)
+
+    def replay_messages(self, user_id, *args, **kwargs):
+        """Buffered messages of the user's brokers (see mqtt_manager)."""
+        return mqtt_manager.replay_messages(user_id, *args, **kwargs)
+
+    def load_job(self, job_id, stop=False):
+        """Status of a load job, or None if unknown (see loadgen)."""
+        job = loadgen.stop_job(job_id) if stop else loadgen.get_job(job_id)
+        return job.status() if job else None
+
+    def broker_metrics(self):
+        """Broker metrics of this process, in the Prometheus format."""
+        return metrics.render_brokers(list(mqtt_manager.connected_clients.values()))
+
+
+def create_registry(ingest_socket=None):
+    """Return the registry backend selected by INGEST_SOCKET."""
+    ingest_socket = ingest_socket or ingest.INGEST_SOCKET
+    if ingest_socket:
+        return ingest.IngestClient(ingest_socket)
+    return LocalRegistry()
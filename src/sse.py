@@ -0,0 +1,288 @@
+import json
+import math
+import os
+import queue
+import time
+from collections import OrderedDict
+
+import metrics
+from messages import message_frame, message_json
+
+# Seconds without traffic before a keepalive comment is sent
+KEEPALIVE_INTERVAL = 20
+
+# Seconds between "dropped N messages" reports for an overflowing listener
+DROP_REPORT_INTERVAL = float(os.environ.get("DROP_REPORT_INTERVAL", "5"))
+
+# Seconds between updates of a topic in "latest value" mode
+LATEST_INTERVAL = float(os.environ.get("LATEST_INTERVAL", "0.5"))
+# Bounds of the interval a "latest value" stream may ask for
+MIN_LATEST_INTERVAL = 0.05
+MAX_LATEST_INTERVAL = 60
+# Topics a "latest value" stream updates per interval; the least recently
+# updated beyond it are skipped and reported as dropped
+LATEST_MAX_TOPICS = int(os.environ.get("LATEST_MAX_TOPICS", "10000"))
+
+# Batching budget: a batch is flushed once it holds this many messages...
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "500"))
+# ...or once this many seconds passed since its first message arrived
+STREAM_BATCH_INTERVAL = float(os.environ.get("STREAM_BATCH_INTERVAL", "0.05"))
+
+
+def drain_batch(q, first, max_size, max_wait, dequeued=None):
+    """Collect queued messages after `first` until the size or time budget runs out.
+
+    If `dequeued` is a list, the monotonic time (ns) at which each message
+    after `first` was taken from the queue is appended to it.
+    """
+    batch = [first]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_size:
+        try:
+            batch.append(q.get_nowait())
+        except queue.Empty:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        if dequeued is not None:
+            dequeued.append(time.monotonic_ns())
+    return batch
+
+
+def batch_frame(messages):
+    """Encode messages as one `batch` event whose id is the last message's.
+
+    The array is joined from each message's cached JSON, so a message shared
+    by several streams is only encoded once.
+    """
+    data = b",".join([message_json(msg) for msg in messages])
+    return b"id: %d\nevent: batch\ndata: [%s]\n\n" % (messages[-1].id, data)
+
+
+def trace_frame(messages, dequeued, written_ns):
+    """Encode the timing of messages whose frame is being written as a `trace` event.
+
+    For each message: microseconds spent waiting in the listener queue
+    (arrival to dequeue) and in this process (arrival to write). `sent` is
+    the wall-clock write time, for the browser to split off the network.
+    """
+    data = {
+        "sent": time.time(),
+        "ids": [msg.id for msg in messages],
+        "queue_us": [(t - msg.mono_ns) // 1000 for msg, t in zip(messages, dequeued)],
+        "server_us": [(written_ns - msg.mono_ns) // 1000 for msg in messages],
+    }
+    return b"event: trace\ndata: %s\n\n" % json.dumps(data).encode()
+
+
+def message_events(
+    q,
+    batch=False,
+    max_size=STREAM_BATCH_SIZE,
+    max_wait=STREAM_BATCH_INTERVAL,
+    keepalive=KEEPALIVE_INTERVAL,
+    drop_interval=DROP_REPORT_INTERVAL,
+    replay=(),
+    trace=False,
+):
+    """Yield SSE frames (bytes) for the messages arriving on a listener queue.
+
+    `replay` messages (from the brokers' ring buffers) are sent first; the
+    same messages arriving again through the queue are skipped. In batch mode
+    every frame is a `batch` event carrying a JSON array, so a busy
+    subscription costs one encode and one write per batch instead of one per
+    message. Messages discarded by the queue's overflow policy are reported
+    with a periodic `dropped` event. With `trace`, every data frame is
+    followed by a `trace` event carrying the timing of its messages.
+    """
+    replayed = {msg.id for msg in replay}
+    if replay:
+        if batch:
+            for i in range(0, len(replay), max_size):
+                yield batch_frame(replay[i : i + max_size])
+        else:
+            for msg in replay:
+                yield message_frame(msg)
+
+    last_write = last_report = time.monotonic()
+    while True:
+        try:
+            msg = q.get(timeout=min(keepalive, drop_interval))
+        except queue.Empty:
+            msg = None
+
+        if msg is not None:
+            if batch:
+                dequeued = [time.monotonic_ns()]
+                messages = drain_batch(q, msg, max_size, max_wait, dequeued)
+                if replayed:
+                    kept = [i for i, m in enumerate(messages) if m.id not in replayed]
+                    messages = [messages[i] for i in kept]
+                    dequeued = [dequeued[i] for i in kept]
+                if messages:
+                    metrics.observe_queue_wait(messages, dequeued)
+                    frame = batch_frame(messages)
+                    if trace:
+                        frame += trace_frame(messages, dequeued, time.monotonic_ns())
+                    yield frame
+                    metrics.observe_delivery(messages)
+                    last_write = time.monotonic()
+            elif msg.id not in replayed:
+                dequeued_ns = time.monotonic_ns()
+                metrics.queue_wait.observe_ns(dequeued_ns - msg.mono_ns)
+                frame = message_frame(msg)
+                if trace:
+                    frame += trace_frame([msg], [dequeued_ns], time.monotonic_ns())
+                yield frame
+                metrics.delivery_latency.observe_ns(time.monotonic_ns() - msg.mono_ns)
+                last_write = time.monotonic()
+
+        now = time.monotonic()
+        if now - last_report >= drop_interval:
+            last_report = now
+            dropped = q.take_dropped()
+            if dropped:
+                data = json.dumps({"dropped": dropped})
+                yield f"event: dropped\ndata: {data}\n\n".encode()
+                last_write = now
+
+        if now - last_write >= keepalive:
+            yield b": keepalive\n\n"
+            last_write = now
+
+
+class _TopicState:
+    """Latest message of one topic, as its (truncated) JSON, and its counts."""
+
+    __slots__ = ("id", "json", "pending", "count", "rate")
+
+    def __init__(self):
+        self.id = 0
+        self.json = None
+        self.pending = 0
+        self.count = 0
+        self.rate = 0.0
+
+    def update(self, msg):
+        """Fold in a newer message of the topic."""
+        self.id = msg.id
+        self.json = message_json(msg)
+        self.pending += 1
+        self.count += 1
+
+
+def latest_interval(value):
+    """Parse a requested "latest value" interval, clamped to the allowed range.
+
+    Raises ValueError if `value` is not a finite number of seconds.
+    """
+    interval = float(value)
+    if not math.isfinite(interval):
+        raise ValueError(f"Interval must be a finite number: {value}")
+    return min(MAX_LATEST_INTERVAL, max(MIN_LATEST_INTERVAL, interval))
+
+
+def latest_frame(states, elapsed):
+    """Encode a `latest` event updating the given topics, resetting their counts.
+
+    Each entry wraps the topic's latest message (its cached JSON) with the
+    number of messages received on the topic and their rate over `elapsed`
+    seconds.
+    """
+    entries = []
+    for state in states:
+        state.rate = state.pending / elapsed if elapsed > 0 else 0.0
+        state.pending = 0
+        entries.append(
+            b'{"rate":%.2f,"count":%d,"message":%s}'
+            % (state.rate, state.count, state.json)
+        )
+    last_id = max(state.id for state in states)
+    return b"id: %d\nevent: latest\ndata: [%s]\n\n" % (last_id, b",".join(entries))
+
+
+def latest_events(
+    q,
+    interval=LATEST_INTERVAL,
+    keepalive=KEEPALIVE_INTERVAL,
+    drop_interval=DROP_REPORT_INTERVAL,
+    replay=(),
+    max_topics=LATEST_MAX_TOPICS,
+):
+    """Yield SSE frames keeping only the latest message of every topic.
+
+    Messages are folded per (broker, topic) as they are dequeued and at most
+    every `interval` seconds a `latest` event carries the topics that
+    changed, each once. A topic that went quiet gets one last update with
+    a zero rate and is then forgotten, so its count starts over if it comes
+    back. At most `max_topics` topics are held per interval. `replay`
+    messages seed the table.
+    """
+    # Topics updated since the last frame, least recently updated first
+    changed = OrderedDict()
+    for msg in replay:
+        key = (msg.broker_id, msg.topic)
+        state = changed.get(key) or _TopicState()
+        state.update(msg)
+        state.pending = state.count = 0
+        changed[key] = state
+    if changed:
+        yield latest_frame(list(changed.values()), interval)
+        changed.clear()
+    replayed = {msg.id for msg in replay}
+
+    # Topics reported with a non-zero rate in the last frame
+    active = {}
+    evicted = 0
+    last_flush = last_write = last_report = time.monotonic()
+    while True:
+        timeout = min(
+            keepalive, drop_interval, last_flush + interval - time.monotonic()
+        )
+        try:
+            msg = q.get(timeout=max(0, timeout))
+        except queue.Empty:
+            msg = None
+        if msg is not None and msg.id not in replayed:
+            key = (msg.broker_id, msg.topic)
+            state = changed.get(key)
+            if state is None:
+                state = active.get(key) or _TopicState()
+                changed[key] = state
+                if len(changed) > max_topics:
+                    old_key, old = changed.popitem(last=False)
+                    active.pop(old_key, None)
+                    evicted += old.pending
+            else:
+                changed.move_to_end(key)
+            state.update(msg)
+
+        now = time.monotonic()
+        if now - last_flush >= interval:
+            # Topics updated last time but silent since then report rate 0
+            for key, state in active.items():
+                if key not in changed:
+                    changed[key] = state
+            if changed:
+                yield latest_frame(list(changed.values()), now - last_flush)
+                active = {key: s for key, s in changed.items() if s.rate}
+                changed = OrderedDict()
+                last_write = now
+            last_flush = now
+
+        if now - last_report >= drop_interval:
+            last_report = now
+            dropped = q.take_dropped() + evicted
+            evicted = 0
+            if dropped:
+                data = json.dumps({"dropped": dropped})
+                yield f"event: dropped\ndata: {data}\n\n".encode()
+                last_write = now
+
+        if now - last_write >= keepalive:
+            yield b": keepalive\n\n"
+            last_write = now
@@ -0,0 +1,178 @@
+"""Per-broker tree of the topics seen, with aggregated statistics.
+
+Every received message walks the tree along its topic levels, bumping the
+message count of each node on the way, so a node's count covers its whole
+subtree. The node of the topic itself also keeps the latest payload (cut to
+TOPIC_TREE_PAYLOAD_BYTES) and its receive time. Rates are counted over
+windows of RATE_WINDOW seconds.
+
+The tree remembers at most TOPIC_TREE_MAX_TOPICS topics per broker: past
+that, the topic updated least recently loses its payload and, if it has no
+subtopics, its node is removed along with any ancestors left empty. Counts
+of the ancestors still include the messages of evicted topics.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import messages
+
+# Topics remembered per broker before the least recently updated are evicted
+TOPIC_TREE_MAX_TOPICS = int(os.environ.get("TOPIC_TREE_MAX_TOPICS", "10000"))
+# Bytes of the latest payload kept for each topic
+TOPIC_TREE_PAYLOAD_BYTES = max(
+    1, int(os.environ.get("TOPIC_TREE_PAYLOAD_BYTES", "256"))
+)
+
+# Seconds over which message rates are counted
+RATE_WINDOW = 10
+_RATE_WINDOW_NS = RATE_WINDOW * 1_000_000_000
+
+
+class _Node:
+    __slots__ = (
+        "name",
+        "parent",
+        "children",
+        "count",
+        "payload",
+        "size",
+        "time_ns",
+        "window_start",
+        "window_count",
+        "rate",
+    )
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = None
+        self.count = 0
+        # Latest message on this exact topic (None for a pure branch)
+        self.payload = None
+        self.size = 0
+        self.time_ns = 0
+        self.window_start = None
+        self.window_count = 0
+        self.rate = 0.0
+
+    def tick(self, mono_ns):
+        """Count one message in the subtree and roll the rate window."""
+        self.count += 1
+        if self.window_start is None:
+            self.window_start = mono_ns
+        elif mono_ns - self.window_start >= _RATE_WINDOW_NS:
+            self.rate = self.window_count * 1e9 / (mono_ns - self.window_start)
+            self.window_start = mono_ns
+            self.window_count = 0
+        self.window_count += 1
+
+    def current_rate(self, mono_ns):
+        """Messages per second over the last complete window, 0 once stale."""
+        if (
+            self.window_start is None
+            or mono_ns - self.window_start >= 2 * _RATE_WINDOW_NS
+        ):
+            return 0.0
+        return self.rate
+
+
+class TopicTree:
+    """Topic tree of one broker, bounded to `max_topics` topics."""
+
+    def __init__(
+        self, max_topics=TOPIC_TREE_MAX_TOPICS, payload_bytes=TOPIC_TREE_PAYLOAD_BYTES
+    ):
+        """Initialize an empty TopicTree."""
+        self.max_topics = max_topics
+        self.payload_bytes = payload_bytes
+        self.root = _Node("", None)
+        self.evicted = 0
+        # Topic nodes, least recently updated first
+        self._topics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._topics)
+
+    def record(self, topic, payload, time_ns, mono_ns):
+        """Account for one message received on `topic`."""
+        with self._lock:
+            node = self.root
+            node.tick(mono_ns)
+            for level in topic.split("/"):
+                children = node.children
+                if children is None:
+                    children = node.children = {}
+                child = children.get(level)
+                if child is None:
+                    child = children[level] = _Node(level, node)
+                node = child
+                node.tick(mono_ns)
+            # One byte more than shown, so a cut payload is flagged as such
+            node.payload = bytes(payload[: self.payload_bytes + 1])
+            node.size = len(payload)
+            node.time_ns = time_ns
+            topics = self._topics
+            if topic in topics:
+                topics.move_to_end(topic)
+            else:
+                topics[topic] = node
+                if len(topics) > self.max_topics:
+                    self._evict(topics.popitem(last=False)[1])
+
+    def _evict(self, node):
+        self.evicted += 1
+        node.payload = None
+        while node.parent is not None and not node.children and node.payload is None:
+            del node.parent.children[node.name]
+            node = node.parent
+
+    def _find(self, path):
+        node = self.root
+        if path is not None:
+            for level in path.split("/"):
+                node = (node.children or {}).get(level)
+                if node is None:
+                    return None
+        return node
+
+    def subtree(self, path=None, mono_ns=None):
+        """Describe the node at `path` and its direct children, or None.
+
+        `path` is a topic or topic prefix, None for the root ("" is the
+        empty first level of topics such as "/a"). Children are only listed
+        one level deep; callers expand them with further calls.
+        """
+        with self._lock:
+            node = self._find(path)
+            if node is None:
+                return None
+            now = time.monotonic_ns() if mono_ns is None else mono_ns
+            info = self._describe(node, path, now)
+            info["children"] = [
+                self._describe(child, name if path is None else f"{path}/{name}", now)
+                for name, child in sorted((node.children or {}).items())
+            ]
+            info["topics"] = len(self._topics)
+            info["evicted"] = self.evicted
+            return info
+
+    def _describe(self, node, path, now):
+        info = {
+            "path": path,
+            "name": node.name,
+            "count": node.count,
+            "rate": round(node.current_rate(now), 3),
+            "subtopics": len(node.children or ()),
+        }
+        if node.payload is not None:
+            info["message"] = {
+                "ts": node.time_ns / 1e9,
+                "timestamp": messages.format_time(node.time_ns),
+                **messages.payload_fields(node.payload, self.payload_bytes),
+                "size": node.size,
+            }
+        return info
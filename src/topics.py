@@ -0,0 +1,136 @@
+def validate_filter(topic_filter):
+    """Raise ValueError unless `topic_filter` is a valid MQTT topic filter."""
+    if not topic_filter:
+        raise ValueError("Topic filter must not be empty")
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if "#" in level and (level != "#" or i != len(levels) - 1):
+            raise ValueError(f"'#' must be the last level of a filter: {topic_filter}")
+        if "+" in level and level != "+":
+            raise ValueError(f"'+' must occupy a whole level: {topic_filter}")
+
+
+def matches(topic_filter, topic):
+    """Return True if `topic` matches the MQTT `topic_filter`."""
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def literal_prefix(topic_filter):
+    """Split a filter into its leading wildcard-free levels and the first wildcard.
+
+    `plant/+/temp` gives `("plant", "+")`, `a/b` gives `("a/b", None)`.
+    """
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if level in ("+", "#"):
+            return "/".join(levels[:i]), level
+    return topic_filter, None
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie:
+    """Trie of MQTT topic filters keyed on topic levels.
+
+    Matching a topic walks at most the literal, `+` and `#` branches of each
+    level, so its cost depends on the topic depth rather than on how many
+    filters are stored.
+    """
+
+    def __init__(self):
+        """Initialize an empty TopicTrie."""
+        self.root = _Node()
+
+    def insert(self, topic_filter, value):
+        """Store `value` under `topic_filter`."""
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.values.append(value)
+
+    def match(self, topic):
+        """Return the values of every filter matching `topic` (may repeat)."""
+        found = []
+        nodes = [self.root]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if "#" in children:
+                    found.extend(children["#"].values)
+                if level in children:
+                    next_nodes.append(children[level])
+                if "+" in children:
+                    next_nodes.append(children["+"])
+            if not next_nodes:
+                return found
+            nodes = next_nodes
+        for node in nodes:
+            found.extend(node.values)
+            # "a/#" also matches "a"
+            if "#" in node.children:
+                found.extend(node.children["#"].values)
+        return found
+
+
+def covers(general, specific):
+    """Return True if every topic matched by `specific` is matched by `general`."""
+    g_levels = general.split("/")
+    s_levels = specific.split("/")
+    for i, level in enumerate(g_levels):
+        if level == "#":
+            return True
+        if i >= len(s_levels):
+            return False
+        if s_levels[i] == "#":
+            return False
+        if level != "+" and (s_levels[i] == "+" or level != s_levels[i]):
+            return False
+    return len(s_levels) == len(g_levels)
+
+
+def minimal_cover(subscriptions):
+    """Reduce `{filter: qos}` to the filters not covered by another one.
+
+    A covered filter is dropped and its QoS folded into the covering filter,
+    so overlapping subscriptions like `a/#` and `a/b` are only sent to the
+    broker once and every message is delivered once at the highest QoS asked.
+    """
+    kept = {}
+    # Broader filters first, so each filter is compared with the ones kept so far
+    for topic_filter in sorted(subscriptions, key=_breadth):
+        qos = subscriptions[topic_filter]
+        for other in kept:
+            if covers(other, topic_filter):
+                kept[other] = max(kept[other], qos)
+                break
+        else:
+            kept[topic_filter] = qos
+    return kept
+
+
+def _breadth(topic_filter):
+    """Sort key placing filters before the ones they might cover."""
+    levels = topic_filter.split("/")
+    has_hash = levels[-1] == "#"
+    return (
+        len(levels) - has_hash,
+        not has_hash,
+        sum(level != "+" for level in levels),
+        topic_filter,
+    )
@@ -0,0 +1,103 @@
+"""Startup connection of 100 saved brokers, some of them unreachable.
+
+Up brokers are served by a stub MQTT broker; down brokers point at
+BENCH_DOWN_HOST, a non-routable address where the TCP connect hangs until
+MQTT_CONNECT_TIMEOUT (on networks that reject it at once, every mode is
+fast). For each share of down brokers the benchmark reports the time to
+start every connection and the time until every up broker is connected,
+for connections started without waiting (as at startup) and one after the
+other, each waiting for its first attempt (the old blocking connect).
+
+Run with: python tests/benchmarks/bench_connect.py
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+import mqtt_manager  # noqa: E402
+from mqtt_manager import ActiveClient  # noqa: E402
+
+BROKERS = int(os.environ.get("BENCH_CONNECT_BROKERS", "100"))
+DOWN_SHARES = [
+    float(s) for s in os.environ.get("BENCH_CONNECT_DOWN", "0,0.1,0.5").split(",")
+]
+DOWN_HOST = os.environ.get("BENCH_DOWN_HOST", "10.255.255.1")
+# Shorter than the default so the serial runs stay bearable
+mqtt_manager.MQTT_CONNECT_TIMEOUT = float(os.environ.get("MQTT_CONNECT_TIMEOUT", "2"))
+
+
+async def _serve_client(reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(2)
+            await reader.readexactly(header[1])
+            kind = header[0] >> 4
+            if kind == 1:  # CONNECT
+                writer.write(b"\x20\x02\x00\x00")
+            elif kind == 12:  # PINGREQ
+                writer.write(b"\xd0\x00")
+            elif kind == 14:  # DISCONNECT
+                break
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.close()
+
+
+def _start_broker():
+    ready = threading.Event()
+    port = []
+    loop = asyncio.new_event_loop()
+
+    async def main():
+        server = await asyncio.start_server(_serve_client, "127.0.0.1", 0, backlog=1024)
+        port.append(server.sockets[0].getsockname()[1])
+        ready.set()
+        await server.serve_forever()
+
+    threading.Thread(
+        target=loop.run_until_complete, args=(main(),), daemon=True
+    ).start()
+    ready.wait()
+    return port[0]
+
+
+def run(port, down_share, wait):
+    """Return (start s, all up brokers connected s) for one configuration."""
+    n_down = int(BROKERS * down_share)
+    clients = []
+    start = time.perf_counter()
+    for i in range(BROKERS):
+        host, broker_port = (DOWN_HOST, 1883) if i < n_down else ("127.0.0.1", port)
+        client = ActiveClient(i, 1, f"b{i}", host, broker_port)
+        client.connect(wait=wait)
+        clients.append(client)
+    started = time.perf_counter() - start
+    up = clients[n_down:]
+    while not all(client.is_connected for client in up):
+        time.sleep(0.001)
+    connected = time.perf_counter() - start
+    for client in clients:
+        client.disconnect()
+    return started, connected
+
+
+def main():
+    port = _start_broker()
+    print(f"{BROKERS} brokers, connect timeout {mqtt_manager.MQTT_CONNECT_TIMEOUT}s")
+    print(f"{'down':>6} {'mode':>10} {'started s':>10} {'up s':>8}")
+    for share in DOWN_SHARES:
+        for mode, wait in (("parallel", 0), ("serial", None)):
+            started, connected = run(port, share, wait)
+            print(f"{share:>6.0%} {mode:>10} {started:>10.3f} {connected:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""CPU time per message spent encoding SSE frames, by listener count.
+
+Every message is fanned out to N listener queues, then each listener turns
+its queue into SSE frames the way /stream does (one frame per message, and
+batch frames of STREAM_BATCH_SIZE). "per-listener" encodes the message again
+for every listener, which was the previous behaviour; "once" uses the
+encoding cached on the Message, so the frame is shared.
+
+Run with: python tests/benchmarks/bench_encode.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+import messages  # noqa: E402
+from messages import Message, dumps, message_frame  # noqa: E402
+from mqtt_manager import ListenerQueue  # noqa: E402
+from sse import STREAM_BATCH_SIZE, batch_frame  # noqa: E402
+
+MESSAGES = int(os.environ.get("BENCH_ENCODE_MESSAGES", "5000"))
+LISTENERS = [1, 10, 100]
+PAYLOAD = b'{"temperature": 21.5, "humidity": 40, "status": "ok"}'
+
+
+def make_messages():
+    return [Message(i, 1, f"plant/{i % 50}/state", PAYLOAD) for i in range(MESSAGES)]
+
+
+def encode_each(message):
+    return b"id: %d\ndata: %s\n\n" % (message.id, dumps(message.to_wire()))
+
+
+def encode_batch_each(pending):
+    data = b",".join(dumps(message.to_wire()) for message in pending)
+    return b"id: %d\nevent: batch\ndata: [%s]\n\n" % (pending[-1].id, data)
+
+
+def run(shared, n_listeners, batch):
+    """Return CPU microseconds per message for one configuration."""
+    encode = message_frame if shared else encode_each
+    encode_batch = batch_frame if shared else encode_batch_each
+    queues = [ListenerQueue(maxsize=0) for _ in range(n_listeners)]
+    start = time.process_time()
+    for message in make_messages():
+        for q in queues:
+            q.offer(message)
+    written = 0
+    for q in queues:
+        pending = []
+        while not q.empty():
+            pending.append(q.get_nowait())
+        if batch:
+            for i in range(0, len(pending), STREAM_BATCH_SIZE):
+                written += len(encode_batch(pending[i : i + STREAM_BATCH_SIZE]))
+        else:
+            for message in pending:
+                written += len(encode(message))
+    return (time.process_time() - start) / MESSAGES * 1e6
+
+
+def main():
+    encoder = "orjson" if messages.orjson is not None else "json"
+    print(f"{MESSAGES} messages, encoder: {encoder}")
+    print(
+        f"{'listeners':>10} {'mode':>7} {'per-listener':>13} {'once':>9}"
+        "  (CPU us/message)"
+    )
+    for n in LISTENERS:
+        for batch in (False, True):
+            per_listener = run(False, n, batch)
+            once = run(True, n, batch)
+            mode = "batch" if batch else "single"
+            print(f"{n:>10} {mode:>7} {per_listener:>13.1f} {once:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Fan-out throughput of broadcast_message with concurrent broker threads.
+
+Compares the copy-on-write ListenerRegistry against the previous design (one
+process-wide lock held while iterating the user's queues), with 1, 10 and 100
+listeners, several broker threads publishing and one thread churning
+subscribe/unsubscribe the way /stream does. Also times server-side topic
+filter matching through the compiled trie against checking every filter of
+every listener.
+
+Run with: python tests/benchmarks/bench_fanout.py
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+from messages import Message  # noqa: E402
+from mqtt_manager import (  # noqa: E402
+    ListenerQueue,
+    ListenerRegistry,
+    broadcast_message,
+    listeners,
+)
+from topics import matches  # noqa: E402
+
+USER_ID = 1
+MESSAGES_PER_BROKER = 20_000
+BROKER_THREADS = int(os.environ.get("BENCH_BROKER_THREADS", "4"))
+
+
+class LockedRegistry:
+    """The previous listener registry: a dict of lists behind a global lock."""
+
+    def __init__(self):
+        self.listeners = {}
+        self.lock = threading.Lock()
+
+    def add(self, user_id, q):
+        with self.lock:
+            self.listeners.setdefault(user_id, []).append(q)
+
+    def remove(self, user_id, q):
+        with self.lock:
+            self.listeners[user_id].remove(q)
+            if not self.listeners[user_id]:
+                del self.listeners[user_id]
+
+    def broadcast(self, user_id, message_data):
+        with self.lock:
+            for q in self.listeners.get(user_id, []):
+                q.offer(message_data)
+
+
+def run(n_listeners, broadcast, add, remove):
+    """Return messages/s fanned out by BROKER_THREADS concurrent publishers."""
+    queues = [
+        ListenerQueue(maxsize=100, policy="drop-oldest") for _ in range(n_listeners)
+    ]
+    for q in queues:
+        add(USER_ID, q)
+
+    stop = threading.Event()
+
+    def churn():
+        # A browser tab opening and closing its stream every millisecond
+        while not stop.wait(0.001):
+            q = ListenerQueue(maxsize=1)
+            add(USER_ID, q)
+            remove(USER_ID, q)
+
+    def broker(i):
+        msg = Message(0, i, f"bench/{i}", b"x")
+        for _ in range(MESSAGES_PER_BROKER):
+            broadcast(USER_ID, msg)
+
+    churner = threading.Thread(target=churn)
+    brokers = [
+        threading.Thread(target=broker, args=(i,)) for i in range(BROKER_THREADS)
+    ]
+    churner.start()
+    start = time.perf_counter()
+    for t in brokers:
+        t.start()
+    for t in brokers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    churner.join()
+
+    for q in queues:
+        remove(USER_ID, q)
+    return BROKER_THREADS * MESSAGES_PER_BROKER / elapsed
+
+
+def bench_filters(n_listeners, filters_per_listener=10, lookups=20_000):
+    """Return matches/s for the trie and for a linear scan of all filters."""
+    registry = ListenerRegistry()
+    subs = []
+    for i in range(n_listeners):
+        filters = [f"site/{i}/dev/{j}/+" for j in range(filters_per_listener - 1)]
+        filters.append(f"alarms/{i}/#")
+        q = ListenerQueue(maxsize=1)
+        registry.add(USER_ID, q, filters)
+        subs.append((q, filters))
+
+    topic_names = [f"site/{i % n_listeners}/dev/{i % 7}/temp" for i in range(64)]
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        registry.match(USER_ID, 1, topic_names[i % 64])
+    trie = lookups / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        topic = topic_names[i % 64]
+        [q for q, filters in subs if any(matches(f, topic) for f in filters)]
+    linear = lookups / (time.perf_counter() - start)
+    return trie, linear
+
+
+if __name__ == "__main__":
+    locked = LockedRegistry()
+    print(f"{BROKER_THREADS} broker threads, {MESSAGES_PER_BROKER} msgs each")
+    for n in (1, 10, 100):
+        cow = run(n, broadcast_message, listeners.add, listeners.remove)
+        old = run(n, locked.broadcast, locked.add, locked.remove)
+        print(
+            f"{n:4d} listeners  copy-on-write {cow:10,.0f} msgs/s  "
+            f"global lock {old:10,.0f} msgs/s"
+        )
+
+    print("topic filter matching, 10 filters per listener")
+    for n in (1, 10, 100):
+        trie, linear = bench_filters(n)
+        print(
+            f"{n:4d} listeners  trie {trie:12,.0f} msgs/s  "
+            f"linear scan {linear:12,.0f} msgs/s"
+        )
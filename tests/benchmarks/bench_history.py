@@ -0,0 +1,79 @@
+"""Ingestion rate and query latency of the message history store.
+
+Measures how fast the MQTT callback side can record messages, how fast the
+background writer persists them to the segment files, and how long indexed
+topic/time range queries take over BENCH_HISTORY_ROWS stored messages,
+from exact topics to wildcard and time-only queries over every topic.
+
+Run with: python tests/benchmarks/bench_history.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+from history import HistoryStore  # noqa: E402
+
+TOTAL = 200_000
+ROWS = int(os.environ.get("BENCH_HISTORY_ROWS", "1000000"))
+
+
+def bench_queries(directory):
+    """Fill one hour of history and time typical UI queries."""
+    store = HistoryStore(directory, max_backlog=ROWS, max_age=0, max_bytes=0)
+    base = 36_000.0
+    for i in range(ROWS):
+        store.record(
+            1 + i % 5, f"plant/{i % 200}/temp", b"21.5", ts=base + i * 3600 / ROWS
+        )
+    store.flush()
+
+    queries = {
+        "exact topic, 5 min": ([3], "plant/7/temp", base + 600, base + 900),
+        "plant/+/temp, 5 min": ([3], "plant/+/temp", base + 600, base + 900),
+        "plant/#, all brokers, 1 min": ([1, 2, 3, 4, 5], "plant/#", base, base + 60),
+        "plant/#, 30 min": ([3], "plant/#", base + 600, base + 2400),
+        "any topic, 30 min": ([3], None, base + 600, base + 2400),
+        "any topic, all brokers, all": ([1, 2, 3, 4, 5], None, None, None),
+    }
+    for label, (brokers, topic, start, end) in queries.items():
+        t = time.perf_counter()
+        page, cursor = store.query(brokers, topic, start, end, limit=100)
+        first = time.perf_counter() - t
+        t = time.perf_counter()
+        store.query(brokers, topic, start, end, limit=100, cursor=cursor)
+        second = time.perf_counter() - t
+        print(
+            f"{label:30s} first page {first * 1000:7.1f} ms  "
+            f"next page {second * 1000:7.1f} ms"
+        )
+    store.stop()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore(directory, max_backlog=TOTAL)
+        payload = b'{"value": 21.5, "unit": "C"}'
+
+        start = time.perf_counter()
+        for i in range(TOTAL):
+            store.record(i % 10, f"plant/{i % 100}/temp", payload)
+        recorded = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store.flush()
+        written = time.perf_counter() - start
+        store.stop()
+
+        print(f"record (callback side) {TOTAL / recorded:12,.0f} msgs/s")
+        print(f"writer (batched)       {TOTAL / written:12,.0f} msgs/s")
+        print(f"dropped                {store.dropped:12d}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"queries over {ROWS:,} rows")
+        bench_queries(directory)
@@ -0,0 +1,82 @@
+"""Request rate of the pages and JSON routes polled by the dashboard.
+
+A user with BENCH_PAGES_BROKERS saved brokers requests the broker list,
+the broker status JSON, the publish page and a per-broker ownership check,
+once with the broker cache and once with it reloading on every request
+(the previous behaviour: one or more SQLite queries per request). Queries
+are counted with an engine event.
+
+Run with: python tests/benchmarks/bench_pages.py
+"""
+
+import os
+import sys
+import time
+
+os.environ.setdefault("NO_MONKEY_PATCH", "1")
+os.environ.setdefault("DATABASE_PATH", ":memory:")
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app, saved_brokers  # noqa: E402
+from database import Broker, User, db  # noqa: E402
+
+BROKERS = int(os.environ.get("BENCH_PAGES_BROKERS", "20"))
+REQUESTS = int(os.environ.get("BENCH_PAGES_REQUESTS", "2000"))
+ROUTES = ["/brokers", "/brokers/status", "/publish", "/brokers/{id}/publishes"]
+
+
+def setup():
+    """Create a user with BROKERS brokers in an in-memory database."""
+    app.config["TESTING"] = True
+    db.create_all()
+    user = User(username="bench")
+    user.set_password("bench")
+    db.session.add(user)
+    db.session.commit()
+    brokers = [
+        Broker(name=f"b{i}", ip="127.0.0.1", user_id=user.id) for i in range(BROKERS)
+    ]
+    db.session.add_all(brokers)
+    db.session.commit()
+    return user.id, brokers[0].id
+
+
+def bench(client, route, queries):
+    """Return (requests/s, queries per request) for one route."""
+    client.get(route)
+    before = len(queries)
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        client.get(route)
+    elapsed = time.perf_counter() - start
+    return REQUESTS / elapsed, (len(queries) - before) / REQUESTS
+
+
+def main():
+    with app.app_context():
+        user_id, broker_id = setup()
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = user_id
+        queries = []
+        event.listen(
+            db.engine, "before_cursor_execute", lambda *args: queries.append(1)
+        )
+
+        print(f"{BROKERS} brokers, {REQUESTS} requests per route")
+        print(f"{'route':<26} {'cache':>6} {'req/s':>9} {'queries':>8}")
+        for ttl, label in ((0, "off"), (60, "on")):
+            saved_brokers.ttl = ttl
+            saved_brokers.invalidate()
+            for route in ROUTES:
+                route = route.format(id=broker_id)
+                rate, per_request = bench(client, route, queries)
+                print(f"{route:<26} {label:>6} {rate:>9.0f} {per_request:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
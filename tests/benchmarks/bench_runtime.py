@@ -0,0 +1,165 @@
+"""Thread-per-broker vs single asyncio loop with 10, 100 and 500 brokers.
+
+A stub MQTT broker (in its own process) accepts every connection and, once a
+client subscribes, publishes BENCH_RUNTIME_MESSAGES messages to it. For each
+runtime the benchmark connects N ActiveClients, waits until every message has
+arrived and reports the connect time, the delivery throughput, the CPU time
+used by this process and the number of threads.
+
+Brokers that are not connected after CONNECT_TIMEOUT seconds are left out and
+reported: paho's network threads use select(), which cannot watch file
+descriptors above 1024, so thread-per-broker stops connecting somewhere
+past 300 brokers.
+
+Run with: python tests/benchmarks/bench_runtime.py
+"""
+
+import asyncio
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+from mqtt_manager import ActiveClient  # noqa: E402
+
+BROKER_COUNTS = [
+    int(n) for n in os.environ.get("BENCH_RUNTIME_BROKERS", "10,100,500").split(",")
+]
+RUNTIMES = os.environ.get("BENCH_RUNTIMES", "threads,asyncio").split(",")
+MESSAGES = int(os.environ.get("BENCH_RUNTIME_MESSAGES", "200"))
+PAYLOAD = b"x" * 64
+CONNECT_TIMEOUT = 10
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def _publish_packet(topic, payload):
+    body = struct.pack("!H", len(topic)) + topic + payload
+    return b"\x30" + _encode_length(len(body)) + body
+
+
+async def _serve_client(reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(1)
+            length, shift = 0, 0
+            while True:
+                byte = (await reader.readexactly(1))[0]
+                length |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            body = await reader.readexactly(length)
+            kind = header[0] >> 4
+            if kind == 1:  # CONNECT
+                writer.write(b"\x20\x02\x00\x00")
+            elif kind == 8:  # SUBSCRIBE
+                writer.write(b"\x90\x03" + body[:2] + b"\x00")
+                packet = _publish_packet(b"bench/load", PAYLOAD)
+                writer.write(packet * MESSAGES)
+            elif kind == 12:  # PINGREQ
+                writer.write(b"\xd0\x00")
+            elif kind == 14:  # DISCONNECT
+                break
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.close()
+
+
+def _run_broker(port_value, ready):
+    async def main():
+        server = await asyncio.start_server(_serve_client, "127.0.0.1", 0, backlog=1024)
+        port_value.value = server.sockets[0].getsockname()[1]
+        ready.set()
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run(runtime, n_brokers, port):
+    """Return (connected, connect s, messages/s, CPU s, threads) for one runtime."""
+    received = [0]
+    lock = threading.Lock()
+    done = threading.Event()
+    total = [0]
+
+    def on_message(client, userdata, msg):
+        with lock:
+            received[0] += 1
+            if received[0] >= total[0]:
+                done.set()
+
+    clients = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for i in range(n_brokers):
+        client = ActiveClient(i, 1, f"b{i}", "127.0.0.1", port, runtime=runtime)
+        client.client.on_message = on_message
+        success, error = client.connect()
+        assert success, error
+        clients.append(client)
+    # Subscribing before CONNACK would subscribe twice (on_connect resubscribes)
+    deadline = time.perf_counter() + CONNECT_TIMEOUT
+    while time.perf_counter() < deadline:
+        if all(client.is_connected for client in clients):
+            break
+        time.sleep(0.001)
+    connected = time.perf_counter()
+    ready = [client for client in clients if client.is_connected]
+    total[0] = len(ready) * MESSAGES
+    for client in ready:
+        client.add_subscription("bench/#")
+    done.wait(timeout=120)
+    elapsed = time.perf_counter() - connected
+    cpu = time.process_time() - cpu_start
+    threads = threading.active_count()
+
+    for client in clients:
+        client.disconnect()
+    assert received[0] >= total[0], f"received {received[0]} of {total[0]}"
+    return len(ready), connected - start, total[0] / elapsed, cpu, threads
+
+
+def main():
+    port = multiprocessing.Value("i", 0)
+    ready = multiprocessing.Event()
+    broker = multiprocessing.Process(
+        target=_run_broker, args=(port, ready), daemon=True
+    )
+    broker.start()
+    ready.wait()
+
+    print(f"{MESSAGES} messages per broker")
+    print(
+        f"{'brokers':>8} {'runtime':>8} {'connected':>10} {'connect s':>10} "
+        f"{'msgs/s':>10} {'cpu s':>8} {'threads':>8}"
+    )
+    try:
+        for n in BROKER_COUNTS:
+            for runtime in RUNTIMES:
+                ready, connect, rate, cpu, threads = run(runtime, n, port.value)
+                print(
+                    f"{n:>8} {runtime:>8} {ready:>10} {connect:>10.3f} "
+                    f"{rate:>10.0f} {cpu:>8.2f} {threads:>8}"
+                )
+                time.sleep(0.5)
+    finally:
+        broker.terminate()
+
+
+if __name__ == "__main__":
+    main()
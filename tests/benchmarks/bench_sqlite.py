@@ -0,0 +1,119 @@
+"""Throughput of the app database under concurrent requests.
+
+Runs the queries behind login (user by name), the broker list (brokers by
+user) and a broker edit (update and commit) from BENCH_SQLITE_CLIENTS
+threads against a temporary database, with SQLite's defaults (rollback
+journal, synchronous=FULL, no mmap) and with the SQLITE_* settings of
+database.py. Each thread uses a Flask app context and the scoped session
+like a request does; password hashing is left out so the database is what
+is measured.
+
+Run with: python tests/benchmarks/bench_sqlite.py
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+from flask import Flask  # noqa: E402
+
+import database  # noqa: E402
+from database import Broker, User, configure_sqlite, db, engine_options  # noqa: E402
+
+USERS = 1000
+BROKERS_PER_USER = 10
+CLIENTS = [int(n) for n in os.environ.get("BENCH_SQLITE_CLIENTS", "1,8").split(",")]
+DURATION = float(os.environ.get("BENCH_SQLITE_DURATION", "3"))
+
+CONFIGS = {
+    "defaults": {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL"},
+    "tuned": {},
+}
+
+
+def make_app(path, settings):
+    """A Flask app bound to the database file `path` with `settings` applied."""
+    for name, value in settings.items():
+        setattr(database, name, value)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+    db.init_app(app)
+    with app.app_context():
+        configure_sqlite(db.engine)
+        db.create_all()
+        users = [User(username=f"u{i}", password_hash="x") for i in range(USERS)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all(
+            Broker(name=f"b{j}", ip="127.0.0.1", user_id=user.id)
+            for user in users
+            for j in range(BROKERS_PER_USER)
+        )
+        db.session.commit()
+    return app
+
+
+def login(i):
+    return User.query.filter_by(username=f"u{i % USERS}").first()
+
+
+def list_brokers(i):
+    return Broker.query.filter_by(user_id=i % USERS + 1).all()
+
+
+def edit_broker(i):
+    broker = db.session.get(Broker, i % (USERS * BROKERS_PER_USER) + 1)
+    broker.name = f"b{i}"
+    db.session.commit()
+
+
+def run(app, request, clients):
+    """Requests per second of `request` issued by `clients` threads."""
+    counts = [0] * clients
+    deadline = time.monotonic() + DURATION
+
+    def worker(n):
+        i = n
+        while time.monotonic() < deadline:
+            with app.app_context():
+                request(i)
+                db.session.remove()
+            i += clients
+            counts[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / DURATION
+
+
+def main():
+    defaults = {name: getattr(database, name) for name in CONFIGS["defaults"]}
+    print(f"{'settings':<10} {'clients':>7} {'login/s':>9} {'list/s':>9} {'edit/s':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for label, settings in CONFIGS.items():
+            app = make_app(
+                os.path.join(directory, f"{label}.db"), {**defaults, **settings}
+            )
+            for clients in CLIENTS:
+                rates = [
+                    run(app, request, clients)
+                    for request in (login, list_brokers, edit_broker)
+                ]
+                print(
+                    f"{label:<10} {clients:>7} "
+                    + " ".join(f"{rate:>9.0f}" for rate in rates)
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Messages/s delivered to a single SSE client, per-message vs batched frames.
+
+Run with: python tests/benchmarks/bench_sse.py
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src"))
+)
+
+from messages import Message  # noqa: E402
+from mqtt_manager import ListenerQueue  # noqa: E402
+from sse import message_events  # noqa: E402
+
+TOTAL = 200_000
+
+
+def _payload(i):
+    return Message(i, 1, f"plant/{i % 50}/temp", b'{"value": %d}' % i)
+
+
+def run(batch):
+    """Feed TOTAL messages through the stream generator and time delivery."""
+    q = ListenerQueue(maxsize=0)
+
+    def producer():
+        for i in range(TOTAL):
+            q.offer(_payload(i))
+
+    t = threading.Thread(target=producer)
+    start = time.perf_counter()
+    t.start()
+
+    delivered = 0
+    frames = 0
+    written = 0
+    for frame in message_events(q, batch=batch, max_wait=0.005):
+        frames += 1
+        written += len(frame)
+        if batch:
+            delivered += frame.count(b'"broker_id"')
+        else:
+            delivered += 1
+        if delivered >= TOTAL:
+            break
+    elapsed = time.perf_counter() - start
+    t.join()
+    return delivered / elapsed, frames, written
+
+
+if __name__ == "__main__":
+    for label, batch in (("per-message", False), ("batched", True)):
+        rate, frames, written = run(batch)
+        print(
+            f"{label:12s} {rate:12,.0f} msgs/s  {frames:8d} frames  "
+            f"{written / 1e6:6.1f} MB written"
+        )
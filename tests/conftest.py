@@ -7,8 +7,10 @@ import socket
 
 # Add src to python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+# The engine is created on import, so keep the tests off data/antena.db
+os.environ.setdefault("DATABASE_PATH", ":memory:")
 
-from app import app as flask_app
+from app import app as flask_app, saved_brokers
 from database import db
 
 
@@ -18,12 +20,13 @@ def app():
     flask_app.config.update(
         {
             "TESTING": True,
-            "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
             "SECRET_KEY": "test-secret",
             "WTF_CSRF_ENABLED": False,
         }
     )
 
+    # Every test starts from an empty database
+    saved_brokers.invalidate()
     with flask_app.app_context():
         db.create_all()
         yield flask_app
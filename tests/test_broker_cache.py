@@ -0,0 +1,59 @@
+from broker_cache import BrokerCache
+from database import Broker, User, db
+
+
+def _user(name):
+    user = User(username=name)
+    user.set_password("pass")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_cache_loads_once_and_follows_commits(app):
+    """Brokers are read once per user and reloaded after a committed change."""
+    loads = []
+
+    def load(user_id):
+        loads.append(user_id)
+        return Broker.query.filter_by(user_id=user_id).all()
+
+    cache = BrokerCache(load)
+    cache.track_changes(Broker)
+    user, other = _user("a"), _user("b")
+    broker = Broker(name="A", ip="1.1.1.1", user_id=user.id)
+    db.session.add(broker)
+    db.session.commit()
+
+    assert [b.name for b in cache.brokers(user.id)] == ["A"]
+    assert cache.get(user.id, broker.id).ip == "1.1.1.1"
+    assert cache.get(other.id, broker.id) is None
+    assert loads == [user.id, other.id]
+
+    # An uncommitted change keeps the cached brokers
+    broker.name = "Renamed"
+    db.session.flush()
+    db.session.rollback()
+    assert cache.brokers(user.id)[0].name == "A"
+    assert loads == [user.id, other.id]
+
+    broker.name = "Renamed"
+    db.session.commit()
+    assert cache.brokers(user.id)[0].name == "Renamed"
+    db.session.delete(broker)
+    db.session.commit()
+    assert cache.brokers(user.id) == []
+    # Only the owner was invalidated
+    assert loads == [user.id, other.id, user.id, user.id]
+
+
+def test_cache_entries_expire():
+    """Without an invalidation an entry is reloaded after the TTL."""
+    loads = []
+    cache = BrokerCache(lambda user_id: loads.append(user_id) or [], ttl=0)
+
+    cache.brokers(1)
+    cache.brokers(1)
+
+    assert loads == [1, 1]
+    assert cache.misses == 2
@@ -0,0 +1,213 @@
+import sqlite3
+from types import SimpleNamespace
+
+import history
+from history import HistoryStore
+from mqtt_manager import ActiveClient
+
+
+def _rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(
+            "SELECT ts, broker_id, topic, payload FROM messages ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def test_flush_writes_batched_messages(tmp_path):
+    """Recorded messages land in the segment of their timestamp after a flush."""
+    store = HistoryStore(str(tmp_path), segment_seconds=3600)
+    store.record(1, "plant/1/temp", b"21.5", ts=7200.5)
+    store.record(2, "plant/2/temp", b"\x00\xff", ts=7201.0)
+
+    assert store.flush() == 2
+    store.stop()
+
+    [(start, path)] = store.segments()
+    assert start == 7200
+    assert _rows(path) == [
+        (7200.5, 1, "plant/1/temp", b"21.5"),
+        (7201.0, 2, "plant/2/temp", b"\x00\xff"),
+    ]
+
+
+def test_messages_are_partitioned_by_time(tmp_path):
+    """Messages from different windows go to different segment files."""
+    store = HistoryStore(str(tmp_path), segment_seconds=60)
+    for ts in (10, 70, 130, 20):
+        store.record(1, "t", b"x", ts=ts)
+    store.flush()
+    store.stop()
+
+    assert [start for start, _ in store.segments()] == [0, 60, 120]
+    assert len(_rows(store.segment_path(0))) == 2
+
+
+def test_retention_by_age(tmp_path):
+    """Segments entirely older than max_age are deleted."""
+    store = HistoryStore(str(tmp_path), segment_seconds=60, max_age=120, max_bytes=0)
+    for ts in (0, 60, 120, 180):
+        store.record(1, "t", b"x", ts=ts)
+    store.flush()
+
+    assert store.enforce_retention(now=240) == 2
+    assert [start for start, _ in store.segments()] == [120, 180]
+    store.stop()
+
+
+def test_retention_by_size_keeps_current_segment(tmp_path):
+    """Oldest segments are deleted first when the store exceeds max_bytes."""
+    store = HistoryStore(str(tmp_path), segment_seconds=60, max_age=0, max_bytes=1)
+    for ts in (0, 60, 120):
+        store.record(1, "t", b"x" * 1000, ts=ts)
+    store.flush()
+
+    store.enforce_retention()
+    assert [start for start, _ in store.segments()] == [120]
+    store.stop()
+
+
+def test_backlog_overflow_drops_oldest(tmp_path):
+    """A full backlog drops the oldest messages instead of blocking."""
+    store = HistoryStore(str(tmp_path), max_backlog=2)
+    for i in range(5):
+        store.record(1, "t", str(i).encode(), ts=100 + i)
+    store.flush()
+    store.stop()
+
+    assert store.dropped == 3
+    [(_, path)] = store.segments()
+    assert [row[3] for row in _rows(path)] == [b"3", b"4"]
+
+
+def test_background_writer_flushes(tmp_path):
+    """The writer thread persists messages without an explicit flush."""
+    store = HistoryStore(str(tmp_path), flush_interval=0.01)
+    store.start()
+    store.record(1, "t", b"x")
+    store.stop()
+
+    assert store.written == 1
+
+
+def _store_with_messages(tmp_path):
+    store = HistoryStore(str(tmp_path), segment_seconds=60)
+    for i in range(10):
+        store.record(1, f"plant/{i % 2}/temp", str(i).encode(), ts=30 + i * 10)
+    store.record(1, "plant", b"root", ts=35)
+    store.record(1, "plant/0/humidity", b"h", ts=36)
+    store.record(2, "plant/0/temp", b"other broker", ts=37)
+    store.flush()
+    return store
+
+
+def test_query_with_wildcard_filters(tmp_path):
+    """Topic filters with + and # match like MQTT subscriptions."""
+    store = _store_with_messages(tmp_path)
+
+    messages, _ = store.query([1], "plant/+/temp")
+    assert len(messages) == 10
+    assert {m["topic"] for m in messages} == {"plant/0/temp", "plant/1/temp"}
+
+    messages, _ = store.query([1], "plant/#")
+    assert len(messages) == 12
+
+    messages, _ = store.query([1, 2], "plant/0/temp")
+    assert [m["payload"] for m in messages] == ["0", "other broker", "2", "4", "6", "8"]
+    store.stop()
+
+
+def test_query_time_range_spans_segments(tmp_path):
+    """A time range query reads only overlapping segments, in time order."""
+    store = _store_with_messages(tmp_path)
+
+    messages, _ = store.query([1], "plant/+/temp", start=50, end=100)
+    assert [m["ts"] for m in messages] == [50, 60, 70, 80, 90]
+    store.stop()
+
+
+def test_keyset_pagination(tmp_path):
+    """Following next_cursor returns every row exactly once."""
+    store = _store_with_messages(tmp_path)
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = store.query([1], "plant/+/temp", limit=3, cursor=cursor)
+        seen.extend(m["payload"] for m in page)
+        if cursor is None:
+            break
+    assert seen == [str(i) for i in range(10)]
+    store.stop()
+
+
+def test_pages_are_read_in_index_order(tmp_path, monkeypatch):
+    """Merged and time-ordered scans page through every match, unsorted."""
+    store = HistoryStore(str(tmp_path), segment_seconds=1000)
+    for i in range(30):
+        store.record(1 + i % 2, f"plant/{i % 3}/temp", str(i).encode(), ts=i // 2)
+    store.flush()
+
+    def pages(topic_filter):
+        seen, cursor = [], None
+        while True:
+            page, cursor = store.query([1, 2], topic_filter, limit=4, cursor=cursor)
+            seen.extend(int(m["payload"]) for m in page)
+            if cursor is None:
+                return seen
+
+    for merged in (history.MAX_MERGED_RANGES, 1):
+        monkeypatch.setattr(history, "MAX_MERGED_RANGES", merged)
+        assert pages(None) == list(range(30))
+        assert pages("plant/#") == list(range(30))
+        assert pages("plant/+/temp") == list(range(30))
+        assert pages("plant/1/temp") == list(range(1, 30, 3))
+
+    conn = history.open_segment_readonly(store.segment_path(0))
+    for broker_id, where, params in history._segment_ranges(conn, [1], None):
+        plan = conn.execute(
+            f"EXPLAIN QUERY PLAN {history.SELECT}{where} AND ts >= ? ORDER BY ts, id",
+            [broker_id, *params, 0],
+        ).fetchall()
+        assert "TEMP B-TREE" not in str(plan)
+    conn.close()
+    store.stop()
+
+
+def test_binary_payload_is_base64(tmp_path):
+    """Payloads that are not valid UTF-8 are returned base64 encoded."""
+    store = HistoryStore(str(tmp_path))
+    store.record(1, "cam/snapshot", b"\xff\xd8\xff", ts=1)
+    store.flush()
+
+    [message], _ = store.query([1])
+    assert message["encoding"] == "base64"
+    assert message["payload"] == "/9j/"
+    store.stop()
+
+
+def test_received_messages_are_recorded(tmp_path, monkeypatch):
+    """on_message stores each message with its own receive time."""
+    store = HistoryStore(str(tmp_path))
+    monkeypatch.setattr(history, "store", store)
+    client = ActiveClient(1, 1, "b", "127.0.0.1", 1883)
+
+    client.on_message(
+        None,
+        None,
+        SimpleNamespace(topic="plant/1/temp", payload=b"21", qos=1, retain=True),
+    )
+    store.flush()
+    store.stop()
+
+    [(_, message)] = client.ring.since()
+    [row] = store.query([1], "plant/#")[0]
+    assert row["ts"] == message.time_ns / 1e9
+    assert (row["topic"], row["payload"], row["qos"], row["retain"]) == (
+        "plant/1/temp",
+        "21",
+        1,
+        True,
+    )
@@ -0,0 +1,214 @@
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import ingest
+import mqtt_manager
+from messages import Message, message_json
+from mqtt_manager import ListenerQueue, listeners
+
+
+@pytest.fixture
+def ingest_server(tmp_path):
+    """An IngestServer listening on a temporary Unix socket."""
+    server = ingest.IngestServer(str(tmp_path / "ingest.sock"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if server._sock is not None and (tmp_path / "ingest.sock").exists():
+            break
+        time.sleep(0.01)
+    # Server and web side share this process: keep the feed from echoing back
+    mqtt_manager.message_sinks.remove(server.forward)
+    yield server
+    mqtt_manager.message_sinks.append(server.forward)
+    server.close()
+
+
+@pytest.fixture
+def ingest_client(ingest_server):
+    """An IngestClient connected to the test ingestion process."""
+    client = ingest.IngestClient(ingest_server.path)
+    yield client
+    client.close()
+
+
+def test_status_of_unknown_broker(ingest_client):
+    """A broker the ingestion process does not hold has no client."""
+    assert ingest_client.get_client(42) is None
+    assert ingest_client.replay_messages(1) == []
+
+
+def test_user_clients_in_one_request(ingest_client, monkeypatch):
+    """A user's broker states are fetched together."""
+    mine = mqtt_manager.ActiveClient(7, 1, "mine", "127.0.0.1", 1883)
+    theirs = mqtt_manager.ActiveClient(8, 2, "theirs", "127.0.0.1", 1883)
+    monkeypatch.setitem(mqtt_manager.connected_clients, 7, mine)
+    monkeypatch.setitem(mqtt_manager.connected_clients, 8, theirs)
+
+    remote = ingest_client.user_clients(1)
+
+    assert list(remote) == [7]
+    assert remote[7].name == "mine"
+    assert not remote[7].is_connected
+
+
+def test_unknown_operation_raises(ingest_client):
+    """Error-only responses surface as RuntimeError on the web side."""
+    with pytest.raises(RuntimeError):
+        ingest_client.request({"op": "bogus"})
+
+
+def test_broker_metrics_come_from_ingestion_process(ingest_client):
+    """The web side exposes the broker metrics of the ingestion process."""
+    text = ingest_client.broker_metrics()
+
+    assert "# TYPE antena_broker_messages_received_total counter" in text
+
+
+def test_load_job_runs_in_ingestion_process(ingest_client, monkeypatch):
+    """Load jobs are started, polled and stopped through the control socket."""
+    active = mqtt_manager.ActiveClient(5, 1, "b", "127.0.0.1", 1883)
+    monkeypatch.setitem(mqtt_manager.connected_clients, 5, active)
+    remote = ingest_client.get_client(5)
+
+    job = remote.start_load({"rate": 10, "duration": 60, "topic": "t/{n}"})
+    assert job["state"] == "running"
+    with pytest.raises(ValueError):
+        remote.start_load({"rate": -1, "duration": 1, "topic": "t"})
+
+    assert ingest_client.load_job(job["id"])["broker_id"] == 5
+    ingest_client.load_job(job["id"], stop=True)
+    assert ingest_client.load_job(job["id"] + 1000) is None
+
+
+def test_publish_status_comes_from_ingestion_process(ingest_client, monkeypatch):
+    """Publishes are tracked where the broker connection lives."""
+    active = mqtt_manager.ActiveClient(6, 1, "b", "127.0.0.1", 1883)
+    monkeypatch.setitem(mqtt_manager.connected_clients, 6, active)
+    remote = ingest_client.get_client(6)
+
+    # Not connected: paho refuses QoS 0 and queues QoS 1 until it connects
+    refused = remote.publish("plant/set", "on")
+    queued = remote.publish("plant/set", "on", qos=1)
+
+    assert refused.state == "failed"
+    assert remote.publish_status(refused.id)["rc"] == refused.rc != 0
+    assert remote.publish_status(queued.id)["state"] == "pending"
+    # Waited for in the ingestion process, on a connection of its own
+    with ingest_client._lock:
+        status = remote.publish_status(queued.id, wait=0.05)
+    assert status["state"] == "pending"
+    summary = remote.publish_summary()
+    assert summary["failed"] == 1
+    assert summary["pending"]["1"] == 1
+
+
+def test_feed_delivers_to_local_listeners(ingest_server, ingest_client):
+    """Messages forwarded by the ingestion process reach the worker's listeners."""
+    ingest_client.start_feed()
+    for _ in range(100):
+        if ingest_server._feeds:
+            break
+        time.sleep(0.01)
+    assert ingest_server._feeds
+
+    q = ListenerQueue()
+    listeners.add(7, q)
+    try:
+        message = Message(1, 3, "a/b", b"hi")
+        ingest_server.forward(7, message)
+        received = q.get(timeout=2)
+        assert (received.id, received.broker_id, received.topic) == (1, 3, "a/b")
+        assert message_json(received) == message_json(message)
+    finally:
+        listeners.remove(7, q)
+
+
+def test_feed_only_carries_announced_users(ingest_server, ingest_client):
+    """A worker only receives the messages of the users it streams to."""
+    ingest_client.start()
+    q = ListenerQueue()
+    listeners.add(8, q)
+    try:
+        for _ in range(100):
+            feeds = ingest_server._feeds
+            if feeds and feeds[0].users == {8}:
+                break
+            time.sleep(0.01)
+        feed = ingest_server._feeds[0]
+        assert feed.users == {8}
+
+        pushed = []
+        push = feed.push
+        feed.push = lambda line: (pushed.append(line), push(line))
+        ingest_server.forward(9, Message(1, 3, "x", b""))
+        ingest_server.forward(8, Message(2, 3, "x", b""))
+        assert q.get(timeout=2).id == 2
+        assert len(pushed) == 1
+    finally:
+        listeners.remove(8, q)
+
+
+def test_auto_connect_from_app_database(tmp_path, monkeypatch):
+    """The ingestion process connects the brokers flagged auto_connect."""
+    path = str(tmp_path / "antena.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE broker (id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT,"
+        " ip TEXT, port INTEGER, username TEXT, password TEXT, auto_connect BOOLEAN)"
+    )
+    conn.executemany(
+        "INSERT INTO broker VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, 7, "A", "10.0.0.1", 1883, None, None, 1),
+            (2, 7, "M", "10.0.0.2", 1883, None, None, 0),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    added = []
+
+    class FakeClient:
+        def __init__(self, broker):
+            added.append(broker)
+
+        def connect(self, wait=None):
+            assert wait == 0
+
+    monkeypatch.setattr(mqtt_manager, "add_client", FakeClient)
+
+    assert ingest.auto_connect_brokers(path) == 1
+    assert [(b.id, b.user_id, b.ip) for b in added] == [(1, 7, "10.0.0.1")]
+    assert ingest.auto_connect_brokers(str(tmp_path / "missing.db")) == 0
+
+
+def test_connect_does_not_wait_for_the_broker(ingest_client, monkeypatch):
+    """A connect never holds the worker's control socket during the attempt."""
+    waits = []
+
+    class FakeClient:
+        def __init__(self, broker):
+            pass
+
+        def connect(self, wait=None):
+            waits.append(wait)
+            return True, None
+
+    monkeypatch.setattr(mqtt_manager, "add_client", FakeClient)
+    broker = SimpleNamespace(
+        id=9,
+        user_id=1,
+        name="B",
+        ip="10.0.0.1",
+        port=1883,
+        username=None,
+        password=None,
+    )
+    remote = ingest_client.add_client(broker)
+
+    assert remote.connect() == (True, None)
+    assert waits == [0]
@@ -0,0 +1,169 @@
+import time
+
+import pytest
+
+import loadgen
+from publish_tracker import PublishTracker
+
+
+class FakeClient:
+    """Stands in for an ActiveClient; QoS 0 is acked before publish() returns."""
+
+    broker_id = 1
+    user_id = 7
+
+    def __init__(self, rc=0):
+        self.rc = rc
+        self.ack_listeners = []
+        self.publishes = PublishTracker(self.ack_listeners)
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+        mid = len(self.published)
+        sent_ns = time.monotonic_ns()
+        if qos == 0 and not self.rc:
+            self.publishes.complete(mid)
+        return self.publishes.track(mid, self.rc, topic, qos, sent_ns)
+
+    def ack(self, mid):
+        self.publishes.complete(mid)
+
+
+def wait_for(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job.finished is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.finished is not None
+
+
+def test_template_fields():
+    """Placeholders are rendered per message and braces can be escaped."""
+    template = loadgen.Template('{{"n": {n}, "v": {randint:5:5}}} {ts}')
+
+    text = template.render(42)
+
+    assert text.startswith('{"n": 42, "v": 5} ')
+    assert float(text.split()[-1]) > 0
+    with pytest.raises(ValueError):
+        loadgen.Template("{nope}")
+    with pytest.raises(ValueError):
+        loadgen.Template("{randint:1}")
+    with pytest.raises(ValueError):
+        loadgen.Template("{randint:9:0}")
+
+
+def test_parse_message_payloads():
+    """Strings are sent as is, other JSON values as JSON, base64 as bytes."""
+    assert loadgen.parse_message({"topic": "a", "payload": "x"}) == ("a", "x", 0, False)
+    assert loadgen.parse_message({"topic": "a", "payload": {"v": 1}, "qos": 2})[
+        1:3
+    ] == ('{"v": 1}', 2)
+    assert loadgen.parse_message({"topic": "a", "payload_base64": "AAE="})[1] == (
+        b"\x00\x01"
+    )
+    for bad in ({"payload": "x"}, {"topic": "a/#"}, {"topic": "a", "qos": 3}, []):
+        with pytest.raises(ValueError):
+            loadgen.parse_message(bad)
+
+
+def test_publish_many_reports_errors_by_index():
+    """Invalid messages are skipped and reported, the rest published."""
+    client = FakeClient()
+
+    result = loadgen.publish_many(
+        client, [{"topic": "a", "payload": "1"}, {"topic": "+"}, {"topic": "b"}]
+    )
+
+    assert result["published"] == 2
+    assert [e["index"] for e in result["errors"]] == [1]
+    assert [p[0] for p in client.published] == ["a", "b"]
+
+
+def test_load_job_paces_and_tracks_acks():
+    """A job publishes rate * duration messages and measures completion."""
+    client = FakeClient()
+    job = loadgen.LoadJob(
+        client, rate=200, duration=0.25, topic="t/{n}", qos={0: 1, 1: 1}
+    )
+
+    started = time.monotonic()
+    job.start()
+    # Acknowledge the QoS 1 publishes as they go out
+    acked = set()
+    while job.finished is None and time.monotonic() - started < 5:
+        for mid, (_, _, qos, _) in enumerate(list(client.published), 1):
+            if qos == 1 and mid not in acked:
+                acked.add(mid)
+                client.ack(mid)
+        time.sleep(0.005)
+    wait_for(job)
+
+    status = job.status()
+    assert status["state"] == "done"
+    assert status["sent"] == len(client.published) == 50
+    assert client.published[3][0] == "t/3"
+    # Paced over the duration rather than sent at once
+    assert status["elapsed"] >= 0.2
+    assert status["acked"]["0"] + status["acked"]["1"] == 50
+    assert status["pending"] == 0
+    assert status["latency_ms"]["0"]["p50"] >= 0
+    assert status["latency_ms"]["2"] is None
+    assert client.ack_listeners == []
+
+
+def test_load_job_can_be_stopped():
+    """Stopping ends the job before its duration."""
+    client = FakeClient()
+    job = loadgen.start_job(client, {"rate": 100, "duration": 60, "topic": "t"})
+
+    assert loadgen.get_job(job.id) is job
+    loadgen.stop_job(job.id)
+    wait_for(job)
+
+    assert job.status()["state"] == "stopped"
+    assert job.sent < 6000
+
+
+def test_load_job_counts_failed_publishes():
+    """Publishes refused by paho count as errors."""
+    client = FakeClient(rc=4)
+    job = loadgen.LoadJob(client, rate=100, duration=0.05, topic="t")
+
+    job.start()
+    wait_for(job)
+
+    assert job.errors == job.sent == 5
+
+
+def test_load_job_with_nothing_to_send_sleeps():
+    """A rate too low to send anything in the duration idles until the end."""
+    client = FakeClient()
+    job = loadgen.LoadJob(client, rate=0.5, duration=0.3, topic="t")
+    checks = []
+    is_set = job._stop.is_set
+    job._stop.is_set = lambda: checks.append(1) or is_set()
+
+    job.start()
+    wait_for(job)
+
+    assert job.sent == 0
+    assert job.status()["elapsed"] >= 0.25
+    # Waiting, not spinning
+    assert len(checks) < 10
+
+
+def test_start_job_validates_parameters():
+    """Bad parameters raise ValueError before anything is published."""
+    client = FakeClient()
+    for params in (
+        {"rate": 0, "duration": 1, "topic": "t"},
+        {"rate": 1, "duration": loadgen.LOADGEN_MAX_DURATION + 1, "topic": "t"},
+        {"rate": 1, "duration": 1},
+        {"rate": 1, "duration": 1, "topic": "t", "qos": {3: 1}},
+        {"rate": 1, "duration": 1, "topic": "t", "extra": 1},
+        {"duration": 1, "topic": "t"},
+    ):
+        with pytest.raises(ValueError):
+            loadgen.start_job(client, params)
+    assert client.published == []
@@ -0,0 +1,109 @@
+import json
+import logging
+import queue
+
+import pytest
+
+import logs
+from messages import Message
+
+
+class _Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def message_records(monkeypatch):
+    """Records of the message logger, with a fresh sampler."""
+    handler = _Collect()
+    logs.message_log.addHandler(handler)
+    monkeypatch.setattr(logs, "message_sampler", logs.MessageSampler(rate=0))
+    yield handler.records
+    logs.message_log.removeHandler(handler)
+
+
+def test_sampler_limits_rate_per_second():
+    """At most `rate` messages are allowed within one second."""
+    sampler = logs.MessageSampler(rate=3, sample=1)
+
+    allowed = [sampler.allow(now=10.5) for _ in range(5)]
+    assert allowed == [True, True, True, False, False]
+    assert sampler.take_skipped(now=10.5) == 2
+    assert sampler.take_skipped(now=10.6) == 0
+
+    assert sampler.allow(now=11.0)
+
+
+def test_sampler_keeps_one_in_n():
+    """With sample=N only every Nth message is allowed."""
+    sampler = logs.MessageSampler(rate=0, sample=4)
+
+    allowed = [sampler.allow() for _ in range(8)]
+    assert allowed == [False, False, False, True] * 2
+
+
+def test_log_message_formats_only_logged_messages(message_records, monkeypatch):
+    """Refused messages are not formatted and the skipped count is reported."""
+    monkeypatch.setattr(logs, "message_sampler", logs.MessageSampler(rate=1))
+    rendered = []
+    monkeypatch.setattr(
+        logs.messages, "payload_preview", lambda payload: rendered.append(payload)
+    )
+
+    for i in range(3):
+        logs.log_message("b1", Message(i, 1, "plant/temp", b"%d" % i))
+
+    assert rendered == [b"0"]
+    assert message_records[0].topic == "plant/temp"
+    # Skipped messages are reported at most once per second
+    assert [r.getMessage() for r in message_records[1:]] == ["1 messages not logged"]
+
+
+def test_message_echo_can_be_disabled(message_records, monkeypatch):
+    """LOG_MESSAGES=0 turns the per-message log off."""
+    monkeypatch.setattr(logs, "LOG_MESSAGES", False)
+
+    logs.log_message("b1", Message(1, 1, "plant/temp", b"21.5"))
+
+    assert message_records == []
+
+
+def test_json_formatter_includes_extra_fields():
+    """JSON lines carry the standard fields and anything passed as `extra`."""
+    record = logging.makeLogRecord(
+        {"name": "antena.messages", "levelname": "INFO", "msg": "hi %s", "args": (1,)}
+    )
+    record.topic = "plant/temp"
+
+    line = json.loads(logs.JsonFormatter().format(record))
+
+    assert line["msg"] == "hi 1"
+    assert line["logger"] == "antena.messages"
+    assert line["topic"] == "plant/temp"
+
+
+def test_queue_handler_drops_when_full():
+    """A full log queue drops records instead of blocking the caller."""
+    handler = logs.DroppingQueueHandler(queue.Queue(1))
+    record = logging.makeLogRecord({"msg": "x"})
+
+    handler.handle(record)
+    handler.handle(record)
+
+    assert handler.queue.qsize() == 1
+    assert handler.dropped == 1
+
+
+def test_parse_levels():
+    """LOG_LEVELS maps short logger names to levels."""
+    assert logs.parse_levels("mqtt=debug, ingest=WARNING") == {
+        "antena.mqtt": "DEBUG",
+        "antena.ingest": "WARNING",
+    }
+    with pytest.raises(ValueError):
+        logs.parse_levels("mqtt")
@@ -0,0 +1,86 @@
+import json
+
+from messages import (
+    Message,
+    broker_names,
+    message_frame,
+    message_json,
+    payload_fields,
+    payload_preview,
+)
+from sse import batch_frame
+
+
+def test_text_payload_is_sent_as_is():
+    """UTF-8 payloads are decoded, with their size in bytes."""
+    assert payload_fields("héllo".encode()) == {
+        "payload": "héllo",
+        "encoding": "utf-8",
+        "size": 6,
+    }
+
+
+def test_binary_payload_is_base64():
+    """Payloads that are not UTF-8 are base64-encoded instead of repr'd."""
+    fields = payload_fields(b"\xff\xd8\xff\xe0")
+    assert fields["encoding"] == "base64"
+    assert fields["payload"] == "/9j/4A=="
+
+
+def test_large_payload_is_truncated():
+    """Only the first `limit` bytes of a large payload are encoded."""
+    fields = payload_fields(b"\x00\xff" * 1000, limit=10)
+    assert fields["truncated"] is True
+    assert fields["size"] == 2000
+    assert fields["payload"] == "AP8A/wD/AP8A/w=="
+
+
+def test_truncation_inside_a_character_keeps_text():
+    """Cutting through a multi-byte character does not turn text into binary."""
+    fields = payload_fields("aé".encode(), limit=2)
+    assert fields == {"payload": "a", "encoding": "utf-8", "size": 3, "truncated": True}
+
+
+def test_message_wire_form():
+    """The wire form formats the receive time and names the broker."""
+    broker_names[42] = "plant"
+    message = Message(1, 42, "a/b", b"on", time_ns=1_700_000_000_123_456_789)
+    wire = message.to_wire()
+    assert wire["broker_name"] == "plant"
+    assert wire["ts"] == 1_700_000_000.1234568
+    assert wire["timestamp"].endswith(".123")
+    assert (wire["payload"], wire["encoding"], wire["size"]) == ("on", "utf-8", 2)
+
+
+def test_frames_encode_raw_payloads():
+    """SSE frames carry the JSON form of raw payloads."""
+    frame = message_frame(Message(5, 1, "cam", b"\x89PNG"))
+    assert frame.startswith(b"id: 5\ndata: ")
+    assert b'"encoding":"base64"' in frame
+    assert b'"payload":"iVBORw=="' in frame
+
+
+def test_message_is_encoded_once():
+    """Every stream sending a message reuses the same encoded frame."""
+    message = Message(7, 1, "a", b"on")
+    assert message_frame(message) is message_frame(message)
+    assert batch_frame([message]) == (
+        b"id: 7\nevent: batch\ndata: [" + message_json(message) + b"]\n\n"
+    )
+
+
+def test_relayed_message_keeps_its_encoding():
+    """A message rebuilt from its wire form is not encoded again."""
+    original = Message(3, 1, "a", b"\xff")
+    encoded = message_json(original)
+    relayed = Message.from_wire(json.loads(encoded), encoded)
+    assert message_json(relayed) == encoded
+    assert (relayed.id, relayed.topic) == (3, "a")
+    assert abs(relayed.time_ns - original.time_ns) < 1000
+
+
+def test_payload_preview():
+    """Log lines get a short preview rather than the whole payload."""
+    assert payload_preview(b"on") == "on"
+    assert payload_preview(b"\xff" * 5000) == "<5000 bytes binary>"
+    assert payload_preview(b"a" * 300, limit=3) == "aaa... <300 bytes>"
@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+import mqtt_loop
+from messages import Message
+from mqtt_manager import ActiveClient, ListenerQueue, ListenerRegistry
+
+
+def test_histogram_buckets_are_cumulative():
+    """Observations land in the first bucket whose bound is not below them."""
+    hist = metrics.Histogram(buckets=(0.001, 0.01))
+    for duration in (500_000, 1_000_000, 5_000_000, 2_000_000_000):
+        hist.observe_ns(duration)
+
+    assert hist.cumulative() == [(0.001, 2), (0.01, 3), (float("inf"), 4)]
+    assert hist.count == 4
+    assert hist.sum_ns == 2_006_500_000
+
+
+def test_client_counts_received_and_published():
+    """on_message and publish update the broker's counters."""
+    client = ActiveClient(401, 1, "metrics", "127.0.0.1", 1883)
+    client.client.publish = lambda *args, **kwargs: SimpleNamespace(mid=1, rc=0)
+    msg = SimpleNamespace(topic="plant/temp", payload=b"21.5", qos=0, retain=False)
+
+    client.on_message(None, None, msg)
+    client.on_message(None, None, msg)
+    client.publish("plant/set", "on")
+
+    assert client.stats.received == 2
+    assert client.stats.received_bytes == 8
+    assert client.stats.published == 1
+    assert client.stats.published_bytes == 2
+
+    text = metrics.render_brokers([client])
+    assert (
+        'antena_broker_messages_received_total{broker_id="401",user_id="1"} 2' in text
+    )
+    assert "antena_paho_loop_threads 0" in text
+    assert "antena_asyncio_loop_clients 0" in text
+
+
+def test_rendering_does_not_start_the_asyncio_loop(monkeypatch):
+    """The asyncio runtime's thread is only started by clients that use it."""
+    monkeypatch.setattr(mqtt_loop, "_loop", None)
+
+    metrics.render_brokers([])
+
+    assert mqtt_loop.current_loop() is None
+
+
+def test_publish_acks_are_tracked():
+    """on_publish completes the in-flight publish and feeds the ack histogram."""
+    client = ActiveClient(402, 1, "acks", "127.0.0.1", 1883)
+    mids = iter(range(1, 10))
+    client.client.publish = lambda *args, **kwargs: SimpleNamespace(
+        mid=next(mids), rc=0
+    )
+
+    first = client.publish("plant/set", "on", qos=1)
+    second = client.publish("plant/set", "off", qos=1)
+    client.on_publish(None, None, first.mid)
+
+    assert client.publish_status(first.id)["state"] == "acked"
+    assert client.publish_status(second.id)["state"] == "pending"
+    summary = client.publish_summary()
+    assert summary["pending"] == {"0": 0, "1": 1, "2": 0}
+    assert summary["ack_ms"]["1"]["count"] == 1
+    text = metrics.render_brokers([client])
+    labels = 'broker_id="402",user_id="1",qos="1"'
+    assert f"antena_broker_publishes_pending{{{labels}}} 1" in text
+    assert f"antena_broker_publish_ack_seconds_count{{{labels}}} 1" in text
+    assert f'antena_broker_publish_ack_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+
+
+def test_histogram_quantile_interpolates_within_buckets():
+    """Quantiles are estimated from the bucket counts."""
+    hist = metrics.Histogram(buckets=(0.1, 0.2))
+    assert hist.quantile(0.5) is None
+    for ms in (50, 150, 150, 150):
+        hist.observe_ns(ms * 1_000_000)
+
+    assert hist.quantile(0.25) == pytest.approx(0.1)
+    assert hist.quantile(0.5) == pytest.approx(0.1 + 0.1 / 3)
+    hist.observe_ns(10**9)
+    assert hist.quantile(1.0) == 0.2
+
+
+def test_render_listeners_reports_queue_depth_and_drops():
+    """Each live listener queue is exposed with its depth and drop count."""
+    registry = ListenerRegistry()
+    q = ListenerQueue(maxsize=1, policy="drop-oldest")
+    registry.add(7, q)
+    q.offer(Message(1, 1, "a", b"1"))
+    q.offer(Message(2, 1, "a", b"2"))
+
+    text = metrics.render_listeners(registry)
+
+    assert f'antena_listener_queue_depth{{user_id="7",listener="{q.id}"}} 1' in text
+    assert f'antena_listener_dropped_total{{user_id="7",listener="{q.id}"}} 1' in text
+    assert 'antena_delivery_latency_seconds_bucket{le="+Inf"}' in text
@@ -1,4 +1,14 @@
-from database import User, Broker
+from sqlalchemy import create_engine, inspect, text
+
+from database import (
+    User,
+    Broker,
+    add_missing_columns,
+    add_missing_indexes,
+    configure_sqlite,
+    db,
+    engine_options,
+)
 
 
 def test_user_password_hashing():
@@ -28,3 +38,42 @@ def test_broker_to_dict():
     assert data["port"] == 1883
     assert data["username"] == "user"
     assert data["password"] == "pass"
+
+
+def test_add_missing_columns_upgrades_old_tables(app):
+    """Columns added to a model are created in an existing database."""
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP TABLE broker"))
+        conn.execute(
+            text(
+                "CREATE TABLE broker (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,"
+                " name VARCHAR(100) NOT NULL, ip VARCHAR(100) NOT NULL,"
+                " port INTEGER NOT NULL, username VARCHAR(100), password VARCHAR(100))"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO broker (user_id, name, ip, port) VALUES (1, 'old', 'h', 1)"
+            )
+        )
+
+    add_missing_columns()
+    add_missing_columns()
+    add_missing_indexes()
+    add_missing_indexes()
+
+    assert Broker.query.one().auto_connect is False
+    indexes = inspect(db.engine).get_indexes("broker")
+    assert [i["column_names"] for i in indexes] == [["user_id"]]
+
+
+def test_sqlite_connections_are_tuned(tmp_path):
+    """Every connection gets WAL, synchronous=NORMAL and a busy timeout."""
+    path = str(tmp_path / "antena.db")
+    engine = create_engine(f"sqlite:///{path}", **engine_options(path))
+    configure_sqlite(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+    engine.dispose()
@@ -1,7 +1,11 @@
 import time
-import queue
 from database import db, Broker
-from mqtt_manager import add_client, remove_client, listeners, listeners_lock
+from mqtt_manager import (
+    add_client,
+    remove_client,
+    listeners,
+    ListenerQueue,
+)
 
 
 def test_mqtt_flow(app, mqtt_broker):
@@ -38,12 +42,9 @@ def test_mqtt_flow(app, mqtt_broker):
             time.sleep(1)  # Wait for subscription to be processed
 
             # 4. Setup SSE listener queue
-            test_queue = queue.Queue()
+            test_queue = ListenerQueue()
             user_id = 1
-            with listeners_lock:
-                if user_id not in listeners:
-                    listeners[user_id] = []
-                listeners[user_id].append(test_queue)
+            listeners.add(user_id, test_queue)
 
             try:
                 # 5. Publish
@@ -54,14 +55,12 @@ def test_mqtt_flow(app, mqtt_broker):
                 # Increased timeout to allow for network/docker latency
                 received = test_queue.get(timeout=5)
 
-                assert received["topic"] == topic
-                assert received["payload"] == message
-                assert "timestamp" in received
+                assert received.topic == topic
+                assert received.payload == message.encode()
+                assert received.time_ns > 0
 
             finally:
-                with listeners_lock:
-                    if user_id in listeners:
-                        listeners[user_id].remove(test_queue)
+                listeners.remove(user_id, test_queue)
 
         finally:
             remove_client(broker_obj.id)
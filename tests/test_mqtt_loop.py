@@ -0,0 +1,100 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import mqtt_loop
+from mqtt_manager import ActiveClient
+
+
+def _read_packet(conn):
+    header = conn.recv(1)
+    if not header:
+        return None, b""
+    length, shift = 0, 0
+    while True:
+        byte = conn.recv(1)[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    body = b""
+    while len(body) < length:
+        body += conn.recv(length - len(body))
+    return header[0] >> 4, body
+
+
+def _publish_packet(topic, payload):
+    body = struct.pack("!H", len(topic)) + topic.encode() + payload
+    return bytes([0x30, len(body)]) + body
+
+
+@pytest.fixture
+def stub_broker():
+    """A one-connection MQTT broker that publishes one message per subscription."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    packets = []
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            while True:
+                kind, body = _read_packet(conn)
+                if kind is None or kind == 14:  # DISCONNECT
+                    break
+                packets.append(kind)
+                if kind == 1:  # CONNECT
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif kind == 8:  # SUBSCRIBE
+                    conn.sendall(b"\x90\x03" + body[:2] + b"\x00")
+                    conn.sendall(_publish_packet("plant/temp", b"21.5"))
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield server.getsockname()[1], packets
+    server.close()
+
+
+def test_asyncio_runtime_serves_client_without_thread(stub_broker):
+    """With the asyncio runtime the shared loop runs the whole MQTT session."""
+    port, packets = stub_broker
+    client = ActiveClient(301, 1, "loop", "127.0.0.1", port, runtime="asyncio")
+    received = []
+    client.client.on_message = lambda c, u, msg: received.append(msg.payload)
+
+    success, error = client.connect()
+    assert success, error
+    assert client.client._thread is None
+
+    client.add_subscription("plant/#")
+    for _ in range(200):
+        if received:
+            break
+        time.sleep(0.01)
+    assert client.is_connected
+    assert received == [b"21.5"]
+
+    client.disconnect()
+    assert client.client not in mqtt_loop.get_loop()._clients
+
+
+def test_backoff_doubles_with_jitter():
+    """Delays grow exponentially up to the cap, each within the upper half."""
+    backoff = mqtt_loop.Backoff(base=1, cap=8)
+
+    delays = [backoff.next() for _ in range(6)]
+
+    for delay, window in zip(delays, (1, 2, 4, 8, 8, 8)):
+        assert window / 2 <= delay <= window
+    backoff.reset()
+    assert backoff.next() <= 1
+
+
+def test_unknown_runtime_is_rejected():
+    """Only the known runtimes can be selected."""
+    with pytest.raises(ValueError):
+        ActiveClient(302, 1, "bad", "127.0.0.1", 1883, runtime="fibers")
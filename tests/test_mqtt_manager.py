@@ -0,0 +1,325 @@
+import socket
+import time
+
+import pytest
+
+from messages import Message
+from mqtt_manager import (
+    ActiveClient,
+    ListenerQueue,
+    ListenerRegistry,
+    MessageRing,
+    broadcast_message,
+    connected_clients,
+    listeners,
+    replay_messages,
+    user_clients,
+)
+
+
+def _message(topic, payload, broker_id=1, msg_id=0):
+    return Message(msg_id, broker_id, topic, payload)
+
+
+def _drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait().payload)
+    return items
+
+
+def test_drop_oldest_policy():
+    """A full drop-oldest queue evicts the oldest buffered message."""
+    q = ListenerQueue(maxsize=2, policy="drop-oldest")
+    for i in range(4):
+        q.offer(_message("a", i))
+
+    assert _drain(q) == [2, 3]
+    assert q.dropped == 2
+
+
+def test_drop_newest_policy():
+    """A full drop-newest queue discards incoming messages."""
+    q = ListenerQueue(maxsize=2, policy="drop-newest")
+    for i in range(4):
+        q.offer(_message("a", i))
+
+    assert _drain(q) == [0, 1]
+    assert q.dropped == 2
+
+
+def test_coalesce_policy_keeps_latest_per_topic():
+    """A full coalescing queue replaces the pending message of the same topic.
+
+    The replacement is queued last, so ids still leave the queue in order.
+    """
+    q = ListenerQueue(maxsize=2, policy="coalesce")
+    q.offer(_message("a", 1, msg_id=1))
+    q.offer(_message("b", 1, msg_id=2))
+    q.offer(_message("a", 2, msg_id=3))
+    q.offer(_message("a", 3, msg_id=4))
+
+    assert q.qsize() == 2
+    assert [(m.id, m.payload) for m in (q.get_nowait(), q.get_nowait())] == [
+        (2, 1),
+        (4, 3),
+    ]
+    assert q.empty()
+    assert q.dropped == 2
+
+    # Once the pending message was consumed a new one is queued normally
+    q.offer(_message("a", 4))
+    assert _drain(q) == [4]
+
+
+def test_coalesce_compacts_replaced_slots():
+    """Replacing the same topic over and over does not grow the queue."""
+    q = ListenerQueue(maxsize=2, policy="coalesce")
+    q.offer(_message("a", 0, msg_id=0))
+    q.offer(_message("b", 0, msg_id=1))
+    for i in range(2, 1000):
+        q.offer(_message("a", i, msg_id=i))
+
+    assert len(q._items) <= 4
+    assert [m.id for m in (q.get_nowait(), q.get_nowait())] == [1, 999]
+
+
+def test_take_dropped_resets_between_reports():
+    """take_dropped only returns drops that were not reported yet."""
+    q = ListenerQueue(maxsize=1, policy="drop-newest")
+    for i in range(3):
+        q.offer(_message("a", i))
+
+    assert q.take_dropped() == 2
+    assert q.take_dropped() == 0
+    assert q.dropped == 2
+
+
+def test_unknown_policy_rejected():
+    """An invalid overflow policy raises a ValueError."""
+    with pytest.raises(ValueError):
+        ListenerQueue(policy="drop-everything")
+
+
+def test_registry_snapshots_are_immutable():
+    """Adding or removing a listener never mutates a snapshot already handed out."""
+    registry = ListenerRegistry()
+    q1, q2 = ListenerQueue(), ListenerQueue()
+    registry.add(7, q1)
+    snapshot = registry.get(7)
+    registry.add(7, q2)
+
+    assert snapshot == (q1,)
+    assert registry.get(7) == (q1, q2)
+
+    registry.remove(7, q1)
+    registry.remove(7, q2)
+    assert 7 not in registry
+    assert registry.get(7) == ()
+
+
+def test_registry_notifies_watchers_of_user_changes():
+    """Watchers run when a user gains its first or loses its last listener."""
+    registry = ListenerRegistry()
+    calls = []
+    registry.watchers.append(lambda: calls.append(registry.users()))
+    q1, q2 = ListenerQueue(), ListenerQueue()
+
+    registry.add(1, q1)
+    registry.add(1, q2)
+    registry.remove(1, q1)
+    registry.remove(1, q2)
+
+    assert calls == [{1}, set()]
+
+
+def test_broadcast_reaches_only_the_users_listeners():
+    """broadcast_message fans out to every queue of the target user only."""
+    mine, also_mine, other = ListenerQueue(), ListenerQueue(), ListenerQueue()
+    listeners.add(1, mine)
+    listeners.add(1, also_mine)
+    listeners.add(2, other)
+    try:
+        broadcast_message(1, _message("a", "hello"))
+        assert mine.get_nowait().payload == "hello"
+        assert also_mine.get_nowait().payload == "hello"
+        assert other.empty()
+    finally:
+        listeners.remove(1, mine)
+        listeners.remove(1, also_mine)
+        listeners.remove(2, other)
+
+
+def test_ring_evicts_oldest_by_count():
+    """A full ring drops its oldest entries."""
+    ring = MessageRing(capacity=3, max_bytes=1000)
+    for i in range(5):
+        ring.append(i, f"m{i}", 10)
+
+    assert len(ring) == 3
+    assert ring.since() == [(2, "m2"), (3, "m3"), (4, "m4")]
+    assert ring.since(3) == [(4, "m4")]
+
+
+def test_ring_evicts_oldest_by_bytes():
+    """The ring never holds more than max_bytes worth of messages."""
+    ring = MessageRing(capacity=100, max_bytes=25)
+    for i in range(5):
+        ring.append(i, f"m{i}", 10)
+    ring.append(5, "too big", 26)
+
+    assert ring.since() == [(3, "m3"), (4, "m4")]
+    assert ring.bytes == 20
+
+
+def test_replay_messages_merges_user_brokers():
+    """Replay merges the user's broker buffers in id order."""
+    a = ActiveClient(101, 1, "a", "127.0.0.1", 1883)
+    b = ActiveClient(102, 1, "b", "127.0.0.1", 1883)
+    other = ActiveClient(103, 2, "c", "127.0.0.1", 1883)
+    a.ring.append(1, _message("a/1", "a1"), 1)
+    b.ring.append(2, _message("b/2", "b2"), 1)
+    a.ring.append(3, _message("a/3", "a3"), 1)
+    other.ring.append(4, _message("c/4", "c4"), 1)
+    for c in (a, b, other):
+        connected_clients[c.broker_id] = c
+
+    def payloads(messages):
+        return [m.payload for m in messages]
+
+    try:
+        assert payloads(replay_messages(1)) == ["a1", "b2", "a3"]
+        assert payloads(replay_messages(1, limit=2)) == ["b2", "a3"]
+        assert payloads(replay_messages(1, after_id=1)) == ["b2", "a3"]
+        assert payloads(replay_messages(1, topic_filters=["a/#"])) == ["a1", "a3"]
+        assert payloads(replay_messages(1, broker_ids=[102])) == ["b2"]
+    finally:
+        for c in (a, b, other):
+            del connected_clients[c.broker_id]
+
+
+def test_broadcast_applies_listener_filters():
+    """Listeners only receive messages matching their topics and brokers."""
+    temps, broker_two, everything = ListenerQueue(), ListenerQueue(), ListenerQueue()
+    listeners.add(5, temps, topic_filters=["plant/+/temp", "plant/#"])
+    listeners.add(5, broker_two, broker_ids=[2])
+    listeners.add(5, everything)
+    try:
+        broadcast_message(5, _message("plant/3/temp", 1, broker_id=1))
+        broadcast_message(5, _message("alarms/fire", 2, broker_id=2))
+
+        assert [m.payload for m in (temps.get_nowait(),)] == [1]
+        assert temps.empty()
+        assert broker_two.get_nowait().payload == 2
+        assert broker_two.empty()
+        assert everything.qsize() == 2
+    finally:
+        for q in (temps, broker_two, everything):
+            listeners.remove(5, q)
+
+
+def test_registry_rejects_invalid_filter():
+    """Malformed topic filters are refused when registering a listener."""
+    with pytest.raises(ValueError):
+        listeners.add(5, ListenerQueue(), topic_filters=["a/#/b"])
+    assert 5 not in listeners
+
+
+def test_subscription_diffs_are_batched(mocker):
+    """Only changed filters are sent, as single list-form packets."""
+    client = ActiveClient(201, 1, "subs", "127.0.0.1", 1883)
+    client.client = mocker.Mock()
+
+    client.set_subscriptions({"a/b": 0, "c/d": 1})
+    client.client.subscribe.assert_called_once_with([("a/b", 0), ("c/d", 1)])
+    client.client.unsubscribe.assert_not_called()
+
+    client.client.reset_mock()
+    client.set_subscriptions({"a/b": 0, "e/f": 0})
+    client.client.unsubscribe.assert_called_once_with(["c/d"])
+    client.client.subscribe.assert_called_once_with([("e/f", 0)])
+
+    client.client.reset_mock()
+    client.set_subscriptions({"a/b": 0, "e/f": 0})
+    client.client.subscribe.assert_not_called()
+    client.client.unsubscribe.assert_not_called()
+
+
+def test_overlapping_subscriptions_sent_once(mocker):
+    """A filter covered by another is kept locally but not sent to the broker."""
+    client = ActiveClient(202, 1, "overlap", "127.0.0.1", 1883)
+    client.client = mocker.Mock()
+
+    client.add_subscription("a/b", 1)
+    client.client.reset_mock()
+    client.add_subscription("a/#", 0)
+
+    client.client.unsubscribe.assert_called_once_with(["a/b"])
+    client.client.subscribe.assert_called_once_with([("a/#", 1)])
+    assert client.subscribed_topics == {"a/b", "a/#"}
+
+    # Dropping the covering filter: a/b is subscribed before a/# goes away
+    client.client.reset_mock()
+    client.remove_subscription("a/#")
+    assert client.client.method_calls == [
+        mocker.call.subscribe([("a/b", 1)]),
+        mocker.call.unsubscribe(["a/#"]),
+    ]
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.mark.parametrize("runtime", ["threads", "asyncio"])
+def test_connect_does_not_block_and_keeps_retrying(runtime):
+    """connect(wait=0) returns at once; a refused connection is retried."""
+    client = ActiveClient(230, 1, "down", "127.0.0.1", _closed_port(), runtime=runtime)
+
+    started = time.monotonic()
+    assert client.connect(wait=0) == (True, None)
+    assert time.monotonic() - started < 0.5
+
+    for _ in range(100):
+        if client.connection_error:
+            break
+        time.sleep(0.01)
+    assert "refused" in client.connection_error.lower()
+    if runtime == "threads":
+        # paho's network thread is retrying the connection
+        assert client.client._thread is not None
+    client.disconnect()
+    assert client.client._thread is None
+
+
+def test_connect_reports_first_failure_when_waiting():
+    """With a wait, the outcome of the first attempt is returned."""
+    client = ActiveClient(231, 1, "down", "127.0.0.1", _closed_port())
+
+    success, error = client.connect(wait=5)
+
+    assert success is False
+    assert "refused" in error.lower()
+    client.disconnect()
+
+
+def test_connected_clients_are_indexed_by_user():
+    """Clients are found per user without scanning every connection."""
+    a = ActiveClient(241, 1, "a", "127.0.0.1", 1883)
+    b = ActiveClient(242, 2, "b", "127.0.0.1", 1883)
+    replacement = ActiveClient(241, 1, "a2", "127.0.0.1", 1883)
+    connected_clients[241] = a
+    connected_clients[242] = b
+    try:
+        assert connected_clients.for_user(1) == [a]
+        connected_clients[241] = replacement
+        assert user_clients(1) == {241: replacement}
+        del connected_clients[242]
+        assert user_clients(2) == {}
+    finally:
+        del connected_clients[241]
+    assert connected_clients.for_user(1) == []
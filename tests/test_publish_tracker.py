@@ -0,0 +1,64 @@
+import threading
+import time
+
+from publish_tracker import PublishTracker
+
+
+def test_ack_before_track_completes_the_publish():
+    """An ack that arrives before publish() returned its mid is not lost."""
+    acked = []
+    tracker = PublishTracker([acked.append])
+
+    tracker.complete(7)
+    record = tracker.track(7, 0, "a", 0, sent_ns=0)
+
+    assert record.state == "acked"
+    assert acked == [record]
+    assert tracker.pending() == [0, 0, 0]
+    assert tracker.acked == [1, 0, 0]
+
+
+def test_failed_and_evicted_publishes():
+    """Refused publishes are failed at once; only recent ones can be looked up."""
+    tracker = PublishTracker(recent=2)
+
+    failed = tracker.track(1, 4, "a", 1, sent_ns=0)
+    pending = tracker.track(2, 0, "a", 1, sent_ns=0)
+    for mid in (3, 4):
+        tracker.track(mid, 0, "a", 2, sent_ns=0)
+        tracker.complete(mid)
+
+    assert failed.to_dict()["state"] == "failed"
+    assert tracker.failed == 1
+    # The failed publish was pushed out by two newer completions
+    assert tracker.get(failed.id) is None
+    assert tracker.get(pending.id).state == "pending"
+    summary = tracker.summary()
+    assert summary["pending"] == {"0": 0, "1": 1, "2": 0}
+    assert summary["ack_ms"]["2"]["count"] == 2
+    assert [r["mid"] for r in summary["recent"]] == [4, 3]
+
+    # A reused mid replaces the stale in-flight record
+    reused = tracker.track(2, 0, "a", 1, sent_ns=0)
+    assert tracker.get(pending.id) is None
+    assert tracker.get(reused.id).state == "pending"
+    assert tracker.pending() == [0, 1, 0]
+    tracker.complete(2)
+    assert tracker.get(reused.id).state == "acked"
+
+
+def test_wait_returns_once_the_publish_completes():
+    """A waiter is woken by the ack instead of polling for it."""
+    tracker = PublishTracker()
+    record = tracker.track(3, 0, "a", 1, sent_ns=0)
+    threading.Timer(0.05, tracker.complete, args=(3,)).start()
+
+    start = time.monotonic()
+    assert tracker.wait(record.id, 5).state == "acked"
+    assert time.monotonic() - start < 1
+    assert tracker._waiters == {}
+
+    pending = tracker.track(4, 0, "a", 1, sent_ns=0)
+    assert tracker.wait(pending.id, 0.01).state == "pending"
+    assert tracker._waiters == {}
+    assert tracker.wait(pending.id + 100, 1) is None
@@ -0,0 +1,18 @@
+import ingest
+import registry
+
+
+def test_local_registry_by_default(monkeypatch):
+    """Without an ingestion socket the clients live in the web process."""
+    monkeypatch.setattr(ingest, "INGEST_SOCKET", None)
+    clients = registry.create_registry()
+    assert isinstance(clients, registry.LocalRegistry)
+    assert not clients.shared
+    assert clients.get_client(12345) is None
+
+
+def test_shared_registry_with_ingest_socket(tmp_path):
+    """An ingestion socket selects the registry shared by every worker."""
+    clients = registry.create_registry(str(tmp_path / "ingest.sock"))
+    assert isinstance(clients, ingest.IngestClient)
+    assert clients.shared
@@ -1,4 +1,11 @@
-from database import db, User, Broker
+import pytest
+from sqlalchemy import event
+
+import history
+import loadgen
+import metrics
+from database import Broker, User, db
+from mqtt_manager import listeners
 
 
 def test_index_redirect(client):
@@ -128,8 +135,11 @@ def test_publish_with_qos_and_retain(client, mocker):
 
     # Mock mqtt_manager functions
     mock_client = mocker.Mock()
+    mock_client.user_id = user.id
     mock_client.is_connected = True
-    mocker.patch("app.get_client", return_value=mock_client)
+    mock_client.publish.return_value.id = 5
+    mock_client.publish_status.return_value = {"state": "acked", "ack_ms": 3.2}
+    mocker.patch("app.clients.get_client", return_value=mock_client)
 
     # Publish with QoS 1 and Retain on
     rv = client.post(
@@ -144,7 +154,408 @@ def test_publish_with_qos_and_retain(client, mocker):
         follow_redirects=True,
     )
 
-    assert b"Message published (QoS: 1, Retain: True)" in rv.data
+    assert b"Message published (QoS: 1, Retain: True), acknowledged in 3.2 ms" in (
+        rv.data
+    )
     mock_client.publish.assert_called_once_with(
         "test/topic", "hello world", qos=1, retain=True
     )
+    mock_client.publish_status.assert_called_with(5, wait=2.0)
+
+    # The answer does not wait forever for an acknowledgement
+    mocker.patch("app.PUBLISH_ACK_WAIT", 0)
+    mock_client.publish_status.return_value = {"state": "pending"}
+    rv = client.post(
+        "/publish",
+        data={
+            "broker_id": str(broker.id),
+            "topic": "test/topic",
+            "message": "hello",
+            "qos": "2",
+        },
+        follow_redirects=True,
+    )
+    assert b"not acknowledged yet (publish 5)" in rv.data
+
+
+def test_history_endpoint(client, tmp_path, monkeypatch):
+    """The history API returns only the user's messages, page by page."""
+    user = User(username="histuser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    mine = Broker(name="Mine", ip="127.0.0.1", user_id=user.id)
+    theirs = Broker(name="Theirs", ip="127.0.0.1", user_id=user.id + 1)
+    db.session.add_all([mine, theirs])
+    db.session.commit()
+
+    store = history.HistoryStore(str(tmp_path))
+    for i in range(3):
+        store.record(mine.id, "plant/1/temp", str(i).encode(), ts=100 + i)
+    store.record(theirs.id, "plant/1/temp", b"secret", ts=101)
+    store.flush()
+    monkeypatch.setattr(history, "store", store)
+
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    rv = client.get("/history?topic=plant/%2B/temp&limit=2")
+    data = rv.get_json()
+    assert [m["payload"] for m in data["messages"]] == ["0", "1"]
+    assert data["messages"][0]["broker_name"] == "Mine"
+
+    rv = client.get(f"/history?topic=plant/%2B/temp&cursor={data['next_cursor']}")
+    assert [m["payload"] for m in rv.get_json()["messages"]] == ["2"]
+
+    rv = client.get("/history?format=ndjson")
+    assert rv.mimetype == "application/x-ndjson"
+    assert len(rv.data.splitlines()) == 3
+
+    assert client.get(f"/history?broker_id={theirs.id}").status_code == 404
+    assert client.get("/history?topic=a/%23/b").status_code == 400
+    # Dates need a time zone; epoch seconds and offsets are unambiguous
+    assert client.get("/history?start=1970-01-01T00:01:41").status_code == 400
+    rv = client.get("/history?start=1970-01-01T01:01:41%2B01:00&end=101.5")
+    assert [m["payload"] for m in rv.get_json()["messages"]] == ["1"]
+    store.stop()
+
+
+def test_stream_rejects_invalid_topic_filter(client):
+    """/stream answers 400 to a malformed topic filter."""
+    user = User(username="streamuser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    assert client.get("/stream?topic=a/%23/b").status_code == 400
+    assert client.get("/stream?overflow=drop-everything").status_code == 400
+    assert client.get("/stream?mode=latest&interval=soon").status_code == 400
+    assert client.get("/stream?mode=latest&interval=inf").status_code == 400
+
+
+def test_failed_stream_unregisters_its_queue(client, mocker):
+    """A stream that fails, not only one closed by the client, is cleaned up."""
+    user = User(username="failstream")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+    mocker.patch(
+        "app.clients.replay_messages",
+        side_effect=RuntimeError("Ingestion process unavailable"),
+    )
+
+    with pytest.raises(RuntimeError):
+        client.get("/stream").get_data()
+
+    assert user.id not in listeners
+
+
+def test_toggle_listen_manages_multiple_topics(client, mocker):
+    """Topics are added and removed individually on the same broker."""
+    user = User(username="subuser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    broker = Broker(name="Sub Broker", ip="127.0.0.1", user_id=user.id)
+    db.session.add(broker)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    mock_client = mocker.Mock()
+    mock_client.user_id = user.id
+    mock_client.name = "Sub Broker"
+    mocker.patch("app.clients.get_client", return_value=mock_client)
+
+    form = {"broker_id": str(broker.id), "topic": "plant/+/temp", "qos": "1"}
+    rv = client.post("/toggle_listen", data={**form, "action": "start"})
+    assert rv.status_code == 302
+    mock_client.add_subscription.assert_called_once_with("plant/+/temp", 1)
+
+    client.post("/toggle_listen", data={**form, "action": "unsubscribe"})
+    mock_client.remove_subscription.assert_called_once_with("plant/+/temp")
+
+    client.post("/toggle_listen", data={**form, "action": "stop"})
+    mock_client.clear_subscription.assert_called_once_with()
+
+
+def test_metrics_endpoint(client, monkeypatch):
+    """/metrics serves the Prometheus text format to trusted scrapers."""
+    import app as app_module
+
+    rv = client.get("/metrics")
+
+    assert rv.status_code == 200
+    assert rv.content_type.startswith("text/plain; version=0.0.4")
+    assert b"# TYPE antena_delivery_latency_seconds histogram" in rv.data
+    assert b"# TYPE antena_broker_messages_received_total counter" in rv.data
+
+    # Only local scrapers without a token, anyone with it
+    remote = {"REMOTE_ADDR": "192.0.2.7"}
+    assert client.get("/metrics", environ_base=remote).status_code == 403
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    rv = client.get(
+        "/metrics", environ_base=remote, headers={"Authorization": "Bearer s3cret"}
+    )
+    assert rv.status_code == 200
+
+
+def test_stream_trace_records_browser_latency(client):
+    """Render latencies reported by a traced page feed the metrics histogram."""
+    user = User(username="tracer")
+    user.set_password("pass")
+    db.session.add(user)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    before = metrics.browser_latency.count
+    rv = client.post("/stream/trace", json={"render_ms": [12.5, -3, "bad"]})
+
+    assert rv.status_code == 204
+    assert metrics.browser_latency.count == before + 2
+    assert client.post("/stream/trace", json={}).status_code == 400
+
+
+def test_topic_tree_endpoint(client, mocker):
+    """The topic tree of a user's connected broker is served one level at a time."""
+    user = User(username="treeuser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    broker = Broker(name="B", ip="127.0.0.1", port=1883, user_id=user.id)
+    db.session.add(broker)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    mock_client = mocker.Mock()
+    mock_client.user_id = user.id
+    mock_client.topic_tree.return_value = {"path": "plant", "children": []}
+    get_client = mocker.patch("app.clients.get_client", return_value=mock_client)
+
+    rv = client.get(f"/brokers/{broker.id}/topics?path=plant")
+    assert rv.get_json()["path"] == "plant"
+    mock_client.topic_tree.assert_called_once_with("plant")
+
+    mock_client.topic_tree.return_value = None
+    assert client.get(f"/brokers/{broker.id}/topics?path=x").status_code == 404
+    get_client.return_value = None
+    assert client.get(f"/brokers/{broker.id}/topics").status_code == 404
+    assert client.get(f"/brokers/{broker.id + 1}/topics").status_code == 404
+
+    # A connection of another user's broker, whatever the saved brokers say
+    get_client.return_value = mocker.Mock(user_id=user.id + 1)
+    assert client.get(f"/brokers/{broker.id}/topics").status_code == 404
+
+
+def test_bulk_publish_json_and_ndjson(client, mocker, monkeypatch):
+    """Bulk messages are handed to the broker client in one call."""
+    user = User(username="bulkuser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    broker = Broker(name="B", ip="127.0.0.1", port=1883, user_id=user.id)
+    db.session.add(broker)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    mock_client = mocker.Mock()
+    mock_client.user_id = user.id
+    mock_client.is_connected = True
+    mock_client.publish_many.return_value = {"published": 2, "errors": []}
+    mocker.patch("app.clients.get_client", side_effect={broker.id: mock_client}.get)
+    messages = [{"topic": "a", "payload": "1"}, {"topic": "b", "qos": 1}]
+
+    rv = client.post(
+        "/publish/bulk", json={"broker_id": broker.id, "messages": messages}
+    )
+    assert rv.get_json()["published"] == 2
+    mock_client.publish_many.assert_called_with(messages)
+
+    body = '{"topic": "a", "payload": "1"}\n\n{"topic": "b", "qos": 1}\n'
+    rv = client.post(
+        f"/publish/bulk?broker_id={broker.id}",
+        data=body,
+        content_type="application/x-ndjson",
+    )
+    assert rv.status_code == 200
+    mock_client.publish_many.assert_called_with(messages)
+
+    rv = client.post(
+        f"/publish/bulk?broker_id={broker.id}",
+        data="{oops",
+        content_type="application/x-ndjson",
+    )
+    assert rv.status_code == 400
+    monkeypatch.setattr(loadgen, "BULK_PUBLISH_MAX", 1)
+    rv = client.post(
+        "/publish/bulk", json={"broker_id": broker.id, "messages": messages}
+    )
+    assert rv.status_code == 413
+    rv = client.post("/publish/bulk", json={"broker_id": broker.id + 1, "messages": []})
+    assert rv.status_code == 404
+
+
+def test_load_job_routes(client, mocker):
+    """Load jobs are started on the user's broker and only visible to them."""
+    user = User(username="loaduser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    broker = Broker(name="B", ip="127.0.0.1", port=1883, user_id=user.id)
+    db.session.add(broker)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    job = {"id": 3, "user_id": user.id, "state": "running"}
+    mock_client = mocker.Mock()
+    mock_client.user_id = user.id
+    mock_client.is_connected = True
+    mock_client.start_load.return_value = job
+    mocker.patch("app.clients.get_client", return_value=mock_client)
+    load_job = mocker.patch("app.clients.load_job", return_value=job)
+
+    rv = client.post(
+        "/publish/load",
+        json={"broker_id": broker.id, "rate": 10, "duration": 1, "topic": "t"},
+    )
+    assert rv.status_code == 202
+    mock_client.start_load.assert_called_once_with(
+        {"rate": 10, "duration": 1, "topic": "t"}
+    )
+
+    assert client.get("/publish/load/3").get_json()["state"] == "running"
+    assert client.delete("/publish/load/3").status_code == 200
+    load_job.assert_called_with(3, stop=True)
+
+    mock_client.start_load.side_effect = ValueError("rate must be positive")
+    rv = client.post("/publish/load", json={"broker_id": broker.id, "rate": 0})
+    assert rv.status_code == 400
+    # Refused by loadgen itself before any job thread starts
+    mock_client.start_load.side_effect = lambda params: loadgen.start_job(
+        mock_client, params
+    ).status()
+    rv = client.post(
+        "/publish/load",
+        json={
+            "broker_id": broker.id,
+            "rate": 10,
+            "duration": 1,
+            "topic": "t",
+            "payload": "{randint:9:0}",
+        },
+    )
+    assert rv.status_code == 400
+    assert "randint" in rv.get_json()["error"]
+    load_job.return_value = {**job, "user_id": user.id + 1}
+    assert client.get("/publish/load/3").status_code == 404
+
+
+def test_auto_connect_brokers_at_startup(app, mocker):
+    """Only brokers flagged auto_connect are connected, without waiting."""
+    user = User(username="autouser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    auto = Broker(name="A", ip="10.0.0.1", user_id=user.id, auto_connect=True)
+    manual = Broker(name="M", ip="10.0.0.2", user_id=user.id)
+    db.session.add_all([auto, manual])
+    db.session.commit()
+    add_client = mocker.patch("app.clients.add_client")
+
+    import app as app_module
+
+    # Never under the test runner, so the suite does not reach real brokers
+    app_module.auto_connect_brokers()
+    add_client.assert_not_called()
+
+    mocker.patch.dict(app.config, {"TESTING": False})
+    app_module.auto_connect_brokers()
+
+    assert [c.args[0].id for c in add_client.call_args_list] == [auto.id]
+    add_client.return_value.connect.assert_called_once_with(wait=0)
+
+
+def test_disconnect_turns_off_auto_connect(client, mocker):
+    """A broker disconnected by hand stays disconnected after a restart."""
+    user = User(username="disconnectuser")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    broker = Broker(name="A", ip="10.0.0.1", user_id=user.id, auto_connect=True)
+    db.session.add(broker)
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+    remove_client = mocker.patch("app.clients.remove_client")
+
+    response = client.post("/brokers", data={"disconnect": "1", "broker_id": broker.id})
+
+    assert response.status_code == 302
+    remove_client.assert_called_once_with(broker.id)
+    assert db.session.get(Broker, broker.id).auto_connect is False
+
+
+def test_broker_status_without_database_queries(client, mocker):
+    """Once a user's brokers are cached, status and ownership need no query."""
+    user = User(username="statususer")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    up = Broker(name="Up", ip="127.0.0.1", user_id=user.id)
+    down = Broker(name="Down", ip="127.0.0.2", user_id=user.id)
+    db.session.add_all([up, down])
+    db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+
+    mock_client = mocker.Mock(
+        user_id=user.id,
+        is_connected=True,
+        connection_error=None,
+        subscriptions={"a/#": 0},
+    )
+    mock_client.publish_summary.return_value = {"pending": {}}
+    # Broker up.id + 5 is connected for another user
+    live = {up.id: mock_client, up.id + 5: mocker.Mock(user_id=user.id + 1)}
+    mocker.patch("app.clients.user_clients", return_value={up.id: mock_client})
+    mocker.patch("app.clients.get_client", side_effect=live.get)
+    client.get("/brokers/status")
+
+    queries = []
+
+    def count(*args):
+        queries.append(args)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        rv = client.get("/brokers/status")
+        client.post(
+            "/toggle_listen",
+            data={"broker_id": str(up.id), "topic": "b/#", "action": "start"},
+        )
+        assert client.get(f"/brokers/{up.id}/publishes").status_code == 200
+        assert client.get(f"/brokers/{up.id + 5}/publishes").status_code == 404
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+
+    assert queries == []
+    assert [(b["name"], b["status"]) for b in rv.get_json()["brokers"]] == [
+        ("Up", "connected"),
+        ("Down", "disconnected"),
+    ]
+    assert rv.get_json()["brokers"][0]["subscriptions"] == ["a/#"]
+    mock_client.add_subscription.assert_called_once_with("b/#", 0)
+
+    # Editing a broker is seen at once
+    client.post(f"/brokers/edit/{down.id}", data={"name": "Renamed", "ip": "127.0.0.2"})
+    rv = client.get("/brokers/status")
+    assert rv.get_json()["brokers"][1]["name"] == "Renamed"
@@ -0,0 +1,173 @@
+import json
+
+import pytest
+
+from messages import Message
+from mqtt_manager import ListenerQueue
+from sse import drain_batch, latest_events, latest_interval, message_events
+
+
+def _message(i):
+    return Message(i, 1, f"t/{i}", str(i).encode())
+
+
+def _fields(data):
+    """The identifying fields of a decoded message."""
+    return data["id"], data["topic"], data["payload"]
+
+
+def _parse(frame):
+    """Split an SSE frame into its fields."""
+    fields = dict(line.split(": ", 1) for line in frame.decode().strip().split("\n"))
+    if "data" in fields:
+        fields["data"] = json.loads(fields["data"])
+    return fields
+
+
+def test_single_message_frames():
+    """Without batching every message becomes its own data frame."""
+    q = ListenerQueue(maxsize=0)
+    q.put(_message(1))
+    q.put(_message(2))
+
+    events = message_events(q)
+    first, second = _parse(next(events)), _parse(next(events))
+    assert first["id"] == "1" and _fields(first["data"]) == (1, "t/1", "1")
+    assert second["id"] == "2" and _fields(second["data"]) == (2, "t/2", "2")
+
+
+def test_batch_frame_drains_queue():
+    """In batch mode all queued messages are sent as a single JSON array."""
+    q = ListenerQueue(maxsize=0)
+    for i in range(10):
+        q.put(_message(i))
+
+    frame = _parse(next(message_events(q, batch=True, max_wait=0)))
+    assert frame["event"] == "batch"
+    assert frame["id"] == "9"
+    assert [_fields(d) for d in frame["data"]] == [
+        (i, f"t/{i}", str(i)) for i in range(10)
+    ]
+    assert q.empty()
+
+
+def test_batch_respects_size_budget():
+    """A batch never grows beyond the configured maximum size."""
+    q = ListenerQueue(maxsize=0)
+    for i in range(1, 10):
+        q.put(_message(i))
+
+    batch = drain_batch(q, _message(0), max_size=4, max_wait=0)
+    assert len(batch) == 4
+    assert q.qsize() == 6
+
+
+def test_keepalive_when_idle():
+    """An idle stream emits an SSE comment to keep the connection open."""
+    q = ListenerQueue(maxsize=0)
+    assert next(message_events(q, keepalive=0.01)) == b": keepalive\n\n"
+
+
+def test_dropped_event_reports_overflow():
+    """Messages lost to the overflow policy are reported in a dropped event."""
+    q = ListenerQueue(maxsize=2, policy="drop-newest")
+    for i in range(5):
+        q.offer(_message(i))
+
+    events = message_events(q, drop_interval=0)
+    assert _fields(_parse(next(events))["data"]) == (0, "t/0", "0")
+    assert next(events) == b'event: dropped\ndata: {"dropped": 3}\n\n'
+
+
+def test_replay_is_sent_first_without_duplicates():
+    """Replayed messages come first and are not repeated by the live queue."""
+    q = ListenerQueue(maxsize=0)
+    q.put(_message(2))
+    q.put(_message(3))
+
+    events = message_events(q, replay=[_message(1), _message(2)])
+    assert _parse(next(events))["id"] == "1"
+    assert _parse(next(events))["id"] == "2"
+    assert _parse(next(events))["id"] == "3"
+
+
+def test_trace_event_follows_each_frame():
+    """With tracing on, a frame is followed by the timing of its messages."""
+    q = ListenerQueue(maxsize=0)
+    for i in range(3):
+        q.put(_message(i))
+
+    frame = next(message_events(q, batch=True, max_wait=0, trace=True))
+    batch, trace = frame.split(b"\n\n", 1)
+    assert _parse(batch + b"\n\n")["event"] == "batch"
+    trace = _parse(trace)
+    assert trace["event"] == "trace"
+    assert trace["data"]["ids"] == [0, 1, 2]
+    assert len(trace["data"]["queue_us"]) == 3
+    assert all(
+        0 <= wait <= total
+        for wait, total in zip(trace["data"]["queue_us"], trace["data"]["server_us"])
+    )
+
+
+def test_latest_mode_sends_one_update_per_topic():
+    """Messages of a topic are folded into its latest value and counted."""
+    q = ListenerQueue(maxsize=0)
+    for i in range(5):
+        q.put(Message(i, 1, "plant/temp", str(i).encode()))
+    q.put(Message(5, 1, "plant/hum", b"40"))
+
+    frame = _parse(next(latest_events(q, interval=0.05)))
+
+    assert frame["event"] == "latest"
+    assert frame["id"] == "5"
+    updates = {u["message"]["topic"]: u for u in frame["data"]}
+    assert updates["plant/temp"]["message"]["payload"] == "4"
+    assert updates["plant/temp"]["count"] == 5
+    assert updates["plant/hum"]["count"] == 1
+    assert updates["plant/temp"]["rate"] > 0
+
+
+def test_latest_mode_reports_quiet_topic_once():
+    """A topic that stops publishing gets a single update with rate 0."""
+    q = ListenerQueue(maxsize=0)
+    q.put(Message(1, 1, "plant/temp", b"21"))
+
+    events = latest_events(q, interval=0.01, keepalive=60)
+    next(events)
+    quiet = _parse(next(events))
+
+    assert [(u["message"]["id"], u["rate"]) for u in quiet["data"]] == [(1, 0)]
+
+    # Once reported quiet the topic is forgotten: its count starts over
+    q.put(Message(2, 1, "plant/temp", b"22"))
+    [update] = _parse(next(events))["data"]
+    assert (update["message"]["id"], update["count"]) == (2, 1)
+
+
+def test_latest_mode_bounds_topics_per_interval():
+    """Past max_topics the least recently updated topics are dropped."""
+    q = ListenerQueue(maxsize=0)
+    for i, topic in enumerate(["a", "b", "c", "b"]):
+        q.put(Message(i, 1, topic, b"x" * 100_000))
+
+    events = latest_events(q, interval=0.05, drop_interval=0.05, max_topics=2)
+    frame = _parse(next(events))
+    dropped = _parse(next(events))
+
+    assert [u["message"]["topic"] for u in frame["data"]] == ["c", "b"]
+    assert frame["data"][1]["count"] == 2
+    # Only the truncated preview of a payload is kept
+    assert frame["data"][0]["message"]["truncated"] is True
+    assert dropped["event"] == "dropped"
+    assert dropped["data"] == {"dropped": 1}
+
+
+def test_latest_interval_is_bounded():
+    """Requested intervals are clamped; non-finite ones are refused."""
+    assert latest_interval("0.2") == 0.2
+    assert latest_interval("0") == 0.05
+    assert latest_interval("1e9") == 60
+    for value in ("inf", "-inf", "nan", "soon"):
+        with pytest.raises(ValueError):
+            latest_interval(value)
@@ -0,0 +1,69 @@
+import pytest
+
+from topic_tree import TopicTree
+
+SECOND = 1_000_000_000
+
+
+def test_counts_aggregate_up_the_tree():
+    """Every level counts the messages of its whole subtree."""
+    tree = TopicTree()
+    tree.record("plant/a/temp", b"21", 0, 0)
+    tree.record("plant/a/temp", b"22", 0, 1)
+    tree.record("plant/b/temp", b"19", 0, 2)
+
+    root = tree.subtree()
+    assert root["count"] == 3
+    assert [(c["name"], c["count"], c["subtopics"]) for c in root["children"]] == [
+        ("plant", 3, 2)
+    ]
+
+    plant = tree.subtree("plant")
+    assert [(c["path"], c["count"]) for c in plant["children"]] == [
+        ("plant/a", 2),
+        ("plant/b", 1),
+    ]
+    leaf = tree.subtree("plant/a/temp")
+    assert leaf["message"]["payload"] == "22"
+    assert leaf["children"] == []
+    assert tree.subtree("plant/c") is None
+
+
+def test_latest_payload_is_truncated():
+    """Only the first bytes of a topic's latest payload are kept."""
+    tree = TopicTree(payload_bytes=4)
+    tree.record("big", b"0123456789", 0, 0)
+
+    message = tree.subtree("big")["message"]
+    assert message["payload"] == "0123"
+    assert message["size"] == 10
+    assert message["truncated"] is True
+
+
+def test_least_recently_updated_topics_are_evicted():
+    """Past max_topics the coldest topic is dropped with its empty branch."""
+    tree = TopicTree(max_topics=2)
+    tree.record("a/x", b"1", 0, 0)
+    tree.record("b/y", b"1", 0, 1)
+    tree.record("a/x", b"2", 0, 2)
+    tree.record("c/z", b"1", 0, 3)
+
+    root = tree.subtree()
+    assert [c["name"] for c in root["children"]] == ["a", "c"]
+    assert root["count"] == 4
+    assert root["topics"] == 2
+    assert root["evicted"] == 1
+
+
+def test_rate_covers_the_last_complete_window():
+    """Rates are messages per second over the previous window, 0 once stale."""
+    tree = TopicTree()
+    for i in range(20):
+        tree.record("t", b"", 0, 1 + i * SECOND // 2)
+    tree.record("t", b"", 0, 11 * SECOND)
+
+    # 20 messages in the window closed by the one at 11 s
+    assert tree.subtree("t", mono_ns=11 * SECOND)["rate"] == pytest.approx(
+        20 / 11, 1e-3
+    )
+    assert tree.subtree("t", mono_ns=40 * SECOND)["rate"] == 0.0
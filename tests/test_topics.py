@@ -0,0 +1,83 @@
+import pytest
+
+from topics import (
+    TopicTrie,
+    covers,
+    literal_prefix,
+    matches,
+    minimal_cover,
+    validate_filter,
+)
+
+
+@pytest.mark.parametrize(
+    "topic_filter, topic, expected",
+    [
+        ("a/b", "a/b", True),
+        ("a/b", "a/c", False),
+        ("a/+", "a/b", True),
+        ("a/+", "a/b/c", False),
+        ("+/+/temp", "plant/1/temp", True),
+        ("a/#", "a", True),
+        ("a/#", "a/b/c", True),
+        ("#", "anything/at/all", True),
+        ("a/b/c", "a/b", False),
+    ],
+)
+def test_matches(topic_filter, topic, expected):
+    """Wildcards follow the MQTT topic matching rules."""
+    assert matches(topic_filter, topic) is expected
+
+
+@pytest.mark.parametrize("topic_filter", ["", "a/#/b", "a/b#", "a/+b"])
+def test_invalid_filters(topic_filter):
+    """Misplaced wildcards are rejected."""
+    with pytest.raises(ValueError):
+        validate_filter(topic_filter)
+
+
+def test_literal_prefix():
+    """The literal prefix stops at the first wildcard level."""
+    assert literal_prefix("plant/+/temp") == ("plant", "+")
+    assert literal_prefix("a/b/#") == ("a/b", "#")
+    assert literal_prefix("a/b") == ("a/b", None)
+
+
+def test_trie_matches_like_matches():
+    """The trie returns exactly the filters that matches() accepts."""
+    filters = ["a/b", "a/+", "a/#", "+/b", "#", "a/b/c", "+/+/c", "x/#"]
+    trie = TopicTrie()
+    for f in filters:
+        trie.insert(f, f)
+
+    for topic in ["a", "a/b", "a/c", "a/b/c", "x", "x/y/z", "q/b"]:
+        expected = sorted(f for f in filters if matches(f, topic))
+        assert sorted(trie.match(topic)) == expected, topic
+
+
+@pytest.mark.parametrize(
+    "general, specific, expected",
+    [
+        ("a/#", "a/b", True),
+        ("a/#", "a", True),
+        ("a/#", "a/+/c", True),
+        ("a/+", "a/b", True),
+        ("a/+", "a/#", False),
+        ("a/b", "a/+", False),
+        ("#", "anything/#", True),
+        ("a/+/c", "a/b/c", True),
+        ("a/+", "a/b/c", False),
+    ],
+)
+def test_covers(general, specific, expected):
+    """A filter covers another when it matches a superset of its topics."""
+    assert covers(general, specific) is expected
+
+
+def test_minimal_cover_folds_qos():
+    """Covered filters are dropped and their QoS raises the covering filter."""
+    assert minimal_cover({"a/#": 0, "a/b": 1, "a/+/c": 2, "x/y": 0}) == {
+        "a/#": 2,
+        "x/y": 0,
+    }
+    assert minimal_cover({"a/b": 0, "a/c": 1}) == {"a/b": 0, "a/c": 1}